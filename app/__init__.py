@@ -3,7 +3,9 @@ from __future__ import annotations
 
 import os
 from flask import Flask, session
-from .db import close_db
+from .asaas import breaker as asaas_breaker
+from .db import close_db, get_db, init_db, rebuild_patient_balances
+from .jobs import start_worker
 from .auth import bp as auth_bp
 from .dashboard import bp as dashboard_bp
 from .patients import bp as patients_bp
@@ -12,6 +14,10 @@ from .agenda import bp as agenda_bp
 from .birthdays import bp as birthdays_bp
 from .ortho import bp as ortho_bp
 from .boletos import bp as boletos_bp
+from .asaas_sync import bp as asaas_sync_bp
+from .reminders import bp as reminders_bp
+from .waitlist import bp as waitlist_bp
+from .statements import bp as statements_bp
 
 def create_app() -> Flask:
     app = Flask(__name__, instance_relative_config=True)
@@ -22,9 +28,18 @@ def create_app() -> Flask:
     # ASAAS_ENV: sandbox|production
     app.config["ASAAS_ENV"] = (os.environ.get("ASAAS_ENV", "sandbox") or "sandbox").strip().lower()
     app.config["ASAAS_API_KEY"] = (os.environ.get("ASAAS_API_KEY", "") or "").strip()
+    # Opcional: sobrescreve a URL da API (ex.: servidor local de testes)
+    app.config["ASAAS_BASE_URL"] = (os.environ.get("ASAAS_BASE_URL", "") or "").strip()
+    # Lotes (carnê etc.): chamadas simultâneas e limite de chamadas por segundo
+    app.config["ASAAS_MAX_CONCURRENCY"] = os.environ.get("ASAAS_MAX_CONCURRENCY", "4")
+    app.config["ASAAS_RATE_PER_SEC"] = os.environ.get("ASAAS_RATE_PER_SEC", "5")
     # Token opcional para validar Webhooks do Asaas (header: asaas-access-token)
     app.config["ASAAS_WEBHOOK_TOKEN"] = (os.environ.get("ASAAS_WEBHOOK_TOKEN", "") or "").strip()
 
+    # Thread de tarefas em segundo plano (emissão de boletos etc.), ligada só pelos pontos
+    # de entrada do servidor (start_server). JOBS_WORKER=0 desliga.
+    app.config["JOBS_WORKER"] = (os.environ.get("JOBS_WORKER", "1") or "1").strip() != "0"
+
     # Informações da clínica (para impressão de orçamento/anamnese etc.)
     # Pode personalizar no Render/PC via variáveis de ambiente.
     app.config["CLINIC_NAME"] = os.environ.get("CLINIC_NAME", "NewClínica Odonto")
@@ -48,6 +63,8 @@ def create_app() -> Flask:
             "finance_unlocked": bool(session.get("finance_unlocked")),
             "ASAAS_ENV": app.config.get("ASAAS_ENV", "sandbox"),
             "ASAAS_ENABLED": bool(app.config.get("ASAAS_API_KEY")),
+            # circuito do Asaas aberto = mostrar "Asaas indisponível" sem chamar a API
+            "ASAAS_AVAILABLE": asaas_breaker.is_available(),
         }
 
     @app.context_processor
@@ -71,12 +88,48 @@ def create_app() -> Flask:
     app.register_blueprint(birthdays_bp)
     app.register_blueprint(ortho_bp)
     app.register_blueprint(boletos_bp)
+    app.register_blueprint(asaas_sync_bp)
+    app.register_blueprint(reminders_bp)
+    app.register_blueprint(waitlist_bp)
+    app.register_blueprint(statements_bp)
 
     # DB teardown
     app.teardown_appcontext(close_db)
 
+    @app.cli.command("rebuild-balances")
+    def rebuild_balances_command():
+        """Recalcula patient_balances de todos os pacientes (flask --app wsgi rebuild-balances)."""
+        init_db()
+        db = get_db()
+        n = rebuild_patient_balances(db)
+        db.commit()
+        print(f"{n} saldo(s) recalculado(s).")
+
+    return app
+
 
+def start_server(app: Flask) -> Flask:
+    """Migrações + thread de tarefas do processo do servidor (wsgi.py / run.py).
+
+    Fica fora do create_app: importar o pacote (scripts, testes, CLI) não sobe
+    worker nenhum nem mexe no banco.
+    """
+    with app.app_context():
+        init_db()
+    if app.config["JOBS_WORKER"]:
+        start_worker(app)
     return app
 
-# Compatibilidade Render (quando Start Command está como gunicorn app:app)
-app = create_app()
+
+_server_app: Flask | None = None
+
+
+def __getattr__(name: str):
+    # Compatibilidade Render (quando Start Command está como gunicorn app:app):
+    # o app do servidor só é montado quando alguém pede app.app
+    global _server_app
+    if name == "app":
+        if _server_app is None:
+            _server_app = start_server(create_app())
+        return _server_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,13 +1,43 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
-from datetime import datetime, timedelta
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from flask import Blueprint, Response, current_app, render_template, request, jsonify, redirect, url_for, flash
 from .auth import login_required
-from .db import get_db
+from .db import cached_by_version, get_db
+from .waitlist import offer_freed_slot
 
 bp = Blueprint("agenda", __name__, url_prefix="/agenda")
 
+APPT_STATUS_LABELS = {
+    "scheduled": "Agendado",
+    "confirmed": "Confirmado",
+    "attended": "Compareceu",
+    "no_show": "Faltou",
+    "cancelled": "Cancelado",
+}
+
+WEEKDAYS_PT = ["Domingo", "Segunda", "Terça", "Quarta", "Quinta", "Sexta", "Sábado"]
+
+# Limite de itens por lote (reagendar o dia inteiro de um profissional cabe com folga)
+BATCH_MAX_ITEMS = 200
+
+# ===== iCalendar (feed por profissional) =====
+# Quantos dias para trás entram no feed (o celular não precisa do histórico inteiro)
+ICAL_PAST_DAYS = 180
+# Blocos VEVENT já renderizados: appointment_id -> ((updated_at, version), texto). LRU limitado por worker.
+ICAL_CACHE_MAX = 20000
+_ical_blocks: OrderedDict[int, tuple[tuple[str, int], str]] = OrderedDict()
+# Feed completo por profissional: provider_id -> (etag, corpo)
+_ical_feeds: dict[int, tuple[str, str]] = {}
+_ical_lock = threading.Lock()
+
 def _iso_to_sql(dt_iso: str | None) -> str | None:
     """Aceita ISO (com ou sem timezone) e retorna 'YYYY-MM-DD HH:MM:SS'."""
     if not dt_iso:
@@ -42,13 +72,17 @@ def _sql_to_iso(dt_sql: str | None) -> str | None:
     except Exception:
         return None
 
+def _parse_id(raw: Any) -> int | None:
+    s = str(raw).strip() if raw is not None else ""
+    return int(s) if s.isdigit() else None
+
 @bp.get("/")
 @login_required
 def calendar_view():
     db = get_db()
     patients = db.execute("SELECT id, name FROM patients ORDER BY name COLLATE NOCASE").fetchall()
     providers = db.execute("SELECT id, name FROM providers ORDER BY name COLLATE NOCASE").fetchall()
-    return render_template("agenda_calendar.html", patients=patients, providers=providers)
+    return render_template("agenda_calendar.html", patients=patients, providers=providers, status_labels=APPT_STATUS_LABELS)
 
 @bp.get("/events")
 @login_required
@@ -69,7 +103,7 @@ def events():
 
     rows = db.execute(
         f"""
-        SELECT a.id, a.title, a.start_at, a.end_at, a.note,
+        SELECT a.id, a.title, a.start_at, a.end_at, a.note, a.status, a.version,
                a.patient_id, p.name AS patient_name, p.phone AS patient_phone,
                a.provider_id, pr.name AS provider_name
           FROM appointments a
@@ -106,6 +140,8 @@ def events():
                 "provider_name": r["provider_name"] or "",
                 "note": r["note"] or "",
                 "raw_title": r["title"] or "Consulta",
+                "status": r["status"] or "scheduled",
+                "version": int(r["version"] or 0),
             }
         })
     return jsonify(out)
@@ -115,11 +151,7 @@ def events():
 def create_event():
     db = get_db()
     patient_id = request.form.get("patient_id", type=int)
-    provider_id_raw = request.form.get("provider_id")
-    provider_id = None
-    if provider_id_raw is not None:
-        s = str(provider_id_raw).strip()
-        provider_id = int(s) if s.isdigit() else None
+    provider_id = _parse_id(request.form.get("provider_id"))
     title = (request.form.get("title") or "Consulta").strip()
     start_at = _iso_to_sql(request.form.get("start_at"))
     end_at = _iso_to_sql(request.form.get("end_at"))
@@ -130,51 +162,456 @@ def create_event():
         return redirect(url_for("agenda.calendar_view"))
 
     db.execute(
-        "INSERT INTO appointments(patient_id, provider_id, title, start_at, end_at, note) VALUES(?,?,?,?,?,?)",
+        "INSERT INTO appointments(patient_id, provider_id, title, start_at, end_at, note, updated_at) VALUES(?,?,?,?,?,?, datetime('now'))",
         (patient_id, provider_id, title, start_at, end_at, note),
     )
     db.commit()
     flash("Agendamento criado.", "success")
     return redirect(url_for("agenda.calendar_view"))
 
+def _event_changes(src) -> dict[str, Any]:
+    """Extrai os campos alterados de um agendamento (form ou item JSON).
+
+    Só entram as chaves enviadas: drag/drop manda apenas start/end, o modal manda tudo.
+    """
+    changes: dict[str, Any] = {}
+    start_at = _iso_to_sql(src.get("start_at"))
+    end_at = _iso_to_sql(src.get("end_at"))
+    if start_at:
+        changes["start_at"] = start_at
+    if end_at:
+        changes["end_at"] = end_at
+    if "title" in src:
+        changes["title"] = (src.get("title") or "Consulta").strip()
+    if "provider_id" in src:
+        changes["provider_id"] = _parse_id(src.get("provider_id"))
+    if "note" in src:
+        changes["note"] = (src.get("note") or "").strip()
+    status = (src.get("status") or "").strip()
+    if status in APPT_STATUS_LABELS:
+        changes["status"] = status
+    return changes
+
+def _apply_event_changes(db, aid: int, changes: dict[str, Any], expected_version: int | None = None) -> dict[str, Any]:
+    """Aplica as alterações num único UPDATE (com controle de versão otimista).
+
+    Retorna {"id", "ok", "version"} ou {"id", "ok": False, "error": "not_found"|"conflict"}.
+    Não faz commit: quem chama decide a transação.
+    """
+    if changes:
+        # colunas vêm de _event_changes (lista fixa), nunca do cliente
+        sets = ", ".join(f"{col}=?" for col in changes)
+        sql = f"UPDATE appointments SET {sets}, version=version+1, updated_at=datetime('now') WHERE id=?"
+        params: list[Any] = [*changes.values(), aid]
+        if expected_version is not None:
+            sql += " AND version=?"
+            params.append(expected_version)
+        updated = db.execute(sql, tuple(params)).rowcount
+    else:
+        updated = 0
+
+    row = db.execute("SELECT version FROM appointments WHERE id=?", (aid,)).fetchone()
+    if not row:
+        return {"id": aid, "ok": False, "error": "not_found"}
+    version = int(row["version"] or 0)
+    if changes and not updated:
+        return {"id": aid, "ok": False, "error": "conflict", "version": version}
+    return {"id": aid, "ok": True, "version": version}
+
 @bp.post("/event/<int:aid>/update")
 @login_required
 def update_event(aid: int):
     db = get_db()
     # Pode vir de drag/drop (start/end) ou do formulário completo
-    start_at = _iso_to_sql(request.form.get("start_at"))
-    end_at = _iso_to_sql(request.form.get("end_at"))
-    title = request.form.get("title")
-    provider_id_raw = request.form.get("provider_id")
-    provider_id = None
-    if provider_id_raw is not None:
-        s = str(provider_id_raw).strip()
-        provider_id = int(s) if s.isdigit() else None
-    note = request.form.get("note")
-
-    # Atualização mínima
-    if start_at or end_at:
-        db.execute(
-            "UPDATE appointments SET start_at=COALESCE(?, start_at), end_at=COALESCE(?, end_at) WHERE id=?",
-            (start_at, end_at, aid),
-        )
-
-    # Atualização completa (se enviado)
-    if title is not None:
-        db.execute("UPDATE appointments SET title=? WHERE id=?", ((title or "Consulta").strip(), aid))
-    if provider_id_raw is not None:
-        db.execute("UPDATE appointments SET provider_id=? WHERE id=?", (provider_id, aid))
-    if note is not None:
-        db.execute("UPDATE appointments SET note=? WHERE id=?", ((note or "").strip(), aid))
+    changes = _event_changes(request.form)
+    raw_version = (request.form.get("version") or "").strip()
+    # versão informada tem que ser inteira: senão a checagem de concorrência sumiria sem aviso
+    if raw_version and not raw_version.lstrip("-").isdigit():
+        return jsonify({"id": aid, "ok": False, "error": "version inválida"}), 400
+    expected_version = int(raw_version) if raw_version else None
+
+    result = _apply_event_changes(db, aid, changes, expected_version)
+    if not result["ok"]:
+        db.rollback()
+        status = 404 if result["error"] == "not_found" else 409
+        return jsonify(result), status
 
     db.commit()
-    return jsonify({"ok": True})
+    return jsonify(result)
+
+@bp.post("/events/batch")
+@login_required
+def update_events_batch():
+    """Aplica várias alterações de agenda numa única transação (tudo ou nada).
+
+    Corpo: {"items": [{"id": 1, "version": 3, "start_at": "...", "end_at": "...", ...}, ...]}
+    Se algum item falhar (inexistente ou versão desatualizada), nada é gravado e a
+    resposta traz o resultado de cada item para a tela decidir o que reverter.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"ok": False, "error": "corpo JSON deve ser um objeto"}), 400
+    items = body.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"ok": False, "error": "items obrigatório"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"ok": False, "error": f"máximo de {BATCH_MAX_ITEMS} itens por lote"}), 400
+
+    db = get_db()
+    results = []
+    for item in items:
+        aid = _parse_id(item.get("id")) if isinstance(item, dict) else None
+        if not aid:
+            results.append({"id": item.get("id") if isinstance(item, dict) else None, "ok": False, "error": "invalid"})
+            continue
+        expected_version = item.get("version")
+        # versão informada tem que ser inteira: senão a checagem de concorrência sumiria sem aviso
+        if expected_version is not None and (isinstance(expected_version, bool) or not isinstance(expected_version, int)):
+            return jsonify({"ok": False, "error": f"version inválida no item {aid}"}), 400
+        results.append(_apply_event_changes(db, aid, _event_changes(item), expected_version))
+
+    if all(r["ok"] for r in results):
+        db.commit()
+        return jsonify({"ok": True, "applied": True, "results": results})
+
+    db.rollback()
+    # versões atuais (pós-rollback) para a tela sincronizar antes de tentar de novo
+    ids = [r["id"] for r in results if "version" in r]
+    if ids:
+        placeholders = ",".join(["?"] * len(ids))
+        current = {
+            int(row["id"]): int(row["version"] or 0)
+            for row in db.execute(f"SELECT id, version FROM appointments WHERE id IN ({placeholders})", tuple(ids)).fetchall()
+        }
+        for r in results:
+            if "version" in r:
+                r["version"] = current.get(r["id"], r["version"])
+    return jsonify({"ok": False, "applied": False, "results": results}), 409
+
+def _noshow_group(rows, label) -> list[dict[str, Any]]:
+    """Calcula a taxa de faltas de cada grupo (faltou / (compareceu + faltou))."""
+    out = []
+    for r in rows:
+        total = int(r["total"] or 0)
+        attended = int(r["attended"] or 0)
+        no_show = int(r["no_show"] or 0)
+        cancelled = int(r["cancelled"] or 0)
+        marked = attended + no_show
+        out.append({
+            "label": label(r),
+            "total": total,
+            "attended": attended,
+            "no_show": no_show,
+            "cancelled": cancelled,
+            "unmarked": total - marked - cancelled,
+            "rate": round(100.0 * no_show / marked, 1) if marked else None,
+        })
+    return out
+
+def _noshow_stats(db, start_sql: str, end_sql: str) -> dict[str, Any]:
+    """Faltas por profissional, dia da semana, hora e paciente.
+
+    Cada agrupamento é um GROUP BY sobre idx_appt_start_status (índice cobre
+    start_at/status/provider_id/patient_id); nomes entram só depois de agrupar.
+    """
+    counts = (
+        "COUNT(*) AS total, "
+        "SUM(a.status='attended') AS attended, "
+        "SUM(a.status='no_show') AS no_show, "
+        "SUM(a.status='cancelled') AS cancelled"
+    )
+    where = "a.start_at >= ? AND a.start_at < ?"
+    params = (start_sql, end_sql)
+
+    overall = db.execute(f"SELECT {counts} FROM appointments a WHERE {where}", params).fetchall()
+    by_provider = db.execute(
+        f"""
+        SELECT g.*, pr.name AS provider_name
+          FROM (SELECT a.provider_id, {counts} FROM appointments a WHERE {where} GROUP BY a.provider_id) g
+          LEFT JOIN providers pr ON pr.id = g.provider_id
+         ORDER BY g.no_show DESC, g.total DESC
+        """,
+        params,
+    ).fetchall()
+    by_weekday = db.execute(
+        f"SELECT CAST(strftime('%w', a.start_at) AS INTEGER) AS wd, {counts} FROM appointments a WHERE {where} GROUP BY wd ORDER BY wd",
+        params,
+    ).fetchall()
+    by_hour = db.execute(
+        f"SELECT CAST(substr(a.start_at, 12, 2) AS INTEGER) AS hh, {counts} FROM appointments a WHERE {where} GROUP BY hh ORDER BY hh",
+        params,
+    ).fetchall()
+    by_patient = db.execute(
+        f"""
+        SELECT g.*, p.name AS patient_name, p.phone AS patient_phone
+          FROM (SELECT a.patient_id, {counts} FROM appointments a WHERE {where}
+                 GROUP BY a.patient_id HAVING SUM(a.status='no_show') > 0) g
+          JOIN patients p ON p.id = g.patient_id
+         ORDER BY g.no_show DESC, g.total DESC
+         LIMIT 30
+        """,
+        params,
+    ).fetchall()
+
+    return {
+        "overall": _noshow_group(overall, lambda r: "Total")[0],
+        "by_provider": _noshow_group(by_provider, lambda r: r["provider_name"] or "Sem profissional"),
+        "by_weekday": _noshow_group(by_weekday, lambda r: WEEKDAYS_PT[int(r["wd"] or 0)]),
+        "by_hour": _noshow_group(by_hour, lambda r: f"{int(r['hh'] or 0):02d}h"),
+        "by_patient": [
+            g | {"patient_id": int(r["patient_id"]), "phone": r["patient_phone"] or ""}
+            for g, r in zip(_noshow_group(by_patient, lambda r: r["patient_name"]), by_patient)
+        ],
+    }
+
+@bp.get("/analytics")
+@login_required
+def noshow_analytics():
+    """Relatório de faltas (no-show). Padrão: últimos 12 meses até hoje."""
+    db = get_db()
+    today = datetime.now().date()
+    date_from = (request.args.get("from") or "").strip()
+    date_to = (request.args.get("to") or "").strip()
+    try:
+        d_from = datetime.strptime(date_from, "%Y-%m-%d").date()
+    except ValueError:
+        d_from = today - timedelta(days=365)
+    try:
+        d_to = datetime.strptime(date_to, "%Y-%m-%d").date()
+    except ValueError:
+        d_to = today
+    # consultas futuras ainda não têm desfecho: o período vai no máximo até hoje
+    d_to = min(d_to, today)
+
+    start_sql = f"{d_from.isoformat()} 00:00:00"
+    end_sql = f"{(d_to + timedelta(days=1)).isoformat()} 00:00:00"
+    stats = cached_by_version(
+        db,
+        ("appointments", "patients", "providers"),
+        ("noshow", start_sql, end_sql),
+        lambda: _noshow_stats(db, start_sql, end_sql),
+    )
+    return render_template(
+        "agenda_analytics.html",
+        stats=stats,
+        date_from=d_from.isoformat(),
+        date_to=d_to.isoformat(),
+    )
 
 @bp.post("/event/<int:aid>/delete")
 @login_required
 def delete_event(aid: int):
     db = get_db()
+    appt = db.execute("SELECT patient_id, provider_id, start_at, end_at FROM appointments WHERE id=?", (aid,)).fetchone()
     db.execute("DELETE FROM appointments WHERE id=?", (aid,))
     db.commit()
     flash("Agendamento excluído.", "success")
-    return redirect(url_for("agenda.calendar_view"))
+    offers_url = offer_freed_slot(db, appt)
+    return redirect(offers_url or url_for("agenda.calendar_view"))
+
+
+
+# =========================
+# iCalendar por profissional
+# =========================
+
+def _ics_escape(text: str | None) -> str:
+    s = str(text or "")
+    return (
+        s.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+def _ics_fold(line: str) -> str:
+    """Quebra linhas com mais de 75 octetos (RFC 5545, 3.1)."""
+    if len(line.encode("utf-8")) <= 75:
+        return line
+    parts: list[str] = []
+    chunk = ""
+    size = 0
+    for ch in line:
+        n = len(ch.encode("utf-8"))
+        limit = 75 if not parts else 74  # continuação começa com um espaço
+        if size + n > limit:
+            parts.append(chunk)
+            chunk, size = "", 0
+        chunk += ch
+        size += n
+    parts.append(chunk)
+    return "\r\n ".join(parts)
+
+def _ics_stamp(dt_sql: str | None) -> str | None:
+    """'YYYY-MM-DD HH:MM:SS' -> 'YYYYMMDDTHHMMSS'."""
+    iso = _sql_to_iso(dt_sql)
+    return iso.replace("-", "").replace(":", "") if iso else None
+
+def _render_vevent(r) -> str:
+    start = _ics_stamp(r["start_at"])
+    end = _ics_stamp(r["end_at"])
+    if start and not end:
+        # padrão: 30 minutos (igual ao calendário)
+        end = (datetime.strptime(start, "%Y%m%dT%H%M%S") + timedelta(minutes=30)).strftime("%Y%m%dT%H%M%S")
+    # updated_at vem de datetime('now') do SQLite, que já é UTC
+    updated = (_ics_stamp(r["updated_at"]) or "19700101T000000") + "Z"
+
+    desc = []
+    if r["patient_phone"]:
+        desc.append(f"Telefone: {r['patient_phone']}")
+    if r["note"]:
+        desc.append(r["note"])
+
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:appt-{int(r['id'])}@newclinica",
+        f"DTSTAMP:{updated}",
+        f"LAST-MODIFIED:{updated}",
+        f"SEQUENCE:{int(r['version'] or 0)}",
+        # horário "de parede" (sem fuso): o celular mostra no fuso local, igual à agenda
+        f"DTSTART:{start}",
+        f"DTEND:{end}",
+        "SUMMARY:" + _ics_escape(f"{r['patient_name']} • {r['title'] or 'Consulta'}"),
+    ]
+    if desc:
+        lines.append("DESCRIPTION:" + _ics_escape("\n".join(desc)))
+    lines.append("END:VEVENT")
+    return "\r\n".join(_ics_fold(x) for x in lines)
+
+def _build_ical(db, provider, since: str) -> str:
+    """Monta o .ics reaproveitando os VEVENT já renderizados (chave: id + updated_at)."""
+    prid = int(provider["id"])
+    index = db.execute(
+        "SELECT id, updated_at, version FROM appointments WHERE provider_id=? AND start_at>=? ORDER BY start_at ASC, id ASC",
+        (prid, since),
+    ).fetchall()
+
+    blocks: dict[int, str] = {}
+    missing: list[int] = []
+    with _ical_lock:
+        for r in index:
+            aid = int(r["id"])
+            hit = _ical_blocks.get(aid)
+            # version desempata edições feitas no mesmo segundo
+            if hit and hit[0] == (r["updated_at"], int(r["version"] or 0)):
+                blocks[aid] = hit[1]
+                _ical_blocks.move_to_end(aid)
+            else:
+                missing.append(aid)
+
+    # só os eventos novos/alterados vão ao banco completo (em lotes, por causa do limite de parâmetros)
+    fresh: list[tuple[int, tuple[str, int], str]] = []
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        placeholders = ",".join(["?"] * len(chunk))
+        rows = db.execute(
+            f"""
+            SELECT a.id, a.title, a.start_at, a.end_at, a.note, a.status, a.version, a.updated_at,
+                   p.name AS patient_name, p.phone AS patient_phone
+              FROM appointments a
+              JOIN patients p ON p.id = a.patient_id
+             WHERE a.id IN ({placeholders})
+            """,
+            tuple(chunk),
+        ).fetchall()
+        for r in rows:
+            block = _render_vevent(r)
+            blocks[int(r["id"])] = block
+            fresh.append((int(r["id"]), (r["updated_at"], int(r["version"] or 0)), block))
+
+    if fresh:
+        with _ical_lock:
+            for aid, key, block in fresh:
+                _ical_blocks[aid] = (key, block)
+                _ical_blocks.move_to_end(aid)
+            while len(_ical_blocks) > ICAL_CACHE_MAX:
+                _ical_blocks.popitem(last=False)
+
+    clinic = current_app.config.get("CLINIC_NAME", "NewClínica")
+    head = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//NewClinica V2//Agenda//PT-BR",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        _ics_fold("X-WR-CALNAME:" + _ics_escape(f"{clinic} • {provider['name']}")),
+        "REFRESH-INTERVAL;VALUE=DURATION:PT15M",
+    ]
+    body = [blocks[int(r["id"])] for r in index if int(r["id"]) in blocks]
+    return "\r\n".join(head + body + ["END:VCALENDAR"]) + "\r\n"
+
+@bp.post("/providers/<int:prid>/ical_link")
+@login_required
+def ical_link(prid: int):
+    """Retorna (e cria, se preciso) o link secreto do feed .ics do profissional.
+    Com reset=1 gera um token novo, invalidando o link antigo."""
+    db = get_db()
+    row = db.execute("SELECT id, ical_token FROM providers WHERE id=?", (prid,)).fetchone()
+    if not row:
+        return jsonify({"ok": False, "error": "Profissional não encontrado"}), 404
+
+    token = row["ical_token"]
+    if not token or request.form.get("reset") == "1":
+        token = secrets.token_urlsafe(24)
+        db.execute("UPDATE providers SET ical_token=? WHERE id=?", (token, prid))
+        db.commit()
+        with _ical_lock:
+            _ical_feeds.pop(prid, None)
+    return jsonify({"ok": True, "url": url_for("agenda.ical_feed", token=token, _external=True)})
+
+@bp.get("/ical/<token>.ics")
+def ical_feed(token: str):
+    """Feed somente leitura para o calendário do celular (sem login: o token é a credencial).
+
+    O celular consulta a cada ~15 min; enquanto nada muda, a resposta é um 304
+    calculado com uma única consulta agregada no índice (provider_id, start_at).
+    """
+    db = get_db()
+    provider = db.execute("SELECT id, name FROM providers WHERE ical_token=?", (token,)).fetchone()
+    if not provider:
+        return Response("Not found", status=404, mimetype="text/plain")
+    prid = int(provider["id"])
+
+    since = (datetime.now() - timedelta(days=ICAL_PAST_DAYS)).strftime("%Y-%m-%d 00:00:00")
+    stamp = db.execute(
+        "SELECT COUNT(*) AS n, MAX(id) AS max_id, MAX(updated_at) AS max_upd, SUM(version) AS sum_ver "
+        "FROM appointments WHERE provider_id=? AND start_at>=?",
+        (prid, since),
+    ).fetchone()
+    etag = hashlib.sha1(
+        f"{prid}:{provider['name']}:{stamp['n']}:{stamp['max_id']}:{stamp['max_upd']}:{stamp['sum_ver']}".encode("utf-8")
+    ).hexdigest()
+    last_modified = None
+    if stamp["max_upd"]:
+        try:
+            last_modified = datetime.fromisoformat(_sql_to_iso(stamp["max_upd"])).replace(tzinfo=timezone.utc)
+        except (TypeError, ValueError):
+            last_modified = None
+
+    # If-None-Match tem precedência sobre If-Modified-Since
+    not_modified = False
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    elif last_modified and request.if_modified_since:
+        not_modified = last_modified <= request.if_modified_since
+
+    if not_modified:
+        resp = Response(status=304)
+    else:
+        with _ical_lock:
+            cached = _ical_feeds.get(prid)
+        if cached and cached[0] == etag:
+            body = cached[1]
+        else:
+            body = _build_ical(db, provider, since)
+            with _ical_lock:
+                _ical_feeds[prid] = (etag, body)
+        resp = Response(body, mimetype="text/calendar")
+        resp.headers["Content-Disposition"] = f'inline; filename="agenda-{prid}.ics"'
+
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
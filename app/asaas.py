@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""Cliente HTTP do Asaas (boletos).
+
+Um único requests.Session por processo (keep-alive + pool de conexões), com
+timeouts separados de conexão/leitura por tipo de chamada, novas tentativas com
+backoff exponencial + jitter para 429/5xx e contadores de latência/erro por endpoint.
+Um circuit breaker por processo corta as chamadas enquanto o Asaas está fora.
+"""
+from __future__ import annotations
+
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
+
+ASAAS_PRODUCTION_URL = "https://api.asaas.com/v3"
+ASAAS_SANDBOX_URL = "https://api-sandbox.asaas.com/v3"
+
+# (conexão, leitura) em segundos por tipo de chamada
+TIMEOUTS: dict[str, tuple[float, float]] = {
+    "read": (3.05, 10.0),   # consultas (GET)
+    "write": (3.05, 25.0),  # criação de cliente/cobrança
+}
+
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5   # s
+BACKOFF_MAX = 8.0    # s
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+POOL_MAXSIZE = 16  # >= threads do gunicorn + workers de fila
+
+# Chamadas em lote (carnê, sincronizações): limites padrão se não houver config
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_RATE_PER_SEC = 5.0
+
+# Circuit breaker: abre se, nos últimos CB_WINDOW_SECONDS, houver pelo menos
+# CB_MIN_CALLS chamadas e CB_FAILURE_RATE delas falharem (rede/timeout/429/5xx)
+CB_WINDOW_SECONDS = 60
+CB_MIN_CALLS = 5
+CB_FAILURE_RATE = 0.5
+CB_OPEN_SECONDS = 30
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class AsaasError(RuntimeError):
+    """Erro de chamada ao Asaas (status None = falha de rede/timeout)."""
+
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retryable(self) -> bool:
+        return self.status is None or self.status in RETRY_STATUS
+
+
+class AsaasUnavailable(AsaasError):
+    """Circuito aberto: nem tentamos a chamada. defer_seconds = quando vale tentar de novo."""
+
+    def __init__(self, defer_seconds: float):
+        super().__init__("Asaas indisponível no momento (muitas falhas seguidas). Tente mais tarde.")
+        self.defer_seconds = max(1, int(defer_seconds))
+
+
+class CircuitBreaker:
+    """closed -> open (taxa de falha alta) -> half_open (1 chamada de teste) -> closed/open."""
+
+    def __init__(self, *, window: float = CB_WINDOW_SECONDS, min_calls: int = CB_MIN_CALLS,
+                 failure_rate: float = CB_FAILURE_RATE, open_seconds: float = CB_OPEN_SECONDS):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.lock = threading.Lock()
+        self.outcomes: deque[tuple[float, bool]] = deque()
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+
+    def _trim(self, now: float) -> None:
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+
+    def _current(self, now: float) -> str:
+        if self.state == "open" and now - self.opened_at >= self.open_seconds:
+            self.state = "half_open"
+            self.probe_in_flight = False
+        return self.state
+
+    def before_call(self) -> None:
+        """Levanta AsaasUnavailable se a chamada não deve ser feita agora."""
+        with self.lock:
+            now = time.monotonic()
+            state = self._current(now)
+            if state == "open":
+                raise AsaasUnavailable(self.open_seconds - (now - self.opened_at))
+            if state == "half_open":
+                if self.probe_in_flight:
+                    raise AsaasUnavailable(1)
+                self.probe_in_flight = True
+
+    def record(self, ok: bool) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "half_open":
+                self.probe_in_flight = False
+                if ok:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                else:
+                    self._open(now)
+                return
+            self.outcomes.append((now, ok))
+            self._trim(now)
+            if self.state == "closed" and len(self.outcomes) >= self.min_calls:
+                failures = sum(1 for _, good in self.outcomes if not good)
+                if failures / len(self.outcomes) >= self.failure_rate:
+                    self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = "open"
+        self.opened_at = now
+        self.times_opened += 1
+        self.outcomes.clear()
+
+    def is_available(self) -> bool:
+        """Para a interface: False enquanto o circuito estiver aberto (sem chamar o Asaas)."""
+        with self.lock:
+            return self._current(time.monotonic()) != "open"
+
+    def snapshot(self) -> dict[str, Any]:
+        with self.lock:
+            now = time.monotonic()
+            state = self._current(now)
+            self._trim(now)
+            calls = len(self.outcomes)
+            failures = sum(1 for _, good in self.outcomes if not good)
+            return {
+                "state": state,
+                "window_calls": calls,
+                "window_failures": failures,
+                "failure_rate": round(failures / calls, 3) if calls else 0.0,
+                "times_opened": self.times_opened,
+                "retry_in_s": round(max(0.0, self.open_seconds - (now - self.opened_at)), 1) if state == "open" else 0.0,
+            }
+
+
+breaker = CircuitBreaker()
+
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+_metrics: dict[str, dict[str, Any]] = {}
+_metrics_lock = threading.Lock()
+
+_ID_SEGMENT = re.compile(r"^(?:[a-z]{2,5}_[A-Za-z0-9]+|\d+)$")
+
+
+def _get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                s = requests.Session()
+                # sem retry automático do urllib3: as novas tentativas são decididas aqui
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _session = s
+    return _session
+
+
+def endpoint_key(method: str, path: str) -> str:
+    """'GET /payments/pay_123/identificationField' -> 'GET /payments/:id/identificationField'."""
+    parts = [":id" if _ID_SEGMENT.match(p) else p for p in path.strip("/").split("/")]
+    return f"{method.upper()} /" + "/".join(parts)
+
+
+def _record(key: str, elapsed_ms: float, *, error: bool, retried: bool, status: int | None) -> None:
+    with _metrics_lock:
+        m = _metrics.get(key)
+        if m is None:
+            m = _metrics[key] = {"calls": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0, "last_status": None}
+        m["calls"] += 1
+        m["errors"] += 1 if error else 0
+        m["retries"] += 1 if retried else 0
+        m["total_ms"] += elapsed_ms
+        m["max_ms"] = max(m["max_ms"], elapsed_ms)
+        m["last_status"] = status
+
+
+def metrics_snapshot() -> dict[str, dict[str, Any]]:
+    """Cópia dos contadores por endpoint, com latência média."""
+    with _metrics_lock:
+        out = {k: dict(v) for k, v in _metrics.items()}
+    for m in out.values():
+        m["avg_ms"] = round(m["total_ms"] / m["calls"], 1) if m["calls"] else 0.0
+        m["total_ms"] = round(m["total_ms"], 1)
+        m["max_ms"] = round(m["max_ms"], 1)
+    return out
+
+
+def reset_metrics() -> None:
+    with _metrics_lock:
+        _metrics.clear()
+
+
+def _backoff(attempt: int, retry_after: str | None = None) -> float:
+    """Backoff exponencial com jitter total; respeita Retry-After (segundos) do 429."""
+    if retry_after and retry_after.strip().isdigit():
+        return min(BACKOFF_MAX, float(retry_after.strip()))
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+class AsaasClient:
+    def __init__(self, base_url: str, api_key: str, *, max_retries: int = MAX_RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.headers = {
+            "access_token": api_key,
+            "Content-Type": "application/json",
+            "User-Agent": "NewClinicaV2/2.2",
+        }
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        params: dict[str, Any] | None = None,
+        json_body: dict[str, Any] | None = None,
+        kind: str | None = None,
+        idempotent: bool | None = None,
+    ) -> dict[str, Any]:
+        method = method.upper()
+        if not self.api_key:
+            raise AsaasError("ASAAS_API_KEY não configurada", status=0)
+        if kind is None:
+            kind = "read" if method == "GET" else "write"
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+
+        url = self.base_url + "/" + path.lstrip("/")
+        key = endpoint_key(method, path)
+        session = _get_session()
+        attempt = 0
+        while True:
+            breaker.before_call()
+            # Qualquer exceção no meio do caminho conta como falha e libera a chamada de
+            # teste do half_open; senão o circuito ficaria preso recusando tudo
+            healthy = False
+            try:
+                t0 = time.perf_counter()
+                status: int | None = None
+                retry_after = None
+                try:
+                    r = session.request(method, url, headers=self.headers, params=params, json=json_body, timeout=TIMEOUTS[kind])
+                    status = r.status_code
+                    retry_after = r.headers.get("Retry-After")
+                    err = None
+                except requests.ConnectionError as e:
+                    # Inclui ConnectTimeout: a requisição não chegou ao Asaas
+                    r, err = None, AsaasError(f"Asaas indisponível: {e.__class__.__name__}")
+                    sent = not isinstance(e, requests.ConnectTimeout)
+                except requests.Timeout as e:
+                    r, err = None, AsaasError(f"Asaas não respondeu a tempo ({e.__class__.__name__})")
+                    sent = True
+                elapsed_ms = (time.perf_counter() - t0) * 1000
+
+                if r is not None:
+                    sent = True
+                    if status >= 400:
+                        try:
+                            data = r.json()
+                            msg = data.get("errors") or data.get("error") or data
+                        except Exception:
+                            msg = r.text[:300]
+                        err = AsaasError(f"Asaas {status}: {msg}", status=status)
+
+                # 429 é sempre seguro repetir (o Asaas recusou sem processar); 5xx/timeout só se idempotente
+                can_retry = (
+                    err is not None
+                    and err.retryable
+                    and attempt < self.max_retries
+                    and (idempotent or status == 429 or not sent)
+                )
+                _record(key, elapsed_ms, error=err is not None, retried=can_retry, status=status)
+                # 4xx "normais" (validação, não encontrado) não dizem nada sobre a saúde do Asaas
+                healthy = err is None or not err.retryable
+            finally:
+                breaker.record(healthy)
+
+            if err is None:
+                try:
+                    return r.json()
+                except Exception:
+                    return {"raw": r.text}
+            if not can_retry:
+                raise err
+            time.sleep(_backoff(attempt, retry_after if status == 429 else None))
+            attempt += 1
+
+
+_client: AsaasClient | None = None
+_client_lock = threading.Lock()
+
+
+def asaas_base_url() -> str:
+    override = (current_app.config.get("ASAAS_BASE_URL") or "").strip()
+    if override:
+        return override
+    env = (current_app.config.get("ASAAS_ENV") or "sandbox").strip().lower()
+    return ASAAS_PRODUCTION_URL if env == "production" else ASAAS_SANDBOX_URL
+
+
+def asaas_client() -> AsaasClient:
+    """Cliente do processo (recriado só se a URL ou a chave mudarem)."""
+    global _client
+    base_url = asaas_base_url()
+    key = (current_app.config.get("ASAAS_API_KEY") or "").strip()
+    c = _client
+    if c is None or c.base_url != base_url.rstrip("/") or c.api_key != key:
+        with _client_lock:
+            c = _client = AsaasClient(base_url, key)
+    return c
+
+
+class RateLimiter:
+    """Token bucket simples compartilhado entre as threads de um lote."""
+
+    def __init__(self, rate_per_sec: float, burst: int | None = None):
+        self.rate = max(0.1, float(rate_per_sec))
+        self.capacity = float(burst or max(1, int(self.rate)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def batch_limits() -> tuple[int, float]:
+    """(concorrência, chamadas/s) para lotes, configuráveis por ASAAS_MAX_CONCURRENCY / ASAAS_RATE_PER_SEC."""
+    cfg = current_app.config
+    try:
+        conc = int(cfg.get("ASAAS_MAX_CONCURRENCY") or DEFAULT_MAX_CONCURRENCY)
+    except (TypeError, ValueError):
+        conc = DEFAULT_MAX_CONCURRENCY
+    try:
+        rate = float(cfg.get("ASAAS_RATE_PER_SEC") or DEFAULT_RATE_PER_SEC)
+    except (TypeError, ValueError):
+        rate = DEFAULT_RATE_PER_SEC
+    return max(1, min(conc, POOL_MAXSIZE)), max(0.1, rate)
+
+
+def map_concurrent(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    *,
+    max_workers: int,
+    limiter: RateLimiter | None = None,
+) -> list[tuple[T, R | None, Exception | None]]:
+    """Roda fn(item) em até max_workers threads, respeitando o limiter antes de cada item.
+
+    Não para no primeiro erro: devolve (item, resultado, erro) de todos, na ordem de entrada.
+    fn não deve usar o banco (as threads não têm conexão própria).
+    """
+    items = list(items)
+
+    def call(item: T) -> tuple[T, R | None, Exception | None]:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return item, fn(item), None
+        except Exception as e:
+            return item, None, e
+
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))), thread_name_prefix="asaas") as ex:
+        return list(ex.map(call, items))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Clientes do Asaas: cria (ou reaproveita pelo CPF) e guarda em patients.asaas_customer_id.
+
+A emissão de boleto só precisa do customer_id; com a sincronização em lote
+(tarefa "asaas.customers") ele já está salvo antes do primeiro boleto do paciente.
+CPFs inválidos são barrados aqui, sem chamar o Asaas.
+"""
+from __future__ import annotations
+
+from typing import Any
+
+from .asaas import AsaasClient, AsaasError, AsaasUnavailable, RateLimiter, asaas_client, batch_limits, map_concurrent
+from .jobs import RetryLater, enqueue, job_handler
+from .patient_cache import forget_patient
+from .utils import digits_only, validate_cpf_cnpj
+
+CUSTOMER_BATCH = 50     # pacientes por commit
+
+
+def _get(row, key: str) -> Any:
+    return row.get(key) if isinstance(row, dict) else (row[key] if key in row.keys() else None)
+
+
+def cpf_problem(patient_row) -> str | None:
+    """Motivo para não criar o cliente no Asaas (None = CPF ok)."""
+    cpf = digits_only(_get(patient_row, "cpf"))
+    if not cpf:
+        return "CPF do paciente é obrigatório para emitir boleto (cadastre no paciente)."
+    if not validate_cpf_cnpj(cpf):
+        return "CPF/CNPJ do paciente é inválido. Confira os dígitos."
+    return None
+
+
+def create_or_link_customer(client: AsaasClient, patient_row) -> str:
+    """Procura o cliente pelo CPF no Asaas e só cria se não existir (só rede, sem banco)."""
+    problem = cpf_problem(patient_row)
+    if problem:
+        raise RuntimeError(problem)
+    cpf = digits_only(_get(patient_row, "cpf"))
+
+    found = client.request("GET", "/customers", params={"cpfCnpj": cpf, "limit": 1})
+    for c in found.get("data") or []:
+        if c.get("id") and not c.get("deleted"):
+            return str(c["id"])
+
+    payload: dict[str, Any] = {"name": _get(patient_row, "name"), "cpfCnpj": cpf}
+    phone = digits_only(_get(patient_row, "phone"))
+    if phone:
+        # asaas normalmente espera DDD+numero (sem +). Se não tiver 55, colocamos.
+        if not phone.startswith("55") and len(phone) <= 11:
+            phone = "55" + phone
+        payload["mobilePhone"] = phone
+
+    customer = client.request("POST", "/customers", json_body=payload)
+    customer_id = str(customer.get("id") or "")
+    if not customer_id:
+        raise RuntimeError("Asaas não retornou o ID do cliente.")
+    return customer_id
+
+
+def customer_counts(db) -> dict[str, Any]:
+    """Resumo para a tela do Asaas: vinculados, prontos para sincronizar e CPFs com problema."""
+    linked = db.execute("SELECT COUNT(*) FROM patients WHERE COALESCE(asaas_customer_id, '') <> ''").fetchone()[0]
+    pending, invalid = 0, []
+    for r in db.execute("SELECT id, name, cpf FROM patients WHERE COALESCE(asaas_customer_id, '') = '' ORDER BY name"):
+        if cpf_problem(r):
+            invalid.append(r)
+        else:
+            pending += 1
+    return {"linked": linked, "pending": pending, "invalid": invalid}
+
+
+def sync_customers(db, patient_ids: list[int] | None = None) -> dict[str, int]:
+    """Vincula ao Asaas os pacientes com CPF válido e sem customer_id.
+
+    As chamadas rodam em paralelo (map_concurrent); cada lote de CUSTOMER_BATCH
+    pacientes é gravado com um executemany + commit. Levanta AsaasUnavailable /
+    RetryLater se sobrar alguém por falha temporária (a tarefa continua depois).
+    """
+    sql = "SELECT id, name, cpf, phone FROM patients WHERE COALESCE(asaas_customer_id, '') = ''"
+    args: list[Any] = []
+    if patient_ids is not None:
+        if not patient_ids:
+            return {"linked": 0, "invalid": 0, "errors": 0}
+        sql += f" AND id IN ({','.join('?' * len(patient_ids))})"
+        args = list(patient_ids)
+    rows = db.execute(sql + " ORDER BY id", args).fetchall()
+    valid = [dict(r) for r in rows if not cpf_problem(r)]
+    result = {"linked": 0, "invalid": len(rows) - len(valid), "errors": 0}
+
+    client = asaas_client()
+    max_workers, rate = batch_limits()
+    limiter = RateLimiter(rate)
+    retry_later = False
+    unavailable: AsaasUnavailable | None = None
+    for i in range(0, len(valid), CUSTOMER_BATCH):
+        done = []
+        for p, customer_id, err in map_concurrent(
+            lambda p: create_or_link_customer(client, p), valid[i:i + CUSTOMER_BATCH], max_workers=max_workers, limiter=limiter
+        ):
+            if err is None:
+                done.append((customer_id, p["id"]))
+            elif isinstance(err, AsaasError) and err.retryable:
+                retry_later = True
+                unavailable = err if isinstance(err, AsaasUnavailable) else unavailable
+            else:
+                result["errors"] += 1
+        # não sobrescreve quem foi vinculado por outro caminho nesse meio tempo
+        cur = db.executemany(
+            "UPDATE patients SET asaas_customer_id=? WHERE id=? AND COALESCE(asaas_customer_id, '') = ''", done
+        )
+        db.commit()
+        for _, patient_id in done:
+            forget_patient(patient_id)
+        result["linked"] += cur.rowcount
+        if unavailable is not None:
+            break  # circuito aberto: nem tenta os próximos lotes
+
+    if unavailable is not None:
+        raise unavailable
+    if retry_later:
+        raise RetryLater("parte dos clientes ficou para a próxima tentativa (Asaas instável)")
+    return result
+
+
+def enqueue_customer_sync(db, patient_ids: list[int] | None = None) -> int:
+    """Agenda a sincronização (sem commit). patient_ids=None = todos os pendentes."""
+    return enqueue(db, "asaas.customers", {"patient_ids": patient_ids})
+
+
+@job_handler("asaas.customers")
+def _sync_customers_job(db, payload: dict[str, Any]) -> None:
+    ids = payload.get("patient_ids")
+    sync_customers(db, [int(x) for x in ids] if ids is not None else None)
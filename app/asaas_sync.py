@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""Reconciliação com o Asaas (pega webhooks perdidos, ex.: VPS fora do ar).
+
+Cada "stream" pagina o /payments do Asaas a partir de um cursor de data salvo em
+asaas_sync_state (junto com o offset da página), então a sincronização pode
+parar no meio e continuar depois. Cada página é comparada com os boletos locais
+em lote (tabela temporária + UPDATE ... FROM) e só o que mudou é gravado.
+
+refresh_open_boletos() faz o caminho inverso: consulta no Asaas, em paralelo,
+cada boleto local ainda em aberto (de um paciente ou da clínica toda). Roda na
+fila de tarefas ("boletos.refresh"), nunca na thread da requisição.
+"""
+from __future__ import annotations
+
+import json
+import time
+from datetime import date, timedelta
+from typing import Any
+
+from flask import Blueprint, current_app, flash, redirect, render_template, url_for
+
+from .asaas import RateLimiter, asaas_client, batch_limits, breaker, map_concurrent, metrics_snapshot
+from .asaas_customers import customer_counts, enqueue_customer_sync
+from .auth import login_required
+from .db import get_db
+from .jobs import enqueue, job_handler, notify, periodic
+
+bp = Blueprint("asaas_sync", __name__, url_prefix="/asaas")
+
+PAGE_SIZE = 100             # máximo do Asaas
+SYNC_EVERY_MINUTES = 30
+FIRST_SYNC_DAYS = 30        # sem cursor salvo: olha os últimos 30 dias
+CURSOR_OVERLAP_DAYS = 1     # recomeça um dia antes (pagamentos confirmados com atraso)
+REFRESH_MAX = 200           # boletos por rodada (um commit); a tarefa emenda rodadas até acabar
+OPEN_STATUSES = ("pending", "overdue")
+
+# status do Asaas -> status local do boleto
+ASAAS_STATUS = {
+    "PENDING": "pending",
+    "AWAITING_RISK_ANALYSIS": "pending",
+    "RECEIVED": "paid",
+    "CONFIRMED": "paid",
+    "RECEIVED_IN_CASH": "paid",
+    "OVERDUE": "overdue",
+    "REFUNDED": "cancelled",
+}
+
+# stream -> (rótulo, filtros do /payments; {cursor} vira a data do cursor)
+STREAMS: dict[str, tuple[str, dict[str, str]]] = {
+    "paid": ("Pagos", {"paymentDate[ge]": "{cursor}"}),
+    "overdue": ("Vencidos", {"status": "OVERDUE", "dueDate[ge]": "{cursor}"}),
+}
+
+
+def _state(db, stream: str) -> dict[str, Any]:
+    row = db.execute("SELECT * FROM asaas_sync_state WHERE stream=?", (stream,)).fetchone()
+    if row:
+        return dict(row)
+    return {
+        "stream": stream,
+        "cursor_date": (date.today() - timedelta(days=FIRST_SYNC_DAYS)).isoformat(),
+        "page_offset": 0,
+        "run_started": None,
+    }
+
+
+def _save_state(db, st: dict[str, Any], **changes: Any) -> None:
+    st.update(changes)
+    db.execute(
+        "INSERT INTO asaas_sync_state(stream, cursor_date, page_offset, run_started, last_run_at, last_changed) "
+        "VALUES(:stream, :cursor_date, :page_offset, :run_started, :last_run_at, :last_changed) "
+        "ON CONFLICT(stream) DO UPDATE SET cursor_date=excluded.cursor_date, page_offset=excluded.page_offset, "
+        "run_started=excluded.run_started, last_run_at=excluded.last_run_at, last_changed=excluded.last_changed",
+        {"last_run_at": None, "last_changed": 0} | st,
+    )
+
+
+def apply_payments(db, payments: list[dict[str, Any]]) -> int:
+    """Compara uma página de cobranças do Asaas com os boletos locais e aplica as diferenças.
+
+    Não faz commit. Retorna quantos boletos mudaram.
+    """
+    rows = []
+    for p in payments:
+        status = "cancelled" if p.get("deleted") else ASAAS_STATUS.get(str(p.get("status") or ""))
+        if not p.get("id") or not status:
+            continue
+        paid = p.get("paymentDate") or p.get("confirmedDate") or p.get("clientPaymentDate") or ""
+        rows.append((str(p["id"]), status, str(paid)[:10] or None, p.get("bankSlipUrl") or "", p.get("invoiceUrl") or ""))
+    if not rows:
+        return 0
+
+    db.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS sync_payments("
+        "payment_id TEXT PRIMARY KEY, status TEXT, paid_date TEXT, bank_slip_url TEXT, invoice_url TEXT)"
+    )
+    db.execute("DELETE FROM temp.sync_payments")
+    db.executemany("INSERT OR REPLACE INTO temp.sync_payments VALUES(?,?,?,?,?)", rows)
+
+    # financeiro primeiro (precisa saber quem ainda não estava pago)
+    db.execute(
+        "UPDATE transactions SET status='paid', date=COALESCE(s.paid_date, date('now')), due_date=NULL, payment_method='boleto' "
+        "FROM boletos b JOIN temp.sync_payments s ON s.payment_id = b.asaas_payment_id "
+        "WHERE transactions.id = b.finance_tx_id AND s.status='paid' AND transactions.status <> 'paid'"
+    )
+    cur = db.execute(
+        "UPDATE boletos SET status=s.status, "
+        "  bank_slip_url=COALESCE(NULLIF(s.bank_slip_url, ''), boletos.bank_slip_url), "
+        "  invoice_url=COALESCE(NULLIF(s.invoice_url, ''), boletos.invoice_url), "
+        "  updated_at=datetime('now') "
+        "FROM temp.sync_payments s "
+        "WHERE boletos.asaas_payment_id = s.payment_id AND boletos.status <> s.status"
+    )
+    return max(0, cur.rowcount)
+
+
+def sync_stream(db, stream: str, *, limiter: RateLimiter | None = None, max_pages: int | None = None) -> int:
+    """Continua a sincronização do stream de onde parou. Retorna quantos boletos mudaram.
+
+    A chamada de rede acontece fora de transação; cada página é aplicada e o
+    cursor/offset salvo no mesmo commit.
+    """
+    _, filters = STREAMS[stream]
+    client = asaas_client()
+    st = _state(db, stream)
+    if not st.get("run_started"):
+        _save_state(db, st, run_started=date.today().isoformat(), page_offset=0)
+        db.commit()
+
+    changed = 0
+    pages = 0
+    while max_pages is None or pages < max_pages:
+        if limiter is not None:
+            limiter.acquire()
+        params: dict[str, Any] = {k: v.format(cursor=st["cursor_date"]) for k, v in filters.items()}
+        params |= {"offset": int(st["page_offset"] or 0), "limit": PAGE_SIZE}
+        page = client.request("GET", "/payments", params=params)
+        data = page.get("data") or []
+        changed += apply_payments(db, data)
+        pages += 1
+        if page.get("hasMore") and data:
+            _save_state(db, st, page_offset=int(st["page_offset"] or 0) + len(data))
+            db.commit()
+            continue
+        # fim: próximo ciclo começa perto da data em que esta rodada começou
+        next_cursor = (date.fromisoformat(st["run_started"]) - timedelta(days=CURSOR_OVERLAP_DAYS)).isoformat()
+        _save_state(
+            db, st,
+            cursor_date=max(next_cursor, st["cursor_date"]),
+            page_offset=0,
+            run_started=None,
+            last_run_at=db.execute("SELECT datetime('now')").fetchone()[0],
+            last_changed=changed,
+        )
+        db.commit()
+        break
+    return changed
+
+
+def refresh_open_boletos(db, patient_id: int | None = None, *, limit: int = REFRESH_MAX) -> dict[str, Any]:
+    """Atualiza pelo Asaas os boletos em aberto (pendentes/vencidos), os mais antigos primeiro.
+
+    As consultas rodam em paralelo (sem banco); as mudanças entram num único commit.
+    Retorna {"checked", "changed", "errors", "remaining", "seconds"}.
+    """
+    t0 = time.perf_counter()
+    where = f"status IN ({','.join('?' * len(OPEN_STATUSES))}) AND asaas_payment_id IS NOT NULL"
+    args: list[Any] = list(OPEN_STATUSES)
+    if patient_id is not None:
+        where += " AND patient_id=?"
+        args.append(patient_id)
+    total = db.execute(f"SELECT COUNT(*) FROM boletos WHERE {where}", args).fetchone()[0]
+    pay_ids = [
+        r[0] for r in db.execute(
+            f"SELECT asaas_payment_id FROM boletos WHERE {where} ORDER BY updated_at, id LIMIT ?", (*args, limit)
+        )
+    ]
+    client = asaas_client()
+    max_workers, rate = batch_limits()
+    results = map_concurrent(
+        lambda pay_id: client.request("GET", f"/payments/{pay_id}"),
+        pay_ids,
+        max_workers=max_workers,
+        limiter=RateLimiter(rate),
+    )
+    payments = [res for _, res, err in results if err is None and res]
+    errors = sum(1 for _, _, err in results if err is not None)
+    # quem foi consultado e não mudou também "anda" na fila (updated_at), para o próximo clique pegar outros
+    checked = [pay_id for pay_id, _, err in results if err is None]
+    changed = apply_payments(db, payments)
+    db.executemany("UPDATE boletos SET updated_at=datetime('now') WHERE asaas_payment_id=?", [(x,) for x in checked])
+    db.commit()
+    return {
+        "checked": len(pay_ids),
+        "changed": changed,
+        "errors": errors,
+        "remaining": max(0, total - len(pay_ids)),
+        "seconds": round(time.perf_counter() - t0, 1),
+    }
+
+
+def refresh_message(res: dict[str, Any]) -> tuple[str, str]:
+    """Texto (e cor) do resumo de refresh_open_boletos() / da tarefa "boletos.refresh"."""
+    if not res["checked"]:
+        return "Nenhum boleto em aberto para atualizar.", "info"
+    msg = f"{res['checked']} boleto(s) consultado(s) em {res['seconds']:.1f} s — {res['changed']} mudaram de status."
+    if res["errors"]:
+        msg += f" {res['errors']} não responderam (tente de novo)."
+    if res["remaining"]:
+        msg += f" Restam {res['remaining']}: clique de novo para continuar."
+    return msg, ("warning" if res["errors"] else "success")
+
+
+@job_handler("boletos.refresh")
+def _refresh_job(db, payload: dict[str, Any]) -> dict[str, Any]:
+    """Rodadas de REFRESH_MAX até não sobrar boleto em aberto (ou o Asaas falhar)."""
+    patient_id = payload.get("patient_id")
+    total: dict[str, Any] = {"checked": 0, "changed": 0, "errors": 0, "remaining": 0, "seconds": 0.0}
+    while True:
+        res = refresh_open_boletos(db, patient_id)
+        for k in ("checked", "changed", "errors"):
+            total[k] += res[k]
+        total["remaining"] = res["remaining"]
+        total["seconds"] = round(total["seconds"] + res["seconds"], 1)
+        # quem deu erro não "anda" na fila: parar evita consultar os mesmos de novo
+        if not res["remaining"] or not res["checked"] or res["errors"]:
+            return total
+
+
+def enqueue_refresh(db, patient_id: int | None = None) -> bool:
+    """Agenda a atualização dos boletos em aberto (do paciente ou da clínica), se não houver outra. Faz commit."""
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    busy = db.execute(
+        "SELECT 1 FROM jobs WHERE kind='boletos.refresh' AND status IN ('queued','running') "
+        "AND json_extract(payload, '$.patient_id') IS ? LIMIT 1",
+        (patient_id,),
+    ).fetchone()
+    if not busy:
+        enqueue(db, "boletos.refresh", {"patient_id": patient_id}, max_attempts=3)
+    db.commit()
+    return not busy
+
+
+def last_refresh(db, patient_id: int | None = None) -> dict[str, Any] | None:
+    """Última atualização agendada (status + resumo, quando terminou) para mostrar na tela."""
+    row = db.execute(
+        "SELECT status, last_error, result, updated_at FROM jobs "
+        "WHERE kind='boletos.refresh' AND json_extract(payload, '$.patient_id') IS ? ORDER BY id DESC LIMIT 1",
+        (patient_id,),
+    ).fetchone()
+    if not row:
+        return None
+    out = dict(row)
+    out["message"] = refresh_message(json.loads(row["result"]))[0] if row["result"] else None
+    return out
+
+
+@job_handler("asaas.reconcile")
+def _reconcile(db, payload: dict[str, Any]) -> None:
+    _, rate = batch_limits()
+    limiter = RateLimiter(rate)
+    for stream in STREAMS:
+        sync_stream(db, stream, limiter=limiter)
+
+
+def enqueue_reconcile(db) -> bool:
+    """Agenda uma reconciliação, se não houver outra na fila. Faz commit."""
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    busy = db.execute(
+        "SELECT 1 FROM jobs WHERE kind='asaas.reconcile' AND status IN ('queued','running') LIMIT 1"
+    ).fetchone()
+    if not busy:
+        enqueue(db, "asaas.reconcile", {}, max_attempts=5)
+    db.commit()
+    return not busy
+
+
+@periodic
+def schedule_reconcile(db) -> None:
+    """A cada SYNC_EVERY_MINUTES, agenda a reconciliação (só com Asaas configurado e disponível)."""
+    if not (current_app.config.get("ASAAS_API_KEY") or "").strip() or not breaker.is_available():
+        return
+    window = f"-{SYNC_EVERY_MINUTES} minutes"
+    recent = db.execute(
+        "SELECT 1 FROM asaas_sync_state WHERE last_run_at >= datetime('now', ?) "
+        "UNION ALL "
+        "SELECT 1 FROM jobs WHERE kind='asaas.reconcile' AND (status IN ('queued','running') OR updated_at >= datetime('now', ?)) "
+        "LIMIT 1",
+        (window, window),
+    ).fetchone()
+    if not recent:
+        enqueue_reconcile(db)
+
+
+@bp.get("/")
+@login_required
+def status():
+    db = get_db()
+    states = []
+    for stream, (label, _) in STREAMS.items():
+        states.append(_state(db, stream) | {"label": label})
+    open_count = db.execute(
+        f"SELECT COUNT(*) FROM boletos WHERE status IN ({','.join('?' * len(OPEN_STATUSES))}) AND asaas_payment_id IS NOT NULL",
+        OPEN_STATUSES,
+    ).fetchone()[0]
+    last_job = db.execute(
+        "SELECT status, attempts, last_error, updated_at FROM jobs WHERE kind='asaas.reconcile' ORDER BY id DESC LIMIT 1"
+    ).fetchone()
+    return render_template(
+        "asaas_status.html",
+        states=states,
+        last_job=last_job,
+        open_count=open_count,
+        customers=customer_counts(db),
+        customers_job=db.execute(
+            "SELECT status, last_error, updated_at FROM jobs WHERE kind='asaas.customers' ORDER BY id DESC LIMIT 1"
+        ).fetchone(),
+        refresh_job=last_refresh(db),
+        metrics=metrics_snapshot(),
+        circuit=breaker.snapshot(),
+        sync_every=SYNC_EVERY_MINUTES,
+    )
+
+
+@bp.post("/refresh")
+@login_required
+def refresh_all():
+    """Agenda a consulta no Asaas de todos os boletos em aberto da clínica (fila de tarefas)."""
+    if not breaker.is_available():
+        flash("Asaas indisponível no momento. Tente daqui a pouco.", "warning")
+    elif enqueue_refresh(get_db()):
+        notify()
+        flash("Atualização dos boletos em aberto agendada ⏳", "success")
+    else:
+        flash("Já existe uma atualização em andamento.", "info")
+    return redirect(url_for("asaas_sync.status"))
+
+
+@bp.post("/customers")
+@login_required
+def sync_customers_now():
+    """Vincula ao Asaas, em segundo plano, todos os pacientes com CPF válido ainda sem cliente."""
+    db = get_db()
+    busy = db.execute(
+        "SELECT 1 FROM jobs WHERE kind='asaas.customers' AND status IN ('queued','running') "
+        "AND json_extract(payload, '$.patient_ids') IS NULL LIMIT 1"
+    ).fetchone()
+    if busy:
+        flash("Já existe uma sincronização de clientes em andamento.", "info")
+    else:
+        enqueue_customer_sync(db)
+        db.commit()
+        notify()
+        flash("Sincronização de clientes agendada ⏳", "success")
+    return redirect(url_for("asaas_sync.status"))
+
+
+@bp.post("/reconcile")
+@login_required
+def reconcile_now():
+    db = get_db()
+    if enqueue_reconcile(db):
+        notify()
+        flash("Sincronização com o Asaas agendada ⏳", "success")
+    else:
+        flash("Já existe uma sincronização em andamento.", "info")
+    return redirect(url_for("asaas_sync.status"))
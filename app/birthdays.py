@@ -7,6 +7,7 @@ from urllib.parse import quote
 from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify
 from .auth import login_required
 from .db import get_db
+from .lookups import get_setting
 
 bp = Blueprint("birthdays", __name__, url_prefix="/birthdays")
 
@@ -22,8 +23,7 @@ def _safe_birthday_in_year(bd: date, year: int) -> date:
         raise
 
 def _get_setting(db, key: str, default: str = "") -> str:
-    row = db.execute("SELECT value FROM app_settings WHERE key=?", (key,)).fetchone()
-    return (row["value"] if row and row["value"] is not None else default)
+    return get_setting(db, key, default)
 
 def _render_message(template: str, nome: str, clinica: str) -> str:
     return (template or "").replace("{nome}", nome).replace("{clinica}", clinica)
@@ -1,41 +1,39 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import json
+from calendar import monthrange
 from datetime import date
 from decimal import Decimal
 from typing import Any
 from urllib.parse import quote
 
-import requests
 from flask import Blueprint, current_app, flash, redirect, render_template, request, url_for, jsonify
 
+from .asaas import (
+    AsaasClient,
+    AsaasError,
+    AsaasUnavailable,
+    RateLimiter,
+    asaas_client,
+    batch_limits,
+    breaker,
+    map_concurrent,
+    metrics_snapshot,
+)
+from .asaas_customers import cpf_problem, create_or_link_customer, enqueue_customer_sync
+from .asaas_sync import enqueue_refresh
 from .auth import login_required
 from .db import get_db
-from .utils import parse_brl_to_cents, cents_to_brl, today_yyyy_mm_dd, validate_cpf_cnpj
+from .jobs import RetryLater, enqueue, job_handler, notify, periodic
+from .lookups import active_categories, active_providers, category_id, provider_repasse
+from .patient_cache import forget_patient, patient_header
+from .utils import parse_brl_to_cents, cents_to_brl, today_yyyy_mm_dd
 
 
 bp = Blueprint("boletos", __name__)
 
 
-def _asaas_base_url() -> str:
-    env = (current_app.config.get("ASAAS_ENV") or "sandbox").strip().lower()
-    # produção: https://api.asaas.com/v3 | sandbox: https://api-sandbox.asaas.com/v3
-    return "https://api.asaas.com/v3" if env == "production" else "https://api-sandbox.asaas.com/v3"
-
-
-def _asaas_headers() -> dict[str, str]:
-    key = (current_app.config.get("ASAAS_API_KEY") or "").strip()
-    return {
-        "access_token": key,
-        "Content-Type": "application/json",
-        "User-Agent": "NewClinicaV2/2.2",
-    }
-
-
-def _digits(s: str | None) -> str:
-    return "".join(ch for ch in (s or "") if ch.isdigit())
-
-
 def _row_get(row, key: str, default: Any = "") -> Any:
     """Compatível com sqlite3.Row e dict."""
     try:
@@ -50,79 +48,162 @@ def _row_get(row, key: str, default: Any = "") -> Any:
 
 
 def _asaas_request(method: str, path: str, *, params: dict[str, Any] | None = None, json_body: dict[str, Any] | None = None) -> dict[str, Any]:
-    key = (current_app.config.get("ASAAS_API_KEY") or "").strip()
-    if not key:
-        raise RuntimeError("ASAAS_API_KEY não configurada")
-    url = _asaas_base_url().rstrip("/") + "/" + path.lstrip("/")
-    r = requests.request(method.upper(), url, headers=_asaas_headers(), params=params, json=json_body, timeout=25)
-    try:
-        data = r.json()
-    except Exception:
-        data = {"raw": r.text}
-    if r.status_code >= 400:
-        # mensagem amigável
-        msg = data.get("errors") or data.get("error") or data
-        raise RuntimeError(f"Asaas {r.status_code}: {msg}")
-    return data
+    # Sessão compartilhada (keep-alive), timeouts por tipo de chamada e retry com backoff: ver app/asaas.py
+    return asaas_client().request(method, path, params=params, json_body=json_body)
+
+
+def _create_asaas_customer(client: AsaasClient, patient_row) -> str:
+    """Cria (ou reaproveita pelo CPF) o cliente no Asaas (só rede, sem banco: pode rodar em outra thread)."""
+    return create_or_link_customer(client, patient_row)
 
 
 def _ensure_asaas_customer(db, patient_row) -> str:
     """Cria (se necessário) e retorna o customer_id no Asaas."""
     if _row_get(patient_row, "asaas_customer_id"):
         return str(_row_get(patient_row, "asaas_customer_id"))
+    customer_id = _create_asaas_customer(asaas_client(), patient_row)
+    db.execute("UPDATE patients SET asaas_customer_id=? WHERE id=?", (customer_id, int(_row_get(patient_row, "id"))))
+    forget_patient(int(_row_get(patient_row, "id")))
+    return customer_id
+
 
-    cpf = _digits(_row_get(patient_row, "cpf"))
-    if not cpf:
-        raise RuntimeError("CPF do paciente é obrigatório para emitir boleto (cadastre no paciente).")
-    if not validate_cpf_cnpj(cpf):
-        raise RuntimeError("CPF/CNPJ do paciente é inválido. Confira os dígitos.")
+def _create_asaas_payment(client: AsaasClient, b, customer_id: str) -> dict[str, Any]:
+    """Cria a cobrança de um boleto local (só rede). Retorna os campos para gravar.
+
+    Se o boleto já estava 'processing' (tentativa anterior caiu no meio), procura
+    antes pelo externalReference para não duplicar a cobrança.
+    """
+    ext_ref = f"boleto:{b['id']}"
+    payment: dict[str, Any] = {}
+    if b["status"] == "processing":
+        found = client.request("GET", "/payments", params={"externalReference": ext_ref, "limit": 1})
+        payment = (found.get("data") or [{}])[0]
+    if not payment.get("id"):
+        value = float((Decimal(b["value_cents"]) / Decimal(100)).quantize(Decimal("0.01")))
+        payment = client.request(
+            "POST",
+            "/payments",
+            json_body={
+                "customer": customer_id,
+                "billingType": "BOLETO",
+                "value": value,
+                "dueDate": b["due_date"],
+                "description": b["description"] or "Boleto",
+                "externalReference": ext_ref,
+            },
+        )
+    pay_id = str(payment.get("id") or "") or None
 
-    payload: dict[str, Any] = {
-        "name": _row_get(patient_row, "name"),
-        "cpfCnpj": cpf,
+    identification_field = ""
+    if pay_id:
+        try:
+            ident = client.request("GET", f"/payments/{pay_id}/identificationField")
+            identification_field = (ident.get("identificationField") or ident.get("value") or "")
+        except Exception:
+            identification_field = ""
+    return {
+        "asaas_payment_id": pay_id,
+        "bank_slip_url": payment.get("bankSlipUrl") or "",
+        "invoice_url": payment.get("invoiceUrl") or "",
+        "identification_field": identification_field,
     }
-    phone = _digits(_row_get(patient_row, "phone"))
-    if phone:
-        # asaas normalmente espera DDD+numero (sem +). Se não tiver 55, colocamos.
-        if not phone.startswith("55") and len(phone) <= 11:
-            phone = "55" + phone
-        payload["mobilePhone"] = phone
-
-    customer = _asaas_request("POST", "/customers", json_body=payload)
-    customer_id = str(customer.get("id") or "")
-    if not customer_id:
-        raise RuntimeError("Asaas não retornou o ID do cliente.")
 
-    db.execute("UPDATE patients SET asaas_customer_id=? WHERE id=?", (customer_id, int(_row_get(patient_row, "id"))))
-    return customer_id
+
+_SAVE_ISSUED_SQL = (
+    "UPDATE boletos SET status='pending', asaas_payment_id=:asaas_payment_id, bank_slip_url=:bank_slip_url, "
+    "invoice_url=:invoice_url, identification_field=:identification_field, last_error=NULL, updated_at=datetime('now') "
+    "WHERE id=:id"
+)
 
 
 def _get_or_create_category_id(db, name: str = "Procedimentos") -> int | None:
-    if not name:
-        return None
+    # cache por versão: só faz INSERT se a categoria ainda não existir
     try:
-        db.execute("INSERT OR IGNORE INTO categories(name, kind, active) VALUES(?, 'income', 1)", (name,))
-        row = db.execute("SELECT id FROM categories WHERE name=? LIMIT 1", (name,)).fetchone()
-        return int(row["id"]) if row else None
+        return category_id(db, name)
     except Exception:
         return None
 
 
 def _provider_default_repasse(db, provider_id: int | None) -> int:
-    if not provider_id:
-        return 0
-    r = db.execute("SELECT default_repasse_percent FROM providers WHERE id=?", (provider_id,)).fetchone()
-    try:
-        return max(0, min(100, int(r["default_repasse_percent"] or 0))) if r else 0
-    except Exception:
-        return 0
+    return provider_repasse(db, provider_id)
+
+
+BOLETO_PENDING_STATES = ("queued", "processing")
+
+BOLETO_STATUS_LABELS = {
+    "queued": "Na fila",
+    "processing": "Emitindo…",
+    "failed": "Falhou",
+    "pending": "A receber",
+    "paid": "Pago",
+    "overdue": "Vencido",
+    "cancelled": "Cancelado",
+}
+
+
+def _cpf_problem(patient_row) -> str | None:
+    """Validação local do CPF (antes de ir para a fila)."""
+    if _row_get(patient_row, "asaas_customer_id"):
+        return None
+    return cpf_problem(patient_row)
+
+
+def _insert_pending_tx(db, pid: int, prid: int | None, cid: int | None, due_date: str, amount_cents: int, description: str) -> int:
+    # lançamento pendente no financeiro (só vira "dim dim" quando estiver PAGO)
+    # para pendente: usamos date=due_date para ordenar bem no financeiro
+    cur = db.execute(
+        "INSERT INTO transactions(kind,status,date,due_date,amount_cents,payment_method,description,patient_id,category_id,provider_id,repasse_percent) "
+        "VALUES('income','pending',?,?,?,?,?,?,?,?,?)",
+        (due_date, due_date, amount_cents, "boleto", f"Boleto • {description}", pid, cid, prid, _provider_default_repasse(db, prid)),
+    )
+    return int(cur.lastrowid)
+
+
+def _boleto_issue_failed(db, payload: dict[str, Any], err: str) -> None:
+    """Desistiu de emitir: marca o boleto e tira o 'a receber' do financeiro."""
+    bid = int(payload["boleto_id"])
+    b = db.execute("SELECT finance_tx_id FROM boletos WHERE id=?", (bid,)).fetchone()
+    if not b:
+        return
+    if b["finance_tx_id"]:
+        db.execute("DELETE FROM transactions WHERE id=? AND status='pending'", (int(b["finance_tx_id"]),))
+    db.execute(
+        "UPDATE boletos SET status='failed', finance_tx_id=NULL, last_error=?, updated_at=datetime('now') WHERE id=?",
+        (err, bid),
+    )
+
+
+@job_handler("boleto.issue", on_fail=_boleto_issue_failed)
+def _issue_boleto(db, payload: dict[str, Any]) -> None:
+    """Emite no Asaas um boleto já gravado localmente como 'queued'.
+
+    Cada escrita local tem commit próprio antes da próxima chamada de rede.
+    """
+    bid = int(payload["boleto_id"])
+    b = db.execute("SELECT * FROM boletos WHERE id=?", (bid,)).fetchone()
+    if not b or b["status"] not in BOLETO_PENDING_STATES:
+        return  # excluído/cancelado ou já emitido
+    patient = db.execute("SELECT * FROM patients WHERE id=?", (b["patient_id"],)).fetchone()
+    if not patient:
+        return
+
+    customer_id = _ensure_asaas_customer(db, patient)
+    db.execute(
+        "UPDATE boletos SET status='processing', asaas_customer_id=?, updated_at=datetime('now') WHERE id=?",
+        (customer_id, bid),
+    )
+    db.commit()
+
+    # b ainda tem o status anterior: 'processing' aqui = tentativa anterior interrompida
+    issued = _create_asaas_payment(asaas_client(), b, customer_id)
+    db.execute(_SAVE_ISSUED_SQL, issued | {"id": bid})
 
 
 @bp.post("/patients/<int:pid>/boletos/create")
 @login_required
 def create_boleto(pid: int):
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
+    patient = patient_header(db, pid)
     if not patient:
         flash("Paciente não encontrado.", "danger")
         return redirect(url_for("patients.list_patients"))
@@ -141,69 +222,32 @@ def create_boleto(pid: int):
     if amount_cents <= 0:
         flash("Valor inválido.", "danger")
         return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
+    if not (current_app.config.get("ASAAS_API_KEY") or "").strip():
+        flash("Não foi possível emitir o boleto: ASAAS_API_KEY não configurada", "danger")
+        return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
+    problem = _cpf_problem(patient)
+    if problem:
+        flash(f"Não foi possível emitir o boleto: {problem}", "danger")
+        return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
 
+    # Só grava localmente (boleto 'queued' + tarefa); a chamada ao Asaas roda no worker
     try:
-        # garante customer no Asaas
-        customer_id = _ensure_asaas_customer(db, patient)
-
-        # cria lançamento pendente no financeiro (só vira "dim dim" quando estiver PAGO)
-        repasse_percent = _provider_default_repasse(db, prid)
-        # para pendente: usamos date=due_date para ordenar bem no financeiro
-        db.execute(
-            "INSERT INTO transactions(kind,status,date,due_date,amount_cents,payment_method,description,patient_id,category_id,provider_id,repasse_percent) "
-            "VALUES('income','pending',?,?,?,?,?,?,?,?,?)",
-            (due_date, due_date, amount_cents, "boleto", f"Boleto • {description}", pid, cid, prid, repasse_percent),
-        )
-        tx_id = int(db.execute("SELECT last_insert_rowid() AS id").fetchone()["id"])
-
-        # cria cobrança no Asaas
-        value = float((Decimal(amount_cents) / Decimal(100)).quantize(Decimal("0.01")))
-        payment = _asaas_request(
-            "POST",
-            "/payments",
-            json_body={
-                "customer": customer_id,
-                "billingType": "BOLETO",
-                "value": value,
-                "dueDate": due_date,
-                "description": description,
-                "externalReference": f"tx:{tx_id}",
-            },
-        )
-        pay_id = str(payment.get("id") or "")
-        bank_slip_url = payment.get("bankSlipUrl") or ""
-        invoice_url = payment.get("invoiceUrl") or ""
-
-        identification_field = ""
-        if pay_id:
-            try:
-                ident = _asaas_request("GET", f"/payments/{pay_id}/identificationField")
-                identification_field = (ident.get("identificationField") or ident.get("value") or "")
-            except Exception:
-                identification_field = ""
-
-        db.execute(
-            "INSERT INTO boletos(patient_id,provider_id,category_id,finance_tx_id,asaas_customer_id,asaas_payment_id,status,value_cents,due_date,description,bank_slip_url,invoice_url,identification_field) "
-            "VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            (
-                pid,
-                prid,
-                cid,
-                tx_id,
-                customer_id,
-                pay_id,
-                "pending",
-                amount_cents,
-                due_date,
-                description,
-                bank_slip_url,
-                invoice_url,
-                identification_field,
-            ),
+        tx_id = _insert_pending_tx(db, pid, prid, cid, due_date, amount_cents, description)
+        cur = db.execute(
+            "INSERT INTO boletos(patient_id,provider_id,category_id,finance_tx_id,asaas_customer_id,status,value_cents,due_date,description) "
+            "VALUES(?,?,?,?,?,'queued',?,?,?)",
+            (pid, prid, cid, tx_id, patient["asaas_customer_id"], amount_cents, due_date, description),
         )
+        if not patient["asaas_customer_id"]:
+            # cliente antes do boleto (mesma fila, ordem de id): a emissão já acha o customer_id salvo
+            enqueue_customer_sync(db, [pid])
+        enqueue(db, "boleto.issue", {"boleto_id": int(cur.lastrowid)})
         db.commit()
-
-        flash("Boleto emitido ✅", "success")
+        notify()
+        if breaker.is_available():
+            flash("Boleto na fila de emissão ⏳ (atualiza sozinho em alguns segundos)", "success")
+        else:
+            flash("Asaas indisponível no momento: o boleto ficou na fila e será emitido assim que ele voltar.", "warning")
     except Exception as e:
         try:
             db.rollback()
@@ -214,6 +258,372 @@ def create_boleto(pid: int):
     return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
 
 
+@bp.post("/patients/<int:pid>/boletos/<int:bid>/retry")
+@login_required
+def retry_boleto(pid: int, bid: int):
+    """Recoloca na fila um boleto cuja emissão falhou (recria o 'a receber')."""
+    db = get_db()
+    b = db.execute("SELECT * FROM boletos WHERE id=? AND patient_id=? AND status='failed'", (bid, pid)).fetchone()
+    if not b:
+        flash("Boleto não encontrado.", "danger")
+        return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
+    tx_id = _insert_pending_tx(db, pid, b["provider_id"], b["category_id"], b["due_date"], int(b["value_cents"]), b["description"] or "Boleto")
+    db.execute(
+        "UPDATE boletos SET status='queued', finance_tx_id=?, last_error=NULL, updated_at=datetime('now') WHERE id=?",
+        (tx_id, bid),
+    )
+    enqueue(db, "boleto.issue", {"boleto_id": bid})
+    db.commit()
+    notify()
+    flash("Boleto recolocado na fila ⏳", "success")
+    return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
+
+
+@bp.post("/patients/<int:pid>/boletos/refresh")
+@login_required
+def refresh_boletos(pid: int):
+    """Agenda a consulta no Asaas dos boletos em aberto do paciente (fila de tarefas)."""
+    if not breaker.is_available():
+        flash("Asaas indisponível no momento. Tente daqui a pouco.", "warning")
+    elif enqueue_refresh(get_db(), pid):
+        notify()
+        flash("Atualização dos boletos agendada ⏳ — recarregue a aba em instantes.", "success")
+    else:
+        flash("Já existe uma atualização em andamento para este paciente.", "info")
+    return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
+
+
+@bp.get("/patients/<int:pid>/boletos/status")
+@login_required
+def boletos_status(pid: int):
+    """Polling do painel: status atual dos boletos pedidos (?ids=1,2,3)."""
+    ids = [int(x) for x in (request.args.get("ids") or "").split(",") if x.strip().isdigit()][:100]
+    if not ids:
+        return jsonify({"boletos": {}})
+    db = get_db()
+    rows = db.execute(
+        f"SELECT id, status, last_error FROM boletos WHERE patient_id=? AND id IN ({','.join('?' * len(ids))})",
+        (pid, *ids),
+    ).fetchall()
+    return jsonify({
+        "boletos": {
+            str(r["id"]): {
+                "status": r["status"],
+                "label": BOLETO_STATUS_LABELS.get(r["status"], r["status"]),
+                "done": r["status"] not in BOLETO_PENDING_STATES,
+                "error": r["last_error"] or "",
+            }
+            for r in rows
+        }
+    })
+
+
+# ===== Carnê (vários boletos de uma vez) =====
+
+CARNE_MAX_INSTALLMENTS = 36
+
+# Lançamento pendente de uma parcela; RETURNING id liga o boleto ao lançamento certo
+_TX_BOLETO_SQL = (
+    "INSERT INTO transactions(kind,status,date,due_date,amount_cents,payment_method,description,patient_id,category_id,provider_id,repasse_percent) "
+    "VALUES('income','pending',?,?,?,'boleto',?,?,?,?,?) RETURNING id"
+)
+
+
+def _add_months(d: date, n: int) -> date:
+    """Mesmo dia n meses depois (ou o último dia do mês, se não existir)."""
+    y, m = divmod(d.month - 1 + n, 12)
+    y, m = d.year + y, m + 1
+    return date(y, m, min(d.day, monthrange(y, m)[1]))
+
+
+def _mark_batch_failures(db, failures: list[tuple[int, str]]) -> None:
+    """Boletos que não deu para emitir: status failed e sem 'a receber' no financeiro."""
+    if not failures:
+        return
+    db.executemany(
+        "DELETE FROM transactions WHERE status='pending' AND id=(SELECT finance_tx_id FROM boletos WHERE id=?)",
+        [(bid,) for bid, _ in failures],
+    )
+    db.executemany(
+        "UPDATE boletos SET status='failed', finance_tx_id=NULL, last_error=?, updated_at=datetime('now') WHERE id=?",
+        [(err[:1000], bid) for bid, err in failures],
+    )
+
+
+def _batch_issue_failed(db, payload: dict[str, Any], err: str) -> None:
+    rows = db.execute(
+        "SELECT id FROM boletos WHERE batch_id=? AND status IN ('queued','processing')",
+        (int(payload["batch_id"]),),
+    ).fetchall()
+    _mark_batch_failures(db, [(int(r["id"]), err) for r in rows])
+
+
+@job_handler("boleto.batch", on_fail=_batch_issue_failed)
+def _issue_batch(db, payload: dict[str, Any]) -> None:
+    """Emite os boletos pendentes de um carnê com concorrência e taxa limitadas.
+
+    As threads só falam com o Asaas; o banco é atualizado aqui, com executemany,
+    em uma transação para os clientes e outra para as cobranças.
+    Falhas temporárias ficam na fila (RetryLater reagenda só o que sobrou).
+    """
+    batch_id = int(payload["batch_id"])
+    rows = db.execute(
+        "SELECT b.*, p.name AS patient_name, p.cpf AS patient_cpf, p.phone AS patient_phone, "
+        "       p.asaas_customer_id AS patient_customer_id "
+        "FROM boletos b JOIN patients p ON p.id=b.patient_id "
+        "WHERE b.batch_id=? AND b.status IN ('queued','processing') ORDER BY b.id",
+        (batch_id,),
+    ).fetchall()
+    if not rows:
+        return
+
+    client = asaas_client()
+    max_workers, rate = batch_limits()
+    limiter = RateLimiter(rate)
+    failures: list[tuple[int, str]] = []
+    retry_later = False
+    unavailable: AsaasUnavailable | None = None
+
+    # 1) clientes que ainda não existem no Asaas (um por paciente)
+    customers = {int(r["patient_id"]): (r["asaas_customer_id"] or r["patient_customer_id"]) for r in rows}
+    missing = {}
+    for r in rows:
+        if not customers[int(r["patient_id"])]:
+            missing.setdefault(int(r["patient_id"]), {"id": r["patient_id"], "name": r["patient_name"], "cpf": r["patient_cpf"], "phone": r["patient_phone"]})
+    created = map_concurrent(lambda p: _create_asaas_customer(client, p), missing.values(), max_workers=max_workers, limiter=limiter)
+    new_customers = []
+    for p, customer_id, err in created:
+        if err is None:
+            customers[int(p["id"])] = customer_id
+            new_customers.append((customer_id, int(p["id"])))
+        elif isinstance(err, AsaasError) and err.retryable:
+            retry_later = True
+            unavailable = err if isinstance(err, AsaasUnavailable) else unavailable
+        else:
+            failures.extend((int(r["id"]), str(err)) for r in rows if int(r["patient_id"]) == int(p["id"]))
+    db.executemany("UPDATE patients SET asaas_customer_id=? WHERE id=?", new_customers)
+    for _, patient_id in new_customers:
+        forget_patient(patient_id)
+    db.executemany(
+        "UPDATE boletos SET status='processing', asaas_customer_id=?, updated_at=datetime('now') WHERE id=?",
+        [(customers[int(r["patient_id"])], int(r["id"])) for r in rows if customers[int(r["patient_id"])]],
+    )
+    db.commit()
+
+    # 2) cobranças (r ainda tem o status anterior para o _create_asaas_payment)
+    ready = [r for r in rows if customers[int(r["patient_id"])]]
+    issued = map_concurrent(
+        lambda r: _create_asaas_payment(client, r, customers[int(r["patient_id"])]),
+        ready,
+        max_workers=max_workers,
+        limiter=limiter,
+    )
+    saved = []
+    for r, data, err in issued:
+        if err is None:
+            saved.append(data | {"id": int(r["id"])})
+        elif isinstance(err, AsaasError) and err.retryable:
+            retry_later = True
+            unavailable = err if isinstance(err, AsaasUnavailable) else unavailable
+        else:
+            failures.append((int(r["id"]), str(err)))
+    db.executemany(_SAVE_ISSUED_SQL, saved)
+    _mark_batch_failures(db, failures)
+    db.commit()
+
+    if unavailable is not None:
+        raise unavailable  # circuito aberto: reagenda sem gastar tentativa
+    if retry_later:
+        raise RetryLater("parte do carnê ficou para a próxima tentativa (Asaas instável)")
+
+
+def _carne_form_defaults() -> dict[str, Any]:
+    return {
+        "installments": 12,
+        "first_due_date": _add_months(date.today(), 1).isoformat(),
+        "amount": "",
+        "description": "",
+    }
+
+
+@bp.route("/boletos/carne", methods=["GET", "POST"])
+@login_required
+def carne_new():
+    """Emite um carnê (N boletos mensais) para um ou vários pacientes."""
+    db = get_db()
+    ortho_only = request.values.get("ortho") == "1"
+    patients = db.execute(
+        "SELECT id, name, cpf, asaas_customer_id FROM patients "
+        + ("WHERE is_ortho=1 " if ortho_only else "")
+        + "ORDER BY name COLLATE NOCASE"
+    ).fetchall()
+    providers = active_providers(db)
+    categories = active_categories(db)
+    selected = {int(x) for x in request.values.getlist("patient_ids") if str(x).isdigit()}
+    form = _carne_form_defaults() | {k: v for k, v in request.form.items() if k in _carne_form_defaults()}
+
+    if request.method == "GET":
+        pre = request.args.get("pid", "")
+        if pre.isdigit():
+            selected.add(int(pre))
+        return render_template(
+            "boletos_carne.html",
+            patients=patients, providers=providers, categories=categories,
+            selected=selected, form=form, ortho_only=ortho_only, max_installments=CARNE_MAX_INSTALLMENTS,
+        )
+
+    def back(msg: str):
+        flash(msg, "danger")
+        return render_template(
+            "boletos_carne.html",
+            patients=patients, providers=providers, categories=categories,
+            selected=selected, form=form, ortho_only=ortho_only, max_installments=CARNE_MAX_INSTALLMENTS,
+        )
+
+    if not (current_app.config.get("ASAAS_API_KEY") or "").strip():
+        return back("ASAAS_API_KEY não configurada.")
+    if not selected:
+        return back("Selecione pelo menos um paciente.")
+    try:
+        installments = int(request.form.get("installments") or 0)
+        first_due = date.fromisoformat((request.form.get("first_due_date") or "").strip())
+    except ValueError:
+        return back("Informe a quantidade de parcelas e o primeiro vencimento.")
+    if not 1 <= installments <= CARNE_MAX_INSTALLMENTS:
+        return back(f"Parcelas: de 1 a {CARNE_MAX_INSTALLMENTS}.")
+    amount_cents = parse_brl_to_cents(request.form.get("amount") or "0")
+    if amount_cents <= 0:
+        return back("Valor da parcela inválido.")
+    description = (request.form.get("description") or "Mensalidade").strip()[:400]
+    prid = int(request.form["provider_id"]) if (request.form.get("provider_id") or "").isdigit() else None
+    cid = int(request.form["category_id"]) if (request.form.get("category_id") or "").isdigit() else None
+    if cid is None:
+        cid = _get_or_create_category_id(db, "Procedimentos")
+
+    by_id = {int(p["id"]): p for p in patients}
+    chosen = [by_id[i] for i in sorted(selected) if i in by_id]
+    problems = [f"{p['name']}: {_cpf_problem(p)}" for p in chosen if _cpf_problem(p)]
+    if problems:
+        return back("Corrija o CPF antes de emitir — " + "; ".join(problems[:5]))
+
+    repasse = _provider_default_repasse(db, prid)
+    dues = [_add_months(first_due, i).isoformat() for i in range(installments)]
+    items = [
+        (p, n, due, f"{description} • Parcela {n}/{installments}")
+        for p in chosen
+        for n, due in enumerate(dues, start=1)
+    ]
+
+    try:
+        cur = db.execute(
+            "INSERT INTO boleto_batches(description, installments, first_due_date, value_cents) VALUES(?,?,?,?)",
+            (description, installments, first_due.isoformat(), amount_cents),
+        )
+        batch_id = int(cur.lastrowid)
+        tx_ids = [
+            int(db.execute(_TX_BOLETO_SQL, (due, due, amount_cents, f"Boleto • {desc}", int(p["id"]), cid, prid, repasse)).fetchone()[0])
+            for p, _, due, desc in items
+        ]
+        db.executemany(
+            "INSERT INTO boletos(patient_id,provider_id,category_id,finance_tx_id,asaas_customer_id,status,value_cents,due_date,description,batch_id) "
+            "VALUES(?,?,?,?,?,'queued',?,?,?,?)",
+            [
+                (int(p["id"]), prid, cid, tx_id, p["asaas_customer_id"], amount_cents, due, desc, batch_id)
+                for tx_id, (p, _, due, desc) in zip(tx_ids, items)
+            ],
+        )
+        enqueue(db, "boleto.batch", {"batch_id": batch_id}, max_attempts=8)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        return back(f"Não foi possível criar o carnê: {e}")
+
+    notify()
+    flash(f"Carnê na fila: {len(items)} boleto(s) ⏳", "success")
+    return redirect(url_for("boletos.carne_view", batch_id=batch_id))
+
+
+def _batch_rows(db, batch_id: int):
+    return db.execute(
+        "SELECT b.id, b.patient_id, b.status, b.due_date, b.description, b.value_cents, b.last_error, "
+        "       b.bank_slip_url, b.invoice_url, p.name AS patient_name "
+        "FROM boletos b JOIN patients p ON p.id=b.patient_id "
+        "WHERE b.batch_id=? ORDER BY p.name COLLATE NOCASE, b.due_date, b.id",
+        (batch_id,),
+    ).fetchall()
+
+
+@bp.get("/boletos/carne/<int:batch_id>")
+@login_required
+def carne_view(batch_id: int):
+    db = get_db()
+    batch = db.execute("SELECT * FROM boleto_batches WHERE id=?", (batch_id,)).fetchone()
+    if not batch:
+        flash("Carnê não encontrado.", "danger")
+        return redirect(url_for("boletos.carne_new"))
+    rows = _batch_rows(db, batch_id)
+    counts: dict[str, int] = {}
+    for r in rows:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    return render_template(
+        "boletos_carne_view.html",
+        batch=batch,
+        rows=rows,
+        counts=counts,
+        waiting=sum(counts.get(s, 0) for s in BOLETO_PENDING_STATES),
+        status_labels=BOLETO_STATUS_LABELS,
+        cents_to_brl=cents_to_brl,
+    )
+
+
+@bp.get("/boletos/carne/<int:batch_id>/status")
+@login_required
+def carne_status(batch_id: int):
+    db = get_db()
+    rows = db.execute(
+        "SELECT status, COUNT(*) AS n FROM boletos WHERE batch_id=? GROUP BY status",
+        (batch_id,),
+    ).fetchall()
+    counts = {r["status"]: int(r["n"]) for r in rows}
+    return jsonify({"counts": counts, "waiting": sum(counts.get(s, 0) for s in BOLETO_PENDING_STATES)})
+
+
+@bp.post("/boletos/carne/<int:batch_id>/retry")
+@login_required
+def carne_retry(batch_id: int):
+    """Recoloca na fila só os boletos do carnê que falharam."""
+    db = get_db()
+    failed = db.execute(
+        "SELECT id, patient_id, provider_id, category_id, due_date, value_cents, description "
+        "FROM boletos WHERE batch_id=? AND status='failed' ORDER BY id",
+        (batch_id,),
+    ).fetchall()
+    if not failed:
+        flash("Nenhuma falha para reemitir.", "info")
+        return redirect(url_for("boletos.carne_view", batch_id=batch_id))
+
+    repasse = {}
+    for b in failed:
+        if b["provider_id"] not in repasse:
+            repasse[b["provider_id"]] = _provider_default_repasse(db, b["provider_id"])
+    tx_ids = [
+        int(db.execute(_TX_BOLETO_SQL, (
+            b["due_date"], b["due_date"], int(b["value_cents"]), f"Boleto • {b['description'] or 'Boleto'}",
+            int(b["patient_id"]), b["category_id"], b["provider_id"], repasse[b["provider_id"]],
+        )).fetchone()[0])
+        for b in failed
+    ]
+    db.executemany(
+        "UPDATE boletos SET status='queued', finance_tx_id=?, last_error=NULL, updated_at=datetime('now') WHERE id=?",
+        [(tx_id, int(b["id"])) for tx_id, b in zip(tx_ids, failed)],
+    )
+    enqueue(db, "boleto.batch", {"batch_id": batch_id}, max_attempts=8)
+    db.commit()
+    notify()
+    flash(f"{len(failed)} boleto(s) recolocado(s) na fila ⏳", "success")
+    return redirect(url_for("boletos.carne_view", batch_id=batch_id))
+
+
 @bp.post("/patients/<int:pid>/boletos/<int:bid>/sandbox_confirm")
 @login_required
 def sandbox_confirm(pid: int, bid: int):
@@ -228,6 +638,9 @@ def sandbox_confirm(pid: int, bid: int):
     if not b or not b["asaas_payment_id"]:
         flash("Boleto não encontrado.", "danger")
         return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
+    if not breaker.is_available():
+        flash("Asaas indisponível no momento. Tente confirmar daqui a pouco.", "warning")
+        return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
     try:
         _asaas_request("POST", f"/sandbox/payment/{b['asaas_payment_id']}/confirm")
         flash("Pagamento confirmado no sandbox ✅ (aguarde o webhook)", "success")
@@ -236,79 +649,290 @@ def sandbox_confirm(pid: int, bid: int):
     return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
 
 
+# ===== Webhooks (caixa de entrada + processamento em lote) =====
+
+INBOX_BATCH = 200
+INBOX_RETENTION_DAYS = 7
+EVENT_RETENTION_DAYS = 90   # depois disso o Asaas não reenvia mais; vira resumo por cobrança
+
+WEBHOOK_STATUS = {
+    "PAYMENT_CONFIRMED": "paid",
+    "PAYMENT_RECEIVED": "paid",
+    "PAYMENT_OVERDUE": "overdue",
+    "PAYMENT_DELETED": "cancelled",
+    "PAYMENT_BANK_SLIP_CANCELLED": "cancelled",
+}
+
+WEBHOOK_EVENT_LABELS = {
+    "PAYMENT_CREATED": "Cobrança criada",
+    "PAYMENT_UPDATED": "Cobrança alterada",
+    "PAYMENT_CONFIRMED": "Pagamento confirmado",
+    "PAYMENT_RECEIVED": "Pagamento recebido",
+    "PAYMENT_OVERDUE": "Venceu",
+    "PAYMENT_DELETED": "Cobrança excluída",
+    "PAYMENT_RESTORED": "Cobrança restaurada",
+    "PAYMENT_REFUNDED": "Estornado",
+    "PAYMENT_BANK_SLIP_CANCELLED": "Boleto cancelado",
+    "PAYMENT_BANK_SLIP_VIEWED": "Boleto visualizado",
+    "PAYMENT_CHECKOUT_VIEWED": "Fatura visualizada",
+}
+
+
 @bp.post("/webhooks/asaas")
 def asaas_webhook():
-    """Recebe eventos do Asaas e atualiza o boleto + financeiro automaticamente."""
+    """Recebe eventos do Asaas: só guarda o corpo na caixa de entrada e responde.
+
+    O Asaas entrega pelo menos uma vez e reenvia se demorarmos; a deduplicação e
+    a atualização do boleto/financeiro ficam com drain_webhook_inbox (worker).
+    """
     token_cfg = (current_app.config.get("ASAAS_WEBHOOK_TOKEN") or "").strip()
     if token_cfg:
         token_hdr = (request.headers.get("asaas-access-token") or "").strip()
         if token_hdr != token_cfg:
             return jsonify({"ok": False, "error": "invalid token"}), 401
 
+    raw = request.get_data(as_text=True) or "{}"
     body = request.get_json(silent=True) or {}
-    event_id = str(body.get("id") or "")
-    event = str(body.get("event") or "")
-    payment = body.get("payment") or {}
-    pay_id = str(payment.get("id") or "")
+    if not isinstance(body, dict):
+        body = {}
+    payment = body.get("payment") if isinstance(body.get("payment"), dict) else {}
+    row = (str(body.get("id") or "") or None, str(body.get("event") or ""), str(payment.get("id") or "") or None, raw)
 
     db = get_db()
+    db.execute("INSERT INTO asaas_webhook_inbox(event_id, event, payment_id, body) VALUES(?,?,?,?)", row)
+    db.commit()
+    notify()
+    return jsonify({"received": True})
 
-    # dedupe de eventos
-    if event_id:
-        try:
-            db.execute(
-                "INSERT INTO asaas_webhook_events(id, event, payment_id) VALUES(?,?,?)",
-                (event_id, event, pay_id),
-            )
-            db.commit()
-        except Exception:
-            # já processado
-            return jsonify({"received": True, "dedup": True})
-
-    # atualiza boleto
-    if not pay_id:
-        return jsonify({"received": True})
-
-    boleto = db.execute("SELECT * FROM boletos WHERE asaas_payment_id=? LIMIT 1", (pay_id,)).fetchone()
-    if not boleto:
-        return jsonify({"received": True, "unknown_payment": True})
-
-    new_status = None
-    if event in ("PAYMENT_CONFIRMED", "PAYMENT_RECEIVED"):
-        new_status = "paid"
-    elif event in ("PAYMENT_OVERDUE",):
-        new_status = "overdue"
-    elif event in ("PAYMENT_DELETED", "PAYMENT_BANK_SLIP_CANCELLED"):
-        new_status = "cancelled"
-
-    # tenta pegar data de pagamento
-    paid_date = None
+
+def _paid_date(payment: dict[str, Any]) -> str:
     for k in ("paymentDate", "confirmedDate", "clientPaymentDate"):
         v = payment.get(k)
         if isinstance(v, str) and len(v) >= 10:
-            paid_date = v[:10]
-            break
-    if not paid_date:
-        paid_date = today_yyyy_mm_dd()
+            return v[:10]
+    return today_yyyy_mm_dd()
 
-    bank_slip_url = payment.get("bankSlipUrl") or boleto["bank_slip_url"]
-    invoice_url = payment.get("invoiceUrl") or boleto["invoice_url"]
 
-    if new_status:
-        db.execute(
+def _apply_inbox_batch(db, limit: int = INBOX_BATCH) -> int:
+    """Processa até `limit` eventos da caixa de entrada em UMA transação.
+
+    BEGIN IMMEDIATE serializa os workers (os dois processos do gunicorn): quem
+    pegou o lote marca como processado antes de soltar o lock. Eventos do mesmo
+    pagamento são aplicados na ordem de chegada; só o estado final de cada
+    boleto/lançamento vai para o banco (executemany).
+    """
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute(
+            "SELECT id, event_id, event, payment_id, body FROM asaas_webhook_inbox "
+            "WHERE processed_at IS NULL ORDER BY id LIMIT ?",
+            (limit,),
+        ).fetchall()
+        if not rows:
+            db.rollback()
+            return 0
+
+        # dedupe: eventos já vistos (reentregas) não são aplicados de novo
+        event_ids = [r["event_id"] for r in rows if r["event_id"]]
+        seen: set[str] = set()
+        for i in range(0, len(event_ids), 500):
+            chunk = event_ids[i:i + 500]
+            seen.update(
+                x["id"] for x in db.execute(
+                    f"SELECT id FROM asaas_webhook_events WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                )
+            )
+
+        new_events = []
+        per_payment: dict[str, list[tuple[str, dict[str, Any]]]] = {}
+        for r in rows:
+            eid = r["event_id"]
+            if eid:
+                if eid in seen:
+                    continue
+                seen.add(eid)
+                new_events.append((eid, r["event"], r["payment_id"]))
+            if not r["payment_id"]:
+                continue
+            try:
+                payment = (json.loads(r["body"] or "{}") or {}).get("payment") or {}
+            except (ValueError, AttributeError):
+                payment = {}
+            per_payment.setdefault(r["payment_id"], []).append((r["event"], payment))
+
+        db.executemany("INSERT OR IGNORE INTO asaas_webhook_events(id, event, payment_id) VALUES(?,?,?)", new_events)
+
+        boletos = {}
+        pay_ids = list(per_payment)
+        for i in range(0, len(pay_ids), 500):
+            chunk = pay_ids[i:i + 500]
+            for b in db.execute(
+                f"SELECT id, asaas_payment_id, status, finance_tx_id, bank_slip_url, invoice_url FROM boletos "
+                f"WHERE asaas_payment_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ):
+                boletos[b["asaas_payment_id"]] = b
+
+        boleto_updates = []
+        paid_updates = []
+        for pay_id, events in per_payment.items():
+            b = boletos.get(pay_id)
+            if not b:
+                continue
+            status, slip, invoice, paid_on = None, b["bank_slip_url"], b["invoice_url"], None
+            for event, payment in events:  # ordem de chegada
+                new_status = WEBHOOK_STATUS.get(event)
+                slip = payment.get("bankSlipUrl") or slip
+                invoice = payment.get("invoiceUrl") or invoice
+                if new_status:
+                    status = new_status
+                    if new_status == "paid":
+                        paid_on = _paid_date(payment)
+            if status:
+                boleto_updates.append((status, slip, invoice, int(b["id"])))
+            # Se pagou (mesmo que chegue outro evento depois), dá baixa automática no financeiro
+            if paid_on and b["finance_tx_id"]:
+                paid_updates.append((paid_on, int(b["finance_tx_id"])))
+
+        db.executemany(
             "UPDATE boletos SET status=?, bank_slip_url=?, invoice_url=?, updated_at=datetime('now') WHERE id=?",
-            (new_status, bank_slip_url, invoice_url, int(boleto["id"])),
+            boleto_updates,
         )
+        db.executemany(
+            "UPDATE transactions SET status='paid', date=?, due_date=NULL, payment_method='boleto' WHERE id=?",
+            paid_updates,
+        )
+        # o lote é exatamente os pendentes de id mínimo..máximo (lidos sob o lock)
+        db.execute(
+            "UPDATE asaas_webhook_inbox SET processed_at=datetime('now') WHERE id BETWEEN ? AND ? AND processed_at IS NULL",
+            (rows[0]["id"], rows[-1]["id"]),
+        )
+        db.commit()
+        return len(rows)
+    except Exception:
+        db.rollback()
+        raise
 
-    # Se pagou, dá baixa automática no financeiro
-    if new_status == "paid" and boleto["finance_tx_id"]:
-        try:
-            db.execute(
-                "UPDATE transactions SET status='paid', date=?, due_date=NULL, payment_method='boleto' WHERE id=?",
-                (paid_date, int(boleto["finance_tx_id"])),
-            )
-        except Exception:
-            pass
 
-    db.commit()
-    return jsonify({"received": True})
\ No newline at end of file
+def compact_webhook_events(db, days: int = EVENT_RETENTION_DAYS) -> int:
+    """Troca os eventos mais antigos que `days` por um resumo por cobrança (asaas_webhook_summary).
+
+    Tudo numa transação: soma as contagens por tipo de evento ao resumo existente
+    e apaga os eventos. A dedupe continua pela PK de asaas_webhook_events, que só
+    guarda a janela em que o Asaas ainda pode reenviar. Retorna quantos saíram.
+    """
+    cutoff = f"-{int(days)} days"
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute(
+            "SELECT payment_id, event, COUNT(*) AS n, MIN(received_at) AS first_at, MAX(received_at) AS last_at "
+            "FROM asaas_webhook_events WHERE received_at < datetime('now', ?) AND payment_id IS NOT NULL "
+            "GROUP BY payment_id, event",
+            (cutoff,),
+        ).fetchall()
+        merged: dict[str, dict[str, Any]] = {}
+        for r in rows:
+            m = merged.setdefault(r["payment_id"], {"counts": {}, "first_at": r["first_at"], "last_at": "", "last_event": None})
+            m["counts"][r["event"] or ""] = m["counts"].get(r["event"] or "", 0) + int(r["n"])
+            m["first_at"] = min(m["first_at"], r["first_at"])
+            if r["last_at"] >= m["last_at"]:
+                m["last_at"], m["last_event"] = r["last_at"], r["event"]
+
+        pay_ids = list(merged)
+        for i in range(0, len(pay_ids), 500):
+            chunk = pay_ids[i:i + 500]
+            for old in db.execute(
+                f"SELECT * FROM asaas_webhook_summary WHERE payment_id IN ({','.join('?' * len(chunk))})", chunk
+            ):
+                m = merged[old["payment_id"]]
+                for ev, n in json.loads(old["event_counts"] or "{}").items():
+                    m["counts"][ev] = m["counts"].get(ev, 0) + int(n)
+                m["first_at"] = min(m["first_at"], old["first_at"] or m["first_at"])
+                if (old["last_at"] or "") > m["last_at"]:
+                    m["last_at"], m["last_event"] = old["last_at"], old["last_event"]
+
+        db.executemany(
+            "INSERT OR REPLACE INTO asaas_webhook_summary(payment_id, events, first_at, last_at, last_event, event_counts) "
+            "VALUES(?,?,?,?,?,?)",
+            [
+                (pid, sum(m["counts"].values()), m["first_at"], m["last_at"], m["last_event"], json.dumps(m["counts"]))
+                for pid, m in merged.items()
+            ],
+        )
+        cur = db.execute("DELETE FROM asaas_webhook_events WHERE received_at < datetime('now', ?)", (cutoff,))
+        db.commit()
+        return max(0, cur.rowcount)
+    except Exception:
+        db.rollback()
+        raise
+
+
+_inbox_ticks = 0
+
+
+@periodic
+def drain_webhook_inbox(db) -> int:
+    """Esvazia a caixa de entrada de webhooks, em lotes de INBOX_BATCH."""
+    global _inbox_ticks
+    total = 0
+    while True:
+        n = _apply_inbox_batch(db)
+        total += n
+        if n < INBOX_BATCH:
+            break
+    _inbox_ticks += 1
+    if _inbox_ticks % 500 == 0:
+        db.execute(
+            "DELETE FROM asaas_webhook_inbox WHERE processed_at < datetime('now', ?)",
+            (f"-{INBOX_RETENTION_DAYS} days",),
+        )
+        db.commit()
+        compact_webhook_events(db)
+    return total
+
+
+@bp.get("/patients/<int:pid>/boletos/<int:bid>/events")
+@login_required
+def boleto_events(pid: int, bid: int):
+    """Histórico de webhooks de um boleto (eventos recentes + resumo dos compactados)."""
+    db = get_db()
+    b = db.execute("SELECT * FROM boletos WHERE id=? AND patient_id=?", (bid, pid)).fetchone()
+    if not b:
+        flash("Boleto não encontrado.", "danger")
+        return redirect(url_for("patients.view_patient", pid=pid, tab="boletos"))
+    patient = db.execute("SELECT id, name FROM patients WHERE id=?", (pid,)).fetchone()
+    events, summary, pending = [], None, 0
+    if b["asaas_payment_id"]:
+        events = db.execute(
+            "SELECT id, event, received_at FROM asaas_webhook_events WHERE payment_id=? ORDER BY received_at DESC, rowid DESC",
+            (b["asaas_payment_id"],),
+        ).fetchall()
+        summary = db.execute("SELECT * FROM asaas_webhook_summary WHERE payment_id=?", (b["asaas_payment_id"],)).fetchone()
+        pending = db.execute(
+            "SELECT COUNT(*) FROM asaas_webhook_inbox WHERE payment_id=? AND processed_at IS NULL", (b["asaas_payment_id"],)
+        ).fetchone()[0]
+    old_counts = sorted(json.loads(summary["event_counts"] or "{}").items()) if summary else []
+    return render_template(
+        "boleto_events.html",
+        patient=patient,
+        boleto=b,
+        events=events,
+        summary=summary,
+        old_counts=old_counts,
+        pending=pending,
+        labels=WEBHOOK_EVENT_LABELS,
+        status_labels=BOLETO_STATUS_LABELS,
+        retention_days=EVENT_RETENTION_DAYS,
+        cents_to_brl=cents_to_brl,
+    )
+
+
+@bp.get("/asaas/metrics")
+@login_required
+def asaas_metrics():
+    """Estado do circuit breaker e latência/erros por endpoint do Asaas (contadores deste processo)."""
+    return jsonify({"circuit": breaker.snapshot(), "endpoints": metrics_snapshot()})
@@ -7,6 +7,7 @@ from flask import current_app
 from flask import Blueprint, render_template, request, session
 from .auth import login_required
 from .db import get_db, get_open_cash_session_id
+from .lookups import get_setting
 from .utils import cents_to_brl
 
 bp = Blueprint("dashboard", __name__)
@@ -73,8 +74,7 @@ def index():
             "cash_total": cents_to_brl(cash_total),
         }
     # Lembrete de aniversários (mostra na Home)
-    tpl_row = db.execute("SELECT value FROM app_settings WHERE key='birthday_template'").fetchone()
-    birthday_template = (tpl_row["value"] if tpl_row and tpl_row["value"] else "Oi {nome}! 🎉 A {clinica} deseja um dia incrível! 🙂")
+    birthday_template = get_setting(db, "birthday_template") or "Oi {nome}! 🎉 A {clinica} deseja um dia incrível! 🙂"
     clinica = current_app.config.get("CLINIC_NAME", "NewClínica")
 
     mmdd = date.today().strftime("%m-%d")
@@ -3,9 +3,21 @@ from __future__ import annotations
 
 import os
 import sqlite3
+import threading
 from pathlib import Path
+from typing import Any, Callable, TypeVar
 from flask import current_app, g
 
+T = TypeVar("T")
+
+# Tabelas com contador de versão (data_versions), incrementado por trigger a cada escrita.
+# Serve para invalidar caches de cada worker do gunicorn sem comunicação entre eles.
+VERSIONED_TABLES = ("appointments", "patients", "providers", "ortho_maintenances", "transactions", "categories", "app_settings")
+
+_version_cache: dict[tuple, tuple[tuple[int, ...], Any]] = {}
+_version_cache_lock = threading.Lock()
+VERSION_CACHE_MAX = 256
+
 def get_db() -> sqlite3.Connection:
     if "db" not in g:
         db_path = current_app.config["DB_PATH"]
@@ -39,6 +51,244 @@ def _ensure_columns(db: sqlite3.Connection, table: str, columns: dict[str, str])
             # Se der erro (ex.: coluna já existe por algum motivo), ignora
             pass
 
+def _ensure_version_triggers(db: sqlite3.Connection, tables: tuple[str, ...]) -> None:
+    for table in tables:
+        db.execute("INSERT OR IGNORE INTO data_versions(name, version) VALUES(?, 0)", (table,))
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            db.execute(
+                f"CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{op.lower()} AFTER {op} ON {table} "
+                f"BEGIN UPDATE data_versions SET version=version+1 WHERE name='{table}'; END"
+            )
+
+# Recalcula o resumo de UM paciente (as triggers trocam {pid} por NEW/OLD.patient_id).
+# Usa idx_ortho_patient_date, então custa o histórico daquele paciente, não a tabela.
+# A "última manutenção" (last_*/next_*) ignora as linhas da cobrança mensal
+# (billing_month preenchido, sem retorno marcado): elas só entram nos valores.
+_ORTHO_SUMMARY_SQL = """
+    INSERT OR REPLACE INTO ortho_patient_summary(
+        patient_id, maintenances, last_id, last_date, next_date, next_time,
+        paid_cents, pending_cents, pending_due, updated_at)
+    SELECT o.patient_id, COUNT(*), l.id, l.maintenance_date, l.next_date, l.next_time,
+           SUM(CASE WHEN o.payment_status='paid' THEN o.amount_cents ELSE 0 END),
+           SUM(CASE WHEN o.payment_status='pending' THEN o.amount_cents ELSE 0 END),
+           MIN(CASE WHEN o.payment_status='pending' AND o.amount_cents > 0 THEN o.due_date END),
+           datetime('now')
+      FROM ortho_maintenances o
+      LEFT JOIN ortho_maintenances l ON l.id = (
+           SELECT id FROM ortho_maintenances WHERE patient_id={pid} AND billing_month IS NULL
+            ORDER BY maintenance_date DESC, id DESC LIMIT 1)
+     WHERE o.patient_id={pid}
+     GROUP BY o.patient_id;
+    DELETE FROM ortho_patient_summary
+     WHERE patient_id={pid} AND NOT EXISTS (SELECT 1 FROM ortho_maintenances WHERE patient_id={pid});
+"""
+
+_ORTHO_SUMMARY_TRIGGERS = {
+    "trg_ortho_summary_insert":
+        "CREATE TRIGGER trg_ortho_summary_insert AFTER INSERT ON ortho_maintenances "
+        f"BEGIN {_ORTHO_SUMMARY_SQL.format(pid='NEW.patient_id')} END",
+    "trg_ortho_summary_update":
+        "CREATE TRIGGER trg_ortho_summary_update AFTER UPDATE ON ortho_maintenances "
+        f"BEGIN {_ORTHO_SUMMARY_SQL.format(pid='NEW.patient_id')} {_ORTHO_SUMMARY_SQL.format(pid='OLD.patient_id')} END",
+    "trg_ortho_summary_delete":
+        "CREATE TRIGGER trg_ortho_summary_delete AFTER DELETE ON ortho_maintenances "
+        f"BEGIN {_ORTHO_SUMMARY_SQL.format(pid='OLD.patient_id')} END",
+}
+
+def _ensure_ortho_summary(db: sqlite3.Connection) -> None:
+    """Triggers que mantêm ortho_patient_summary (um registro por paciente) a cada escrita."""
+    current = dict(db.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type='trigger' AND name LIKE 'trg_ortho_summary_%'"
+    ).fetchall())
+    stale = False
+    for name, sql in _ORTHO_SUMMARY_TRIGGERS.items():
+        if current.get(name) == sql:
+            continue
+        # trigger nova ou com o corpo de uma versão anterior do resumo
+        db.execute(f"DROP TRIGGER IF EXISTS {name}")
+        db.execute(sql)
+        stale = True
+    if stale:
+        # base antiga: monta o resumo de uma vez com a regra atual
+        rebuild_ortho_summary(db)
+
+# Lançamentos que contam no saldo do paciente {pid}: entradas do financeiro (menos as
+# pendentes de boleto cancelado) + manutenções de orto com valor que não têm lançamento.
+_BALANCE_ITEMS_SQL = """
+    SELECT t.patient_id AS patient_id, t.amount_cents AS amount, t.status AS status,
+           COALESCE(t.due_date, t.date) AS due, t.date AS paid_on
+      FROM transactions t
+     WHERE t.kind='income' AND {tx_where}
+       AND NOT (t.status='pending' AND EXISTS (
+            SELECT 1 FROM boletos b WHERE b.finance_tx_id=t.id AND b.patient_id=t.patient_id AND b.status='cancelled'))
+    UNION ALL
+    SELECT o.patient_id, o.amount_cents, o.payment_status,
+           COALESCE(o.due_date, o.maintenance_date), COALESCE(o.paid_at, o.maintenance_date)
+      FROM ortho_maintenances o
+     WHERE o.finance_tx_id IS NULL AND o.amount_cents > 0 AND {ortho_where}
+"""
+
+_BALANCE_SELECT_SQL = """
+    SELECT i.patient_id,
+           SUM(i.amount),
+           SUM(CASE WHEN i.status='paid' THEN i.amount ELSE 0 END),
+           SUM(CASE WHEN i.status<>'paid' THEN i.amount ELSE 0 END),
+           SUM(CASE WHEN i.status<>'paid' AND i.due < date('now') THEN i.amount ELSE 0 END),
+           MIN(CASE WHEN i.status<>'paid' THEN i.due END),
+           MAX(CASE WHEN i.status='paid' THEN i.paid_on END),
+           date('now'), datetime('now')
+      FROM ({items}) i
+      JOIN patients p ON p.id = i.patient_id
+     GROUP BY i.patient_id
+"""
+
+_BALANCE_COLUMNS = (
+    "patient_id, billed_cents, paid_cents, pending_cents, overdue_cents, oldest_due, last_payment, as_of, updated_at"
+)
+
+# Recalcula o saldo de UM paciente (as triggers trocam {pid} por NEW/OLD.patient_id).
+_PATIENT_BALANCE_SQL = (
+    "DELETE FROM patient_balances WHERE patient_id={pid}; "
+    f"INSERT INTO patient_balances({_BALANCE_COLUMNS}) "
+    + _BALANCE_SELECT_SQL.format(items=_BALANCE_ITEMS_SQL.format(
+        tx_where="t.patient_id={pid}", ortho_where="o.patient_id={pid}"
+    ))
+    + ";"
+)
+
+def _ensure_patient_balances(db: sqlite3.Connection) -> None:
+    """Triggers que mantêm patient_balances a cada escrita que mexe no saldo."""
+    fresh = not db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='trg_balance_tx_insert'"
+    ).fetchone()
+    new, old = _PATIENT_BALANCE_SQL.format(pid="NEW.patient_id"), _PATIENT_BALANCE_SQL.format(pid="OLD.patient_id")
+    # no UPDATE só refaz o paciente antigo se o lançamento mudou de paciente
+    moved = _PATIENT_BALANCE_SQL.format(pid="(CASE WHEN OLD.patient_id IS NOT NEW.patient_id THEN OLD.patient_id END)")
+    watched = {
+        "transactions": "kind, status, date, due_date, amount_cents, patient_id",
+        "ortho_maintenances": "patient_id, amount_cents, payment_status, due_date, paid_at, maintenance_date, finance_tx_id",
+        "boletos": "patient_id, status, finance_tx_id",
+    }
+    for table, short in (("transactions", "tx"), ("ortho_maintenances", "ortho"), ("boletos", "boleto")):
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS trg_balance_{short}_insert AFTER INSERT ON {table} BEGIN {new} END")
+        db.execute(
+            f"CREATE TRIGGER IF NOT EXISTS trg_balance_{short}_update AFTER UPDATE OF {watched[table]} ON {table} "
+            f"BEGIN {new} {moved} END"
+        )
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS trg_balance_{short}_delete AFTER DELETE ON {table} BEGIN {old} END")
+    if fresh:
+        rebuild_patient_balances(db)
+
+def rebuild_patient_balances(db: sqlite3.Connection, patient_ids: list[int] | None = None) -> int:
+    """Refaz os saldos numa passada só (todos ou só `patient_ids`), sem commit. Retorna quantos ficaram."""
+    if patient_ids is None:
+        where, args = "patient_id IS NOT NULL", []
+        db.execute("DELETE FROM patient_balances")
+    else:
+        if not patient_ids:
+            return 0
+        where, args = f"patient_id IN ({','.join('?' * len(patient_ids))})", list(patient_ids)
+        db.execute(f"DELETE FROM patient_balances WHERE {where}", args)
+    items = _BALANCE_ITEMS_SQL.format(tx_where=f"t.{where}", ortho_where=f"o.{where}")
+    cur = db.execute(
+        f"INSERT INTO patient_balances({_BALANCE_COLUMNS}) " + _BALANCE_SELECT_SQL.format(items=items),
+        args + args,
+    )
+    return max(0, cur.rowcount)
+
+def refresh_overdue_balances(db: sqlite3.Connection) -> int:
+    """Vencidos mudam com o calendário, não só com escritas: refaz quem tem pendência
+    vencendo desde o último cálculo e marca o resto como atual. Sem commit."""
+    stale = [
+        r[0] for r in db.execute(
+            "SELECT patient_id FROM patient_balances "
+            "WHERE as_of < date('now') AND pending_cents > 0 AND oldest_due < date('now')"
+        )
+    ]
+    n = rebuild_patient_balances(db, stale) if stale else 0
+    db.execute("UPDATE patient_balances SET as_of=date('now') WHERE as_of < date('now')")
+    return n
+
+def _ensure_odontograma_history(db: sqlite3.Connection) -> None:
+    """Triggers que gravam cada mudança de status/observação em odontograma_history."""
+    fresh = not db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='trg_odonto_history_insert'"
+    ).fetchone()
+    db.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_odonto_history_insert AFTER INSERT ON odontograma "
+        "BEGIN INSERT INTO odontograma_history(patient_id, tooth, status, note, changed_at) "
+        "VALUES(NEW.patient_id, NEW.tooth, NEW.status, NEW.note, NEW.updated_at); END"
+    )
+    # salvar o mesmo status/obs. de novo não vira histórico
+    db.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_odonto_history_update AFTER UPDATE ON odontograma "
+        "WHEN NEW.status IS NOT OLD.status OR NEW.note IS NOT OLD.note "
+        "BEGIN INSERT INTO odontograma_history(patient_id, tooth, status, note, prev_status, changed_at) "
+        "VALUES(NEW.patient_id, NEW.tooth, NEW.status, NEW.note, OLD.status, NEW.updated_at); END"
+    )
+    if fresh:
+        # base antiga: o estado atual vira o primeiro ponto da linha do tempo
+        db.execute(
+            "INSERT INTO odontograma_history(patient_id, tooth, status, note, changed_at) "
+            "SELECT patient_id, tooth, status, note, updated_at FROM odontograma ORDER BY updated_at, id"
+        )
+
+def rebuild_ortho_summary(db: sqlite3.Connection) -> None:
+    """Refaz o resumo de todos os pacientes (sem commit)."""
+    db.execute("DELETE FROM ortho_patient_summary")
+    db.execute(
+        """
+        INSERT INTO ortho_patient_summary(
+            patient_id, maintenances, last_id, last_date, next_date, next_time,
+            paid_cents, pending_cents, pending_due, updated_at)
+        SELECT a.patient_id, a.n, l.id, l.maintenance_date, l.next_date, l.next_time, a.paid, a.pending, a.pending_due, datetime('now')
+          FROM (SELECT patient_id, COUNT(*) AS n,
+                       SUM(CASE WHEN payment_status='paid' THEN amount_cents ELSE 0 END) AS paid,
+                       SUM(CASE WHEN payment_status='pending' THEN amount_cents ELSE 0 END) AS pending,
+                       MIN(CASE WHEN payment_status='pending' AND amount_cents > 0 THEN due_date END) AS pending_due,
+                       MAX(maintenance_date) AS last_date
+                  FROM ortho_maintenances GROUP BY patient_id) a
+          LEFT JOIN ortho_maintenances l ON l.id = (
+               SELECT id FROM ortho_maintenances WHERE patient_id=a.patient_id AND billing_month IS NULL
+                ORDER BY maintenance_date DESC, id DESC LIMIT 1)
+        """
+    )
+
+def data_version(db: sqlite3.Connection, *tables: str) -> tuple[int, ...]:
+    """Versão atual das tabelas (uma leitura na PK de data_versions)."""
+    placeholders = ",".join(["?"] * len(tables))
+    rows = db.execute(
+        f"SELECT name, version FROM data_versions WHERE name IN ({placeholders})",
+        tables,
+    ).fetchall()
+    found = {r["name"]: int(r["version"]) for r in rows}
+    return tuple(found.get(t, 0) for t in tables)
+
+def cached_by_version(db: sqlite3.Connection, tables: tuple[str, ...], key: Any, compute: Callable[[], T]) -> T:
+    """Memoiza compute() no worker enquanto nenhuma das tabelas mudar.
+
+    A versão é lida antes do cálculo: se alguém gravar no meio, o próximo acesso
+    vê a versão nova e recalcula (nunca serve dado velho com versão nova).
+    Dentro de uma transação aberta a versão pode ser de um bump ainda não
+    commitado (e um rollback devolve esse número para o próximo commit): aí só
+    consulta, sem guardar.
+    """
+    version = data_version(db, *tables)
+    cache_key = (tables, key)
+    with _version_cache_lock:
+        hit = _version_cache.get(cache_key)
+    if hit and hit[0] == version:
+        return hit[1]
+    value = compute()
+    if db.in_transaction:
+        return value
+    with _version_cache_lock:
+        _version_cache.pop(cache_key, None)
+        _version_cache[cache_key] = (version, value)
+        while len(_version_cache) > VERSION_CACHE_MAX:
+            _version_cache.pop(next(iter(_version_cache)))
+    return value
+
 def init_db():
     db = get_db()
     db.executescript("""
@@ -68,6 +318,7 @@ def init_db():
         role TEXT NOT NULL DEFAULT 'Dentista',
         default_repasse_percent INTEGER NOT NULL DEFAULT 0,
         active INTEGER NOT NULL DEFAULT 1,
+        ical_token TEXT, -- link secreto do feed .ics da agenda
         created_at TEXT NOT NULL DEFAULT (datetime('now'))
     );
 
@@ -118,6 +369,21 @@ def init_db():
     CREATE INDEX IF NOT EXISTS idx_tx_due ON transactions(due_date);
     CREATE INDEX IF NOT EXISTS idx_tx_kind ON transactions(kind);
     CREATE INDEX IF NOT EXISTS idx_tx_status ON transactions(status);
+    CREATE INDEX IF NOT EXISTS idx_tx_patient ON transactions(patient_id, date, id);
+
+    -- Saldo por paciente (mantido pelas triggers de transactions/boletos/ortho_maintenances).
+    -- Sem FK: as triggers rodam também durante o ON DELETE do paciente.
+    CREATE TABLE IF NOT EXISTS patient_balances(
+        patient_id INTEGER PRIMARY KEY,
+        billed_cents INTEGER NOT NULL DEFAULT 0,
+        paid_cents INTEGER NOT NULL DEFAULT 0,
+        pending_cents INTEGER NOT NULL DEFAULT 0,
+        overdue_cents INTEGER NOT NULL DEFAULT 0,  -- vencido até as_of
+        oldest_due TEXT,                           -- vencimento pendente mais antigo
+        last_payment TEXT,
+        as_of TEXT NOT NULL,                       -- dia em que overdue_cents foi calculado
+        updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+    );
 
     -- ===== MÓDULOS DO PACIENTE (Painel) =====
     CREATE TABLE IF NOT EXISTS budgets(
@@ -132,6 +398,55 @@ def init_db():
 
     CREATE INDEX IF NOT EXISTS idx_budgets_patient ON budgets(patient_id);
 
+    -- Itens do orçamento; os totais do cabeçalho (budgets) são ajustados pelas triggers
+    CREATE TABLE IF NOT EXISTS budget_items(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        budget_id INTEGER NOT NULL,
+        position INTEGER NOT NULL DEFAULT 0,
+        tooth TEXT,
+        procedure TEXT NOT NULL,
+        qty INTEGER NOT NULL DEFAULT 1,
+        unit_cents INTEGER NOT NULL DEFAULT 0,
+        discount_cents INTEGER NOT NULL DEFAULT 0,
+        total_cents INTEGER NOT NULL DEFAULT 0,   -- qty*unit_cents - discount_cents
+        FOREIGN KEY(budget_id) REFERENCES budgets(id) ON DELETE CASCADE
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_budget_items_budget ON budget_items(budget_id, position);
+
+    CREATE TRIGGER IF NOT EXISTS trg_budget_items_insert AFTER INSERT ON budget_items BEGIN
+        UPDATE budgets SET
+            items_count = items_count + 1,
+            gross_cents = gross_cents + NEW.qty * NEW.unit_cents,
+            discount_cents = discount_cents + NEW.discount_cents,
+            amount_cents = amount_cents + NEW.total_cents
+         WHERE id = NEW.budget_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_budget_items_update AFTER UPDATE OF budget_id, qty, unit_cents, discount_cents, total_cents ON budget_items BEGIN
+        UPDATE budgets SET
+            items_count = items_count - 1,
+            gross_cents = gross_cents - OLD.qty * OLD.unit_cents,
+            discount_cents = discount_cents - OLD.discount_cents,
+            amount_cents = amount_cents - OLD.total_cents
+         WHERE id = OLD.budget_id;
+        UPDATE budgets SET
+            items_count = items_count + 1,
+            gross_cents = gross_cents + NEW.qty * NEW.unit_cents,
+            discount_cents = discount_cents + NEW.discount_cents,
+            amount_cents = amount_cents + NEW.total_cents
+         WHERE id = NEW.budget_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_budget_items_delete AFTER DELETE ON budget_items BEGIN
+        UPDATE budgets SET
+            items_count = items_count - 1,
+            gross_cents = gross_cents - OLD.qty * OLD.unit_cents,
+            discount_cents = discount_cents - OLD.discount_cents,
+            amount_cents = amount_cents - OLD.total_cents
+         WHERE id = OLD.budget_id;
+    END;
+
     CREATE TABLE IF NOT EXISTS plan_items(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         patient_id INTEGER NOT NULL,
@@ -215,12 +530,16 @@ def init_db():
         start_at TEXT NOT NULL,
         end_at TEXT,
         note TEXT,
+        status TEXT NOT NULL DEFAULT 'scheduled', -- scheduled|confirmed|attended|no_show|cancelled
+        version INTEGER NOT NULL DEFAULT 0, -- controle de concorrência otimista
         created_at TEXT NOT NULL DEFAULT (datetime('now')),
+        updated_at TEXT NOT NULL DEFAULT (datetime('now')),
         FOREIGN KEY(patient_id) REFERENCES patients(id) ON DELETE CASCADE,
         FOREIGN KEY(provider_id) REFERENCES providers(id) ON DELETE SET NULL
     );
 
     CREATE INDEX IF NOT EXISTS idx_appt_patient_start ON appointments(patient_id, start_at);
+    CREATE INDEX IF NOT EXISTS idx_appt_provider_start ON appointments(provider_id, start_at);
 
     CREATE TABLE IF NOT EXISTS odontograma(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -235,6 +554,20 @@ def init_db():
 
     CREATE INDEX IF NOT EXISTS idx_odonto_patient ON odontograma(patient_id);
 
+    -- linha do tempo do odontograma (só INSERT; preenchida pelas triggers de odontograma)
+    CREATE TABLE IF NOT EXISTS odontograma_history(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER NOT NULL,
+        tooth TEXT NOT NULL,
+        status TEXT NOT NULL,
+        note TEXT,
+        prev_status TEXT,
+        changed_at TEXT NOT NULL DEFAULT (datetime('now')),
+        FOREIGN KEY(patient_id) REFERENCES patients(id) ON DELETE CASCADE
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_odonto_hist_tooth ON odontograma_history(patient_id, tooth, id);
+
 
     CREATE TABLE IF NOT EXISTS ortho_maintenances(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -263,6 +596,24 @@ def init_db():
     CREATE INDEX IF NOT EXISTS idx_ortho_patient ON ortho_maintenances(patient_id);
     CREATE INDEX IF NOT EXISTS idx_ortho_next ON ortho_maintenances(next_date, next_time);
     CREATE INDEX IF NOT EXISTS idx_ortho_pay ON ortho_maintenances(payment_status, due_date);
+    -- lista paginada (keyset por data+id) e "última manutenção do paciente"
+    CREATE INDEX IF NOT EXISTS idx_ortho_date ON ortho_maintenances(maintenance_date, id);
+    CREATE INDEX IF NOT EXISTS idx_ortho_patient_date ON ortho_maintenances(patient_id, maintenance_date, id);
+
+    -- Resumo por paciente de ortodontia (mantido pelas triggers de _ensure_ortho_summary)
+    CREATE TABLE IF NOT EXISTS ortho_patient_summary(
+        patient_id INTEGER PRIMARY KEY,
+        maintenances INTEGER NOT NULL DEFAULT 0,
+        last_id INTEGER,
+        last_date TEXT,
+        next_date TEXT,
+        next_time TEXT,
+        paid_cents INTEGER NOT NULL DEFAULT 0,
+        pending_cents INTEGER NOT NULL DEFAULT 0,
+        pending_due TEXT,              -- vencimento pendente mais antigo
+        updated_at TEXT,
+        FOREIGN KEY(patient_id) REFERENCES patients(id) ON DELETE CASCADE
+    );
 
 
     -- ===== BOLETOS (ASAAS) =====
@@ -274,7 +625,7 @@ def init_db():
         finance_tx_id INTEGER,
         asaas_customer_id TEXT,
         asaas_payment_id TEXT,
-        status TEXT NOT NULL DEFAULT 'pending', -- pending|paid|overdue|cancelled|unknown
+        status TEXT NOT NULL DEFAULT 'pending', -- queued|processing|failed|pending|paid|overdue|cancelled|unknown
         value_cents INTEGER NOT NULL DEFAULT 0,
         due_date TEXT NOT NULL,
         description TEXT,
@@ -293,6 +644,16 @@ def init_db():
     CREATE INDEX IF NOT EXISTS idx_boletos_due ON boletos(due_date);
     CREATE UNIQUE INDEX IF NOT EXISTS ux_boletos_asaas_payment ON boletos(asaas_payment_id);
 
+    -- Carnês: lote de boletos emitidos de uma vez (boletos.batch_id)
+    CREATE TABLE IF NOT EXISTS boleto_batches(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        description TEXT,
+        installments INTEGER NOT NULL DEFAULT 1,
+        first_due_date TEXT,
+        value_cents INTEGER NOT NULL DEFAULT 0,  -- por parcela
+        created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    );
+
     -- ===== CONTRATOS E CONSENTIMENTOS DO PACIENTE =====
     CREATE TABLE IF NOT EXISTS patient_documents(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -321,7 +682,48 @@ def init_db():
         payment_id TEXT,
         received_at TEXT NOT NULL DEFAULT (datetime('now'))
     );
+    CREATE INDEX IF NOT EXISTS idx_webhook_events_payment ON asaas_webhook_events(payment_id, received_at);
+    CREATE INDEX IF NOT EXISTS idx_webhook_events_received ON asaas_webhook_events(received_at);
+
+    -- Eventos antigos compactados (um registro por cobrança; ver compact_webhook_events em boletos.py)
+    CREATE TABLE IF NOT EXISTS asaas_webhook_summary(
+        payment_id TEXT PRIMARY KEY,
+        events INTEGER NOT NULL DEFAULT 0,
+        first_at TEXT,
+        last_at TEXT,
+        last_event TEXT,
+        event_counts TEXT              -- JSON {"PAYMENT_RECEIVED": 2, ...}
+    );
 
+    -- Caixa de entrada dos webhooks do Asaas: o endpoint só grava aqui; o worker processa em lote
+    CREATE TABLE IF NOT EXISTS asaas_webhook_inbox(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_id TEXT,
+        event TEXT,
+        payment_id TEXT,
+        body TEXT NOT NULL,
+        received_at TEXT NOT NULL DEFAULT (datetime('now')),
+        processed_at TEXT
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_webhook_inbox_pending ON asaas_webhook_inbox(id) WHERE processed_at IS NULL;
+    CREATE INDEX IF NOT EXISTS idx_webhook_inbox_processed ON asaas_webhook_inbox(processed_at) WHERE processed_at IS NOT NULL;
+
+    -- Reconciliação com o Asaas: cursor por stream (ver app/asaas_sync.py)
+    CREATE TABLE IF NOT EXISTS asaas_sync_state(
+        stream TEXT PRIMARY KEY,
+        cursor_date TEXT NOT NULL,     -- YYYY-MM-DD
+        page_offset INTEGER NOT NULL DEFAULT 0,
+        run_started TEXT,              -- rodada em andamento (NULL = terminou)
+        last_run_at TEXT,
+        last_changed INTEGER NOT NULL DEFAULT 0
+    );
+
+    -- Versão por tabela (triggers incrementam a cada escrita); invalida caches dos workers
+    CREATE TABLE IF NOT EXISTS data_versions(
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    );
 
     CREATE TABLE IF NOT EXISTS app_settings(
         key TEXT PRIMARY KEY,
@@ -341,10 +743,102 @@ def init_db():
 
     CREATE INDEX IF NOT EXISTS idx_bdaylog_patient_sent ON birthday_log(patient_id, sent_on);
 
+    -- Fila de tarefas em segundo plano (ver app/jobs.py)
+    CREATE TABLE IF NOT EXISTS jobs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL DEFAULT '{}',   -- JSON
+        status TEXT NOT NULL DEFAULT 'queued', -- queued|running|done|failed
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        run_after TEXT NOT NULL DEFAULT (datetime('now')),
+        locked_at TEXT,
+        last_error TEXT,
+        result TEXT,                          -- JSON devolvido pelo handler (ex.: resumo para a tela)
+        created_at TEXT NOT NULL DEFAULT (datetime('now')),
+        updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, run_after, id);
+
+    -- Lista de espera (encaixes quando um horário é liberado)
+    CREATE TABLE IF NOT EXISTS waitlist(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER NOT NULL,
+        provider_id INTEGER,            -- NULL = qualquer profissional
+        earliest_date TEXT,             -- YYYY-MM-DD (NULL = a partir de já)
+        latest_date TEXT,               -- YYYY-MM-DD (NULL = sem limite)
+        time_from TEXT,                 -- HH:MM (NULL = qualquer horário)
+        time_to TEXT,                   -- HH:MM
+        priority INTEGER NOT NULL DEFAULT 0, -- maior = atende primeiro
+        note TEXT,
+        active INTEGER NOT NULL DEFAULT 1,
+        created_at TEXT NOT NULL DEFAULT (datetime('now')),
+        FOREIGN KEY(patient_id) REFERENCES patients(id) ON DELETE CASCADE,
+        FOREIGN KEY(provider_id) REFERENCES providers(id) ON DELETE SET NULL
+    );
+
+    -- Janela (datas/horários) e paciente no fim do índice: os filtros de encaixe são
+    -- resolvidos na própria entrada do índice, sem ler a linha da tabela
+    DROP INDEX IF EXISTS idx_waitlist_match;
+    CREATE INDEX IF NOT EXISTS idx_waitlist_window ON waitlist(provider_id, priority DESC, id,
+        earliest_date, latest_date, time_from, time_to, patient_id) WHERE active=1;
+
+    -- Lembretes de consulta (WhatsApp) gerados por dia
+    CREATE TABLE IF NOT EXISTS reminder_log(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        appointment_id INTEGER NOT NULL,
+        patient_id INTEGER NOT NULL,
+        remind_on TEXT NOT NULL,        -- dia da consulta (YYYY-MM-DD)
+        channel TEXT NOT NULL DEFAULT 'whatsapp',
+        message TEXT,
+        sent_at TEXT,
+        created_at TEXT NOT NULL DEFAULT (datetime('now')),
+        UNIQUE(appointment_id, channel),
+        FOREIGN KEY(appointment_id) REFERENCES appointments(id) ON DELETE CASCADE,
+        FOREIGN KEY(patient_id) REFERENCES patients(id) ON DELETE CASCADE
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_reminderlog_day ON reminder_log(remind_on);
+
     """)
     # Migrações leves (bases antigas)
     _ensure_columns(db, "patients", {"cpf": "TEXT", "address": "TEXT", "asaas_customer_id": "TEXT", "is_ortho": "INTEGER NOT NULL DEFAULT 0"})
     _ensure_columns(db, "transactions", {"repasse_paid_at": "TEXT"})
+    _ensure_columns(db, "providers", {"ical_token": "TEXT"})
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_providers_ical_token ON providers(ical_token)")
+    appt_cols = {r["name"] for r in db.execute("PRAGMA table_info(appointments)").fetchall()}
+    _ensure_columns(db, "appointments", {
+        "status": "TEXT NOT NULL DEFAULT 'scheduled'",
+        "version": "INTEGER NOT NULL DEFAULT 0",
+        "updated_at": "TEXT",
+    })
+    if "updated_at" not in appt_cols:
+        # coluna recém-criada (base antiga): preenche uma vez só; os INSERTs já gravam updated_at
+        db.execute("UPDATE appointments SET updated_at=created_at WHERE updated_at IS NULL")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_appt_status_start ON appointments(status, start_at)")
+    # cobre a análise de faltas (período + status + profissional/paciente) sem ler a tabela
+    db.execute("CREATE INDEX IF NOT EXISTS idx_appt_start_status ON appointments(start_at, status, provider_id, patient_id)")
+    # cobrança mensal da ortodontia (ver ortho.billing_run): no máximo uma por paciente/mês
+    _ensure_columns(db, "ortho_maintenances", {"billing_month": "TEXT"})
+    db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_ortho_billing_month ON ortho_maintenances(patient_id, billing_month) "
+        "WHERE billing_month IS NOT NULL"
+    )
+    _ensure_columns(db, "boletos", {"last_error": "TEXT", "batch_id": "INTEGER"})
+    _ensure_columns(db, "jobs", {"result": "TEXT"})
+    db.execute("CREATE INDEX IF NOT EXISTS idx_boletos_batch ON boletos(batch_id, status)")
+    # "atualizar boletos em aberto": só os pendentes/vencidos, dos consultados há mais tempo
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_boletos_open ON boletos(updated_at, id) "
+        "WHERE status IN ('pending','overdue') AND asaas_payment_id IS NOT NULL"
+    )
+    # totais do orçamento com itens (mantidos pelas triggers de budget_items)
+    _ensure_columns(db, "budgets", {
+        "items_count": "INTEGER NOT NULL DEFAULT 0",
+        "gross_cents": "INTEGER NOT NULL DEFAULT 0",
+        "discount_cents": "INTEGER NOT NULL DEFAULT 0",
+    })
     _ensure_columns(db, "patient_documents", {
         "responsible": "TEXT",
         "signed_cpf": "TEXT",
@@ -353,6 +847,11 @@ def init_db():
         "updated_at": "TEXT NOT NULL DEFAULT (datetime('now'))",
     })
 
+    _ensure_version_triggers(db, VERSIONED_TABLES)
+    _ensure_ortho_summary(db)
+    _ensure_odontograma_history(db)
+    _ensure_patient_balances(db)
+
     db.commit()
 
 def ensure_seed_data():
@@ -378,6 +877,15 @@ def ensure_seed_data():
         ),
     )
 
+    # Mensagem padrão de lembrete de consulta (WhatsApp)
+    db.execute(
+        "INSERT OR IGNORE INTO app_settings(key, value) VALUES(?, ?)",
+        (
+            "reminder_template",
+            "Olá {nome}! Passando pra lembrar da sua consulta ({procedimento}) em {data} às {hora} com {profissional} na {clinica}. Podemos confirmar? 🙂",
+        ),
+    )
+
     # Profissionais padrão (Dentistas)
     default_providers = [
         "Hellen",
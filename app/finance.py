@@ -5,7 +5,9 @@ from datetime import date
 from functools import wraps
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app
 from .auth import login_required
-from .db import get_db, get_open_cash_session_id
+from .db import get_db, get_open_cash_session_id, refresh_overdue_balances
+from .jobs import periodic
+from .lookups import active_categories, active_providers, provider_repasse
 from .utils import parse_brl_to_cents, cents_to_brl, today_yyyy_mm_dd
 
 bp = Blueprint("finance", __name__, url_prefix="/finance")
@@ -24,6 +26,21 @@ PAYMENT_METHODS = [
 ]
 
 
+_balances_refreshed_on: str | None = None
+
+
+@periodic
+def refresh_balances_daily(db) -> None:
+    """Uma vez por dia (por processo): atualiza o "vencido" de patient_balances."""
+    global _balances_refreshed_on
+    today = today_yyyy_mm_dd()
+    if _balances_refreshed_on == today:
+        return
+    refresh_overdue_balances(db)
+    db.commit()
+    _balances_refreshed_on = today
+
+
 def finance_required(view):
     """Proteção extra do módulo Financeiro por senha (além do login)."""
 
@@ -166,9 +183,9 @@ def transactions():
                 total_expense += amt
 
     patients = db.execute("SELECT id, name, cpf FROM patients ORDER BY name ASC").fetchall()
-    categories = db.execute("SELECT id, name FROM categories WHERE active=1 ORDER BY name ASC").fetchall()
+    categories = active_categories(db)
 
-    providers = db.execute("SELECT id, name FROM providers WHERE active=1 ORDER BY name ASC").fetchall()
+    providers = active_providers(db)
     pm_labels = {k: v for k, v in PAYMENT_METHODS}
 
     income_by_pm = {
@@ -201,8 +218,8 @@ def transactions():
 def transaction_new():
     db = get_db()
     patients = db.execute("SELECT id, name, cpf FROM patients ORDER BY name ASC").fetchall()
-    categories = db.execute("SELECT id, name, kind FROM categories WHERE active=1 ORDER BY name ASC").fetchall()
-    providers = db.execute("SELECT id, name, default_repasse_percent FROM providers WHERE active=1 ORDER BY name ASC").fetchall()
+    categories = active_categories(db)
+    providers = active_providers(db)
 
     if request.method == "POST":
         kind = request.form.get("kind", "income")
@@ -230,11 +247,7 @@ def transaction_new():
 
         if repasse_percent == "":
             # puxa default do provider
-            if prid is not None:
-                r = db.execute("SELECT default_repasse_percent FROM providers WHERE id=?", (prid,)).fetchone()
-                repasse_percent = str(int(r["default_repasse_percent"] or 0))
-            else:
-                repasse_percent = "0"
+            repasse_percent = str(provider_repasse(db, prid))
 
         try:
             repasse_percent_int = max(0, min(100, int(repasse_percent)))
@@ -278,8 +291,8 @@ def transaction_edit(tid: int):
         return redirect(url_for("finance.transactions"))
 
     patients = db.execute("SELECT id, name, cpf FROM patients ORDER BY name ASC").fetchall()
-    categories = db.execute("SELECT id, name, kind FROM categories WHERE active=1 ORDER BY name ASC").fetchall()
-    providers = db.execute("SELECT id, name, default_repasse_percent FROM providers WHERE active=1 ORDER BY name ASC").fetchall()
+    categories = active_categories(db)
+    providers = active_providers(db)
 
     if request.method == "POST":
         kind = request.form.get("kind", tx["kind"])
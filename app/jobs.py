@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Fila de tarefas em segundo plano guardada no próprio SQLite (tabela jobs).
+
+- enqueue() só faz um INSERT: o chamador grava a tarefa na mesma transação dos
+  dados locais e faz o commit (se der rollback, a tarefa some junto).
+- Uma thread por processo (start_worker) pega a próxima tarefa com um UPDATE
+  atômico, faz commit e só então chama o handler — nada de lock de escrita
+  durante chamadas de rede.
+- Erros temporários voltam para a fila com backoff; os demais (ou depois de
+  max_attempts) marcam a tarefa como failed e chamam on_fail do handler.
+  Exceções com `defer_seconds` (ex.: Asaas indisponível) só adiam a tarefa,
+  sem gastar tentativa. O que o handler devolver (se não for None) fica em
+  jobs.result, em JSON, para a tela mostrar o resumo.
+- Rotinas @periodic (ex.: drenar a caixa de entrada de webhooks) rodam a cada
+  volta do worker, antes das tarefas.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import random
+import sqlite3
+import threading
+from typing import Any, Callable
+
+from flask import Flask
+
+from .db import get_db, init_db
+
+log = logging.getLogger(__name__)
+
+POLL_SECONDS = 2.0
+STALE_MINUTES = 10          # tarefa "running" há mais tempo que isso = processo morreu
+DONE_RETENTION_DAYS = 7
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 600
+
+Handler = Callable[[sqlite3.Connection, dict[str, Any]], Any]
+FailHook = Callable[[sqlite3.Connection, dict[str, Any], str], None]
+
+_handlers: dict[str, tuple[Handler, FailHook | None]] = {}
+_periodic: list[Callable[[sqlite3.Connection], Any]] = []
+_wakeup = threading.Event()
+_worker_started = False
+_worker_lock = threading.Lock()
+
+
+class RetryLater(Exception):
+    """Levante no handler para reagendar a tarefa sem contar como erro definitivo."""
+
+
+def job_handler(kind: str, *, on_fail: FailHook | None = None) -> Callable[[Handler], Handler]:
+    def deco(fn: Handler) -> Handler:
+        _handlers[kind] = (fn, on_fail)
+        return fn
+    return deco
+
+
+def periodic(fn: Callable[[sqlite3.Connection], Any]) -> Callable[[sqlite3.Connection], Any]:
+    """Registra uma rotina chamada a cada volta do worker (deve ser rápida e idempotente)."""
+    _periodic.append(fn)
+    return fn
+
+
+def enqueue(db: sqlite3.Connection, kind: str, payload: dict[str, Any], *, delay_seconds: int = 0, max_attempts: int = 5) -> int:
+    """Grava a tarefa (sem commit)."""
+    cur = db.execute(
+        "INSERT INTO jobs(kind, payload, max_attempts, run_after) VALUES(?,?,?, datetime('now', ?))",
+        (kind, json.dumps(payload, ensure_ascii=False), max_attempts, f"+{int(delay_seconds)} seconds"),
+    )
+    return int(cur.lastrowid)
+
+
+def notify() -> None:
+    """Acorda a thread deste processo (chamar depois do commit)."""
+    _wakeup.set()
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, (RetryLater, sqlite3.OperationalError)):
+        return True
+    return bool(getattr(e, "retryable", False))
+
+
+def _claim(db: sqlite3.Connection) -> sqlite3.Row | None:
+    row = db.execute(
+        "UPDATE jobs SET status='running', attempts=attempts+1, locked_at=datetime('now'), updated_at=datetime('now') "
+        "WHERE id = (SELECT id FROM jobs WHERE status='queued' AND run_after <= datetime('now') ORDER BY run_after, id LIMIT 1) "
+        "RETURNING *"
+    ).fetchone()
+    db.commit()
+    return row
+
+
+def run_job(db: sqlite3.Connection, job: sqlite3.Row) -> bool:
+    """Executa uma tarefa já reservada. Retorna True se concluiu."""
+    payload = json.loads(job["payload"] or "{}")
+    handler, on_fail = _handlers.get(job["kind"], (None, None))
+    try:
+        if handler is None:
+            raise RuntimeError(f"tarefa sem handler: {job['kind']}")
+        result = handler(db, payload)
+        db.execute(
+            "UPDATE jobs SET status='done', last_error=NULL, result=?, updated_at=datetime('now') WHERE id=?",
+            (None if result is None else json.dumps(result, ensure_ascii=False), job["id"]),
+        )
+        db.commit()
+        return True
+    except Exception as e:
+        try:
+            db.rollback()
+        except Exception:
+            pass
+        err = str(e)[:1000] or e.__class__.__name__
+        defer = getattr(e, "defer_seconds", None)
+        if defer is not None:
+            # serviço externo fora (ex.: circuito do Asaas aberto): espera sem gastar tentativa
+            db.execute(
+                "UPDATE jobs SET status='queued', attempts=attempts-1, last_error=?, run_after=datetime('now', ?), "
+                "updated_at=datetime('now') WHERE id=?",
+                (err, f"+{int(defer)} seconds", job["id"]),
+            )
+            db.commit()
+            return False
+        if _is_retryable(e) and job["attempts"] < job["max_attempts"]:
+            delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** (job["attempts"] - 1)))
+            delay = int(delay * random.uniform(0.5, 1.0))
+            db.execute(
+                "UPDATE jobs SET status='queued', last_error=?, run_after=datetime('now', ?), updated_at=datetime('now') WHERE id=?",
+                (err, f"+{delay} seconds", job["id"]),
+            )
+            db.commit()
+            return False
+        log.warning("tarefa %s (%s) falhou: %s", job["id"], job["kind"], err)
+        db.execute("UPDATE jobs SET status='failed', last_error=?, updated_at=datetime('now') WHERE id=?", (err, job["id"]))
+        db.commit()
+        if on_fail is not None:
+            try:
+                on_fail(db, payload, err)
+                db.commit()
+            except Exception:
+                db.rollback()
+                log.exception("on_fail da tarefa %s", job["id"])
+        return False
+
+
+def run_pending(db: sqlite3.Connection, *, limit: int = 50) -> int:
+    """Processa até `limit` tarefas prontas. Retorna quantas foram pegas."""
+    n = 0
+    while n < limit:
+        job = _claim(db)
+        if job is None:
+            break
+        run_job(db, job)
+        n += 1
+    return n
+
+
+def _housekeeping(db: sqlite3.Connection) -> None:
+    db.execute(
+        "UPDATE jobs SET status='queued', updated_at=datetime('now') WHERE status='running' AND locked_at < datetime('now', ?)",
+        (f"-{STALE_MINUTES} minutes",),
+    )
+    db.execute(
+        "DELETE FROM jobs WHERE status='done' AND updated_at < datetime('now', ?)",
+        (f"-{DONE_RETENTION_DAYS} days",),
+    )
+    db.commit()
+
+
+def _worker_loop(app: Flask) -> None:
+    with app.app_context():
+        init_db()
+    ticks = 0
+    while True:
+        try:
+            with app.app_context():
+                db = get_db()
+                if ticks % 300 == 0:
+                    _housekeeping(db)
+                for fn in _periodic:
+                    try:
+                        fn(db)
+                    except Exception:
+                        db.rollback()
+                        log.exception("rotina periódica %s", getattr(fn, "__name__", fn))
+                run_pending(db)
+        except Exception:
+            log.exception("worker de tarefas")
+        ticks += 1
+        _wakeup.wait(POLL_SECONDS)
+        _wakeup.clear()
+
+
+def start_worker(app: Flask) -> None:
+    """Sobe a thread de tarefas deste processo (uma só, mesmo com vários create_app)."""
+    global _worker_started
+    with _worker_lock:
+        if _worker_started:
+            return
+        _worker_started = True
+    threading.Thread(target=_worker_loop, args=(app,), name="jobs-worker", daemon=True).start()
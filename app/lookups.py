@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Tabelas pequenas que quase nunca mudam (categorias, profissionais, app_settings).
+
+Ficam em memória em cada worker via cached_by_version: cada acesso custa uma
+leitura na PK de data_versions e só recarrega quando alguma escrita (de
+qualquer processo) incrementou a versão da tabela.
+Os valores devolvidos são compartilhados entre requisições: não altere.
+"""
+from __future__ import annotations
+
+from typing import Any
+
+from .db import cached_by_version
+
+
+def _categories(db) -> dict[str, Any]:
+    rows = [dict(r) for r in db.execute("SELECT * FROM categories ORDER BY name ASC")]
+    return {
+        "active": [r for r in rows if r["active"]],
+        "by_name": {r["name"]: int(r["id"]) for r in rows},
+    }
+
+
+def _providers(db) -> dict[str, Any]:
+    rows = [dict(r) for r in db.execute("SELECT * FROM providers ORDER BY name ASC")]
+    return {
+        "active": [r for r in rows if r["active"]],
+        "repasse": {int(r["id"]): max(0, min(100, int(r["default_repasse_percent"] or 0))) for r in rows},
+    }
+
+
+def active_categories(db) -> list[dict[str, Any]]:
+    """Categorias ativas, por nome (mesmo resultado de SELECT * ... WHERE active=1 ORDER BY name)."""
+    return cached_by_version(db, ("categories",), "categories", lambda: _categories(db))["active"]
+
+
+def category_id(db, name: str, kind: str = "income") -> int | None:
+    """id da categoria pelo nome; cria se não existir (sem commit: entra na transação de quem chamou)."""
+    if not name:
+        return None
+    found = cached_by_version(db, ("categories",), "categories", lambda: _categories(db))["by_name"].get(name)
+    if found is not None:
+        return found
+    db.execute("INSERT OR IGNORE INTO categories(name, kind, active) VALUES(?, ?, 1)", (name, kind))
+    row = db.execute("SELECT id FROM categories WHERE name=? LIMIT 1", (name,)).fetchone()
+    return int(row["id"]) if row else None
+
+
+def active_providers(db) -> list[dict[str, Any]]:
+    """Profissionais ativos, por nome."""
+    return cached_by_version(db, ("providers",), "providers", lambda: _providers(db))["active"]
+
+
+def provider_repasse(db, provider_id: int | None) -> int:
+    """Repasse padrão (%) do profissional (0 se não houver)."""
+    if not provider_id:
+        return 0
+    return cached_by_version(db, ("providers",), "providers", lambda: _providers(db))["repasse"].get(int(provider_id), 0)
+
+
+def get_setting(db, key: str, default: str = "") -> str:
+    settings = cached_by_version(
+        db, ("app_settings",), "app_settings",
+        lambda: {r["key"]: r["value"] for r in db.execute("SELECT key, value FROM app_settings")},
+    )
+    value = settings.get(key)
+    return value if value is not None else default
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+from calendar import monthrange
 from datetime import datetime, timedelta, date
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from urllib.parse import quote
+
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash
 
 from .auth import login_required
-from .db import get_db, get_open_cash_session_id
+from .db import cached_by_version, get_db, get_open_cash_session_id
+from .lookups import active_providers, category_id, provider_repasse
 from .utils import parse_brl_to_cents, cents_to_brl, today_yyyy_mm_dd
 
 bp = Blueprint("ortho", __name__, url_prefix="/ortho")
@@ -49,13 +53,9 @@ def _to_sql_datetime(d: str | None, t: str | None) -> str | None:
 
 def _get_or_create_category_id(db, name: str = "Ortodontia") -> int | None:
     """Garante categoria de entrada para lançamentos de ortodontia."""
-    if not name:
-        return None
+    # sem commit (entra na transação de quem chamou) e sem INSERT se já existir (cache por versão)
     try:
-        db.execute("INSERT OR IGNORE INTO categories(name, kind, active) VALUES(?, 'income', 1)", (name,))
-        db.commit()
-        row = db.execute("SELECT id FROM categories WHERE name=? LIMIT 1", (name,)).fetchone()
-        return int(row["id"]) if row else None
+        return category_id(db, name)
     except Exception:
         return None
 
@@ -82,14 +82,7 @@ def _create_finance_tx(
 
     # Categoria e repasse
     category_id = _get_or_create_category_id(db, "Ortodontia")
-    repasse_percent = 0
-    if provider_id:
-        pr = db.execute("SELECT default_repasse_percent FROM providers WHERE id=? LIMIT 1", (provider_id,)).fetchone()
-        if pr:
-            try:
-                repasse_percent = int(pr["default_repasse_percent"] or 0)
-            except Exception:
-                repasse_percent = 0
+    repasse_percent = provider_repasse(db, provider_id)
 
     desc = "Ortodontia • Manutenção"
     md = (maintenance_done or "").strip()
@@ -125,62 +118,121 @@ def _create_next_appointment(db, *, patient_id: int, provider_id: int | None, ne
 
     title = "Manutenção ortodôntica"
     db.execute(
-        "INSERT INTO appointments(patient_id, provider_id, title, start_at, end_at, note) VALUES(?,?,?,?,?,?)",
+        "INSERT INTO appointments(patient_id, provider_id, title, start_at, end_at, note, updated_at) VALUES(?,?,?,?,?,?, datetime('now'))",
         (patient_id, provider_id, title, start_at, end_at, (note or "").strip() or None),
     )
     appt_id = db.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
     return int(appt_id) if appt_id is not None else None
 
 
+ORTHO_PAGE_SIZE = 50
+
+
+def _parse_cursor(raw: str | None) -> tuple[str, int] | None:
+    """Cursor da paginação: "<valor>|<id>" do último item da página anterior."""
+    val, _, rid = (raw or "").rpartition("|")
+    return (val, int(rid)) if rid.isdigit() else None
+
+
 @bp.get("/")
 @login_required
 def list_ortho():
+    """Manutenções (mais recentes primeiro) ou um resumo por paciente (view=patients).
+
+    Paginação por keyset (data+id / nome+id): cada página é uma busca no índice,
+    sem OFFSET e sem limite fixo que esconda os registros antigos.
+    """
     db = get_db()
+    view = "patients" if request.args.get("view") == "patients" else "list"
     q = (request.args.get("q") or "").strip()
     patient_id = (request.args.get("patient_id") or "").strip()
     provider_id = (request.args.get("provider_id") or "").strip()
     pay_status = (request.args.get("status") or "").strip()  # paid|pending|''
+    cursor = _parse_cursor(request.args.get("after"))
 
     where = []
     params = []
-    if q:
-        where.append("(p.name LIKE ? OR p.cpf LIKE ? OR o.maintenance_done LIKE ?)")
-        params.extend([f"%{q}%", f"%{q}%", f"%{q}%"])
-    if patient_id.isdigit():
-        where.append("o.patient_id=?")
-        params.append(int(patient_id))
-    if provider_id.isdigit():
-        where.append("o.provider_id=?")
-        params.append(int(provider_id))
-    if pay_status in ("paid", "pending"):
-        where.append("o.payment_status=?")
-        params.append(pay_status)
-
-    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
-    rows = db.execute(
-        f"""
-        SELECT o.*,
-               p.name AS patient_name, p.cpf AS patient_cpf,
-               pr.name AS provider_name
-          FROM ortho_maintenances o
-          JOIN patients p ON p.id=o.patient_id
-          LEFT JOIN providers pr ON pr.id=o.provider_id
-          {where_sql}
-         ORDER BY o.maintenance_date DESC, o.id DESC
-         LIMIT 400
-        """,
-        tuple(params),
-    ).fetchall()
+    if view == "patients":
+        if q:
+            where.append("(p.name LIKE ? OR p.cpf LIKE ?)")
+            params.extend([f"%{q}%", f"%{q}%"])
+        if patient_id.isdigit():
+            where.append("s.patient_id=?")
+            params.append(int(patient_id))
+        if pay_status == "pending":
+            where.append("s.pending_cents > 0")
+        elif pay_status == "paid":
+            where.append("s.pending_cents = 0")
+        if cursor:
+            where.append("(p.name COLLATE NOCASE, p.id) > (?, ?)")
+            params.extend(cursor)
+        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+        rows = db.execute(
+            f"""
+            SELECT s.*, p.id AS patient_id, p.name AS patient_name, p.cpf AS patient_cpf, p.is_ortho,
+                   pr.name AS provider_name
+              FROM ortho_patient_summary s
+              JOIN patients p ON p.id=s.patient_id
+              LEFT JOIN ortho_maintenances l ON l.id=s.last_id
+              LEFT JOIN providers pr ON pr.id=l.provider_id
+              {where_sql}
+             ORDER BY p.name COLLATE NOCASE, p.id
+             LIMIT ?
+            """,
+            (*params, ORTHO_PAGE_SIZE + 1),
+        ).fetchall()
+    else:
+        if q:
+            where.append("(p.name LIKE ? OR p.cpf LIKE ? OR o.maintenance_done LIKE ?)")
+            params.extend([f"%{q}%", f"%{q}%", f"%{q}%"])
+        if patient_id.isdigit():
+            where.append("o.patient_id=?")
+            params.append(int(patient_id))
+        if provider_id.isdigit():
+            where.append("o.provider_id=?")
+            params.append(int(provider_id))
+        if pay_status in ("paid", "pending"):
+            where.append("o.payment_status=?")
+            params.append(pay_status)
+        if cursor:
+            where.append("(o.maintenance_date, o.id) < (?, ?)")
+            params.extend(cursor)
+        where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+        rows = db.execute(
+            f"""
+            SELECT o.*,
+                   p.name AS patient_name, p.cpf AS patient_cpf,
+                   pr.name AS provider_name
+              FROM ortho_maintenances o
+              JOIN patients p ON p.id=o.patient_id
+              LEFT JOIN providers pr ON pr.id=o.provider_id
+              {where_sql}
+             ORDER BY o.maintenance_date DESC, o.id DESC
+             LIMIT ?
+            """,
+            (*params, ORTHO_PAGE_SIZE + 1),
+        ).fetchall()
+
+    next_after = None
+    if len(rows) > ORTHO_PAGE_SIZE:
+        rows = rows[:ORTHO_PAGE_SIZE]
+        last = rows[-1]
+        next_after = f"{last['patient_name']}|{last['patient_id']}" if view == "patients" else f"{last['maintenance_date']}|{last['id']}"
 
     patients = db.execute("SELECT id, name, cpf FROM patients ORDER BY name ASC").fetchall()
-    providers = db.execute("SELECT id, name FROM providers WHERE active=1 ORDER BY name ASC").fetchall()
+    providers = active_providers(db)
 
     return render_template(
         "ortho_list.html",
         rows=rows,
+        view=view,
+        next_after=next_after,
+        is_first_page=cursor is None,
+        page_size=ORTHO_PAGE_SIZE,
         patients=patients,
         providers=providers,
         cents_to_brl=cents_to_brl,
+        today=today_yyyy_mm_dd(),
         filters=dict(q=q, patient_id=patient_id, provider_id=provider_id, status=pay_status),
     )
 
@@ -189,7 +241,7 @@ def list_ortho():
 def new_ortho():
     db = get_db()
     patients = db.execute("SELECT id, name, cpf FROM patients ORDER BY name ASC").fetchall()
-    providers = db.execute("SELECT id, name FROM providers WHERE active=1 ORDER BY name ASC").fetchall()
+    providers = active_providers(db)
     patient_prefill = request.args.get("patient_id", "").strip()
 
     if request.method == "POST":
@@ -305,7 +357,7 @@ def edit_ortho(oid: int):
         return redirect(url_for("ortho.list_ortho"))
 
     patients = db.execute("SELECT id, name, cpf FROM patients ORDER BY name ASC").fetchall()
-    providers = db.execute("SELECT id, name FROM providers WHERE active=1 ORDER BY name ASC").fetchall()
+    providers = active_providers(db)
 
     if request.method == "POST":
         provider_id = _safe_int(request.form.get("provider_id"))
@@ -456,3 +508,210 @@ def confirm_payment(oid: int):
         flash(f"Erro ao confirmar pagamento: {e}", "danger")
 
     return redirect(url_for("ortho.list_ortho", patient_id=item["patient_id"]))
+
+
+# =========================
+# Cobrança mensal (todos os pacientes de ortodontia)
+# =========================
+
+def _billing_candidates(db, month: str, due_day: int) -> list[dict]:
+    """Pacientes is_ortho=1 com a última manutenção (valor/profissional/método) e se o mês já foi cobrado."""
+    y, m = (int(x) for x in month.split("-"))
+    first, last = f"{month}-01", f"{month}-{monthrange(y, m)[1]:02d}"
+    due = f"{month}-{min(due_day, monthrange(y, m)[1]):02d}"
+    rows = db.execute(
+        """
+        SELECT p.id AS patient_id, p.name AS patient_name,
+               o.id AS last_id, o.maintenance_date AS last_date, o.provider_id, o.amount_cents, o.payment_method,
+               pr.name AS provider_name, COALESCE(pr.default_repasse_percent, 0) AS repasse_percent,
+               EXISTS(
+                   SELECT 1 FROM ortho_maintenances x
+                    WHERE x.patient_id = p.id
+                      AND (x.billing_month = ? OR x.maintenance_date BETWEEN ? AND ?)
+               ) AS already
+          FROM patients p
+          LEFT JOIN ortho_maintenances o ON o.id = (
+               SELECT id FROM ortho_maintenances WHERE patient_id = p.id ORDER BY maintenance_date DESC, id DESC LIMIT 1
+          )
+          LEFT JOIN providers pr ON pr.id = o.provider_id
+         WHERE p.is_ortho = 1
+         ORDER BY p.name COLLATE NOCASE
+        """,
+        (month, first, last),
+    ).fetchall()
+    out = []
+    for r in rows:
+        d = dict(r) | {"due_date": due}
+        if d["already"]:
+            d["skip"] = "já cobrado/atendido neste mês"
+        elif not d["last_id"]:
+            d["skip"] = "sem manutenção anterior"
+        elif int(d["amount_cents"] or 0) <= 0:
+            d["skip"] = "última manutenção sem valor"
+        else:
+            d["skip"] = None
+        out.append(d)
+    return out
+
+
+@bp.route("/billing", methods=["GET", "POST"])
+@login_required
+def billing_run():
+    """Gera as manutenções do mês (pendentes) + lançamentos a receber de todos os pacientes de orto.
+
+    GET = prévia (nada é gravado). POST grava tudo numa transação (lançamentos com
+    RETURNING id, manutenções com executemany); a prévia é recalculada dentro da transação e o índice único (paciente, mês)
+    garante que rodar de novo não duplica.
+    """
+    db = get_db()
+    month = (request.values.get("month") or today_yyyy_mm_dd()[:7]).strip()
+    due_day = _safe_int(request.values.get("due_day")) or 10
+    try:
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        flash("Mês inválido.", "danger")
+        month = today_yyyy_mm_dd()[:7]
+    due_day = max(1, min(31, due_day))
+    label = f"{month[5:7]}/{month[:4]}"
+
+    if request.method == "POST":
+        if db.in_transaction:
+            db.commit()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            todo = [c for c in _billing_candidates(db, month, due_day) if not c["skip"]]
+            if todo:
+                category_id = _get_or_create_category_id(db, "Ortodontia")
+                desc = f"Ortodontia • Manutenção mensal {label}"
+                # cada manutenção aponta para o lançamento devolvido pelo próprio INSERT
+                tx_ids = [
+                    int(db.execute(
+                        "INSERT INTO transactions(kind,status,date,due_date,amount_cents,payment_method,description,patient_id,category_id,provider_id,repasse_percent) "
+                        "VALUES('income','pending',?,?,?,?,?,?,?,?,?) RETURNING id",
+                        (c["due_date"], c["due_date"], int(c["amount_cents"]), c["payment_method"] or "pix", desc,
+                         c["patient_id"], category_id, c["provider_id"], int(c["repasse_percent"] or 0)),
+                    ).fetchone()[0])
+                    for c in todo
+                ]
+                db.executemany(
+                    "INSERT INTO ortho_maintenances(patient_id, provider_id, maintenance_date, maintenance_done, amount_cents, "
+                    "payment_status, payment_method, due_date, finance_tx_id, billing_month) "
+                    "VALUES(?,?,?,?,?,'pending',?,?,?,?)",
+                    [
+                        (c["patient_id"], c["provider_id"], c["due_date"], f"Manutenção mensal {label}", int(c["amount_cents"]),
+                         c["payment_method"] or "pix", c["due_date"], tx_id, month)
+                        for tx_id, c in zip(tx_ids, todo)
+                    ],
+                )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            flash(f"Erro ao gerar a cobrança do mês: {e}", "danger")
+            return redirect(url_for("ortho.billing_run", month=month, due_day=due_day))
+        if todo:
+            total = sum(int(c["amount_cents"]) for c in todo)
+            flash(f"Cobrança de {label} gerada: {len(todo)} paciente(s), R$ {cents_to_brl(total)} a receber ✅", "success")
+        else:
+            flash(f"Nada a gerar em {label}: todos já foram cobrados.", "info")
+        return redirect(url_for("ortho.billing_run", month=month, due_day=due_day))
+
+    rows = _billing_candidates(db, month, due_day)
+    todo = [r for r in rows if not r["skip"]]
+    return render_template(
+        "ortho_billing.html",
+        rows=rows,
+        month=month,
+        due_day=due_day,
+        label=label,
+        todo_count=len(todo),
+        todo_total=sum(int(r["amount_cents"]) for r in todo),
+        cents_to_brl=cents_to_brl,
+    )
+
+
+# =========================
+# Atrasados: retorno vencido e pagamento vencido
+# =========================
+
+def _wa_link(phone: str | None, msg: str) -> str:
+    digits = "".join(ch for ch in (phone or "") if ch.isdigit())
+    if digits and not digits.startswith("55"):
+        digits = "55" + digits
+    return f"https://wa.me/{digits}?text={quote(msg)}" if digits else ""
+
+
+def _overdue_tracker(db, today: str) -> dict:
+    """Listas do coordenador de orto, só com consultas no banco (índices + NOT EXISTS).
+
+    - retorno vencido: next_date da ÚLTIMA manutenção já passou (idx_ortho_next) e
+      não há agendamento válido depois dela (idx_appt_patient_start). As linhas da
+      cobrança mensal (billing_month) não contam como manutenção atendida;
+    - pagamento vencido: manutenções pendentes com vencimento passado (idx_ortho_pay),
+      cujo lançamento ainda não foi pago no Financeiro, agrupadas por paciente.
+    """
+    clinica = current_app.config.get("CLINIC_NAME", "NewClínica")
+    returns = []
+    for r in db.execute(
+        """
+        SELECT o.patient_id, p.name AS patient_name, p.phone AS patient_phone,
+               o.maintenance_date AS last_date, o.next_date, o.next_time, pr.name AS provider_name,
+               CAST(julianday(?) - julianday(o.next_date) AS INTEGER) AS days_late
+          FROM ortho_maintenances o
+          JOIN patients p ON p.id = o.patient_id AND p.is_ortho = 1
+          LEFT JOIN providers pr ON pr.id = o.provider_id
+         WHERE o.next_date < ? AND o.next_date <> ''
+           AND NOT EXISTS (
+               SELECT 1 FROM ortho_maintenances x
+                WHERE x.patient_id = o.patient_id AND x.billing_month IS NULL
+                  AND (x.maintenance_date > o.maintenance_date OR (x.maintenance_date = o.maintenance_date AND x.id > o.id))
+           )
+           AND NOT EXISTS (
+               SELECT 1 FROM appointments a
+                WHERE a.patient_id = o.patient_id AND a.start_at >= o.next_date
+                  AND a.status NOT IN ('cancelled', 'no_show')
+           )
+         ORDER BY o.next_date, o.patient_id
+        """,
+        (today, today),
+    ):
+        msg = f"Olá {r['patient_name']}! Sua manutenção ortodôntica na {clinica} está pendente. Vamos agendar?"
+        returns.append(dict(r) | {"wa_link": _wa_link(r["patient_phone"], msg)})
+
+    payments = []
+    for r in db.execute(
+        """
+        SELECT o.patient_id, p.name AS patient_name, p.phone AS patient_phone,
+               COUNT(*) AS n, SUM(o.amount_cents) AS total_cents, MIN(o.due_date) AS oldest_due,
+               CAST(julianday(?) - julianday(MIN(o.due_date)) AS INTEGER) AS days_late
+          FROM ortho_maintenances o
+          JOIN patients p ON p.id = o.patient_id
+         WHERE o.payment_status = 'pending' AND o.due_date < ? AND o.amount_cents > 0
+           AND NOT EXISTS (SELECT 1 FROM transactions t WHERE t.id = o.finance_tx_id AND t.status = 'paid')
+         GROUP BY o.patient_id
+         ORDER BY oldest_due, o.patient_id
+        """,
+        (today, today),
+    ):
+        msg = f"Olá {r['patient_name']}! Consta em aberto na {clinica} a manutenção ortodôntica com vencimento em {r['oldest_due']}."
+        payments.append(dict(r) | {"wa_link": _wa_link(r["patient_phone"], msg)})
+
+    return {
+        "returns": returns,
+        "payments": payments,
+        "payments_total": sum(int(r["total_cents"] or 0) for r in payments),
+    }
+
+
+@bp.get("/tracker")
+@login_required
+def tracker():
+    """Retornos e pagamentos de ortodontia atrasados (cache por versão dos dados)."""
+    db = get_db()
+    today = today_yyyy_mm_dd()
+    data = cached_by_version(
+        db,
+        ("ortho_maintenances", "appointments", "patients", "transactions"),
+        ("ortho_tracker", today),
+        lambda: _overdue_tracker(db, today),
+    )
+    return render_template("ortho_tracker.html", today=today, cents_to_brl=cents_to_brl, **data)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Cabeçalho do paciente (linha de patients) em um LRU pequeno por worker.
+
+Telas de impressão/visualização (orçamento, ficha, anamnese, documentos) e a
+emissão de boleto só precisam do cadastro do paciente + um registro. Com o
+cabeçalho em cache, uma leva de impressões do dia vai ao banco uma vez por
+paciente; no primeiro acesso paciente e registro vêm numa consulta só.
+
+Invalidação: forget_patient() nas edições deste processo e, para os outros
+workers, a versão de "patients" em data_versions (qualquer escrita limpa o LRU).
+A versão só é adotada fora de transação: com escrita pendente na conexão ela
+pode ser de um bump não commitado, então o LRU só é usado se a versão bater.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any
+
+from .db import data_version
+
+PATIENT_CACHE_MAX = 512
+
+_lru: OrderedDict[int, dict[str, Any]] = OrderedDict()
+_lru_version: tuple[int, ...] | None = None
+_lru_lock = threading.Lock()
+
+# tabelas de detalhe que podem ser buscadas junto com o paciente
+DETAIL_TABLES = {"budgets", "clinical_records", "anamnesis", "patient_documents"}
+
+
+def _check_version(db) -> tuple[int, ...]:
+    global _lru_version
+    version = data_version(db, "patients")
+    if db.in_transaction:
+        # pode ser um bump não commitado: não troca a do LRU (_get/_put só usam se bater)
+        return version
+    with _lru_lock:
+        if version != _lru_version:
+            _lru.clear()
+            _lru_version = version
+    return version
+
+
+def _get(version: tuple[int, ...], pid: int) -> dict[str, Any] | None:
+    with _lru_lock:
+        if version != _lru_version:
+            return None
+        hit = _lru.get(pid)
+        if hit is not None:
+            _lru.move_to_end(pid)
+        return hit
+
+
+def _put(version: tuple[int, ...], pid: int, row: dict[str, Any]) -> None:
+    with _lru_lock:
+        if version != _lru_version:
+            return  # alguém gravou no meio: não guarda dado que pode estar velho
+        _lru[pid] = row
+        _lru.move_to_end(pid)
+        while len(_lru) > PATIENT_CACHE_MAX:
+            _lru.popitem(last=False)
+
+
+def forget_patient(pid: int | None = None) -> None:
+    """Tira um paciente (ou todos) do cache deste worker."""
+    with _lru_lock:
+        if pid is None:
+            _lru.clear()
+        else:
+            _lru.pop(int(pid), None)
+
+
+def patient_header(db, pid: int) -> dict[str, Any] | None:
+    """Linha de patients (dict; não altere) ou None."""
+    version = _check_version(db)
+    hit = _get(version, pid)
+    if hit is not None:
+        return hit
+    row = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
+    if row is None:
+        return None
+    header = dict(row)
+    _put(version, pid, header)
+    return header
+
+
+def patient_with(db, pid: int, table: str, row_id: int) -> tuple[dict[str, Any] | None, Any]:
+    """(paciente, registro de `table` daquele paciente). Qualquer um pode vir None.
+
+    Com o paciente em cache é só a busca do registro; sem, uma consulta traz os dois.
+    """
+    if table not in DETAIL_TABLES:
+        raise ValueError(table)
+    version = _check_version(db)
+    header = _get(version, pid)
+    if header is not None:
+        detail = db.execute(f"SELECT * FROM {table} WHERE id=? AND patient_id=?", (row_id, pid)).fetchone()
+        return header, detail
+
+    cur = db.execute(
+        f"SELECT p.*, NULL AS __split__, d.* FROM patients p "
+        f"LEFT JOIN {table} d ON d.id=? AND d.patient_id=p.id WHERE p.id=?",
+        (row_id, pid),
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None, None
+    names = [c[0] for c in cur.description]
+    k = names.index("__split__")
+    header = dict(zip(names[:k], row[:k]))
+    _put(version, pid, header)
+    detail = dict(zip(names[k + 1:], row[k + 1:]))
+    return header, (detail if detail.get("id") is not None else None)
@@ -5,10 +5,17 @@ from datetime import datetime, timedelta
 from typing import Any
 import re
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, jsonify
+from .agenda import APPT_STATUS_LABELS
+from .asaas_customers import cpf_problem, enqueue_customer_sync
+from .asaas_sync import last_refresh
 from .auth import login_required
 from .db import get_db
-from .utils import cents_to_brl, parse_brl_to_cents
+from .jobs import notify
+from .lookups import active_categories, active_providers
+from .patient_cache import forget_patient, patient_header, patient_with
+from .utils import cents_to_brl, digits_only, parse_brl_to_cents, today_yyyy_mm_dd
+from .waitlist import offer_freed_slot
 
 bp = Blueprint("patients", __name__, url_prefix="/patients")
 
@@ -156,6 +163,14 @@ Profissional responsável: _______________________________
 """
 
 
+def _queue_asaas_customer(db, pid: int, cpf: str) -> bool:
+    """Com Asaas configurado e CPF válido, já agenda o cliente no Asaas (sem commit)."""
+    if not (current_app.config.get("ASAAS_API_KEY") or "").strip() or cpf_problem({"cpf": cpf}):
+        return False
+    enqueue_customer_sync(db, [pid])
+    return True
+
+
 def _parse_date_input(s: str | None) -> str | None:
     """Aceita 'YYYY-MM-DD' (input type=date) ou 'dd/mm/aaaa' e retorna 'YYYY-MM-DD'."""
     if not s:
@@ -180,14 +195,19 @@ def _parse_date_input(s: str | None) -> str | None:
 def list_patients():
     q = request.args.get("q", "").strip()
     db = get_db()
+    # saldo já vem pronto de patient_balances (mantido pelas triggers)
+    sql = (
+        "SELECT p.*, b.pending_cents, b.overdue_cents, b.oldest_due FROM patients p "
+        "LEFT JOIN patient_balances b ON b.patient_id=p.id"
+    )
     if q:
         rows = db.execute(
-            "SELECT * FROM patients WHERE name LIKE ? OR cpf LIKE ? ORDER BY name ASC",
+            sql + " WHERE p.name LIKE ? OR p.cpf LIKE ? ORDER BY p.name ASC",
             (f"%{q}%", f"%{q}%"),
         ).fetchall()
     else:
-        rows = db.execute("SELECT * FROM patients ORDER BY name ASC").fetchall()
-    return render_template("patients_list.html", patients=rows, q=q)
+        rows = db.execute(sql + " ORDER BY p.name ASC").fetchall()
+    return render_template("patients_list.html", patients=rows, q=q, cents_to_brl=cents_to_brl, today=today_yyyy_mm_dd())
 
 
 @bp.route("/new", methods=["GET", "POST"])
@@ -205,11 +225,14 @@ def new_patient():
         birth_date = request.form.get("birth_date", "").strip() or None
         notes = request.form.get("notes", "").strip()
         db = get_db()
-        db.execute(
+        cur = db.execute(
             "INSERT INTO patients(name, phone, cpf, address, is_ortho, birth_date, notes) VALUES(?,?,?,?,?,?,?)",
             (name, phone, cpf, address, is_ortho, birth_date, notes),
         )
+        queued = _queue_asaas_customer(db, int(cur.lastrowid), cpf)
         db.commit()
+        if queued:
+            notify()
         flash("Paciente cadastrado ✅", "success")
         return redirect(url_for("patients.list_patients"))
     return render_template("patient_form.html", patient=None)
@@ -226,15 +249,13 @@ def view_patient(pid: int):
         tab = "orcamentos"
 
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
+    patient = patient_header(db, pid)
     if not patient:
         flash("Paciente não encontrado.", "danger")
         return redirect(url_for("patients.list_patients"))
 
     # Profissionais
-    providers = db.execute(
-        "SELECT * FROM providers WHERE active=1 ORDER BY name ASC"
-    ).fetchall()
+    providers = active_providers(db)
 
     # Orçamentos
     budgets = db.execute(
@@ -295,6 +316,8 @@ def view_patient(pid: int):
         ).fetchall()
         mapa = {row["tooth"]: row["status"] for row in odontos}
 
+    balance = db.execute("SELECT * FROM patient_balances WHERE patient_id=?", (pid,)).fetchone()
+
     # Últimos lançamentos do paciente (resuminho no topo)
     tx = db.execute(
         "SELECT t.*, c.name AS category_name FROM transactions t "
@@ -306,7 +329,9 @@ def view_patient(pid: int):
     # Boletos (carrega quando precisa)
     boletos = []
     categories = []
+    refresh_job = None
     if tab == "boletos":
+        refresh_job = last_refresh(db, pid)
         boletos = db.execute(
             "SELECT b.*, pr.name AS provider_name, c.name AS category_name, t.status AS finance_status "
             "FROM boletos b "
@@ -316,7 +341,7 @@ def view_patient(pid: int):
             "WHERE b.patient_id=? ORDER BY b.id DESC",
             (pid,),
         ).fetchall()
-        categories = db.execute("SELECT id, name FROM categories WHERE active=1 ORDER BY name ASC").fetchall()
+        categories = active_categories(db)
 
     # Contratos e termos (carrega quando precisa)
     documents = []
@@ -348,10 +373,14 @@ def view_patient(pid: int):
         odontos=odontos,
         mapa=mapa,
         tx=tx,
+        balance=balance,
+        today=today_yyyy_mm_dd(),
         boletos=boletos,
+        refresh_job=refresh_job,
         documents=documents,
         doc_defaults=doc_defaults,
         doc_type_label=_doc_type_label,
+        appt_status_labels=APPT_STATUS_LABELS,
         cents_to_brl=cents_to_brl,
         sql_to_br=_sql_to_br,
     )
@@ -380,7 +409,15 @@ def edit_patient(pid: int):
             "UPDATE patients SET name=?, phone=?, cpf=?, address=?, is_ortho=?, birth_date=?, notes=? WHERE id=?",
             (name, phone, cpf, address, is_ortho, birth_date, notes, pid),
         )
+        queued = False
+        if digits_only(cpf) != digits_only(patient["cpf"]) or not patient["asaas_customer_id"]:
+            # CPF novo = outro cliente no Asaas
+            db.execute("UPDATE patients SET asaas_customer_id=NULL WHERE id=?", (pid,))
+            queued = _queue_asaas_customer(db, pid, cpf)
         db.commit()
+        forget_patient(pid)
+        if queued:
+            notify()
         flash("Paciente atualizado ✅", "success")
         return redirect(url_for("patients.view_patient", pid=pid))
     return render_template("patient_form.html", patient=patient)
@@ -393,6 +430,7 @@ def delete_patient(pid: int):
     # mantém os lançamentos (FK ON DELETE SET NULL), apenas desvincula
     db.execute("DELETE FROM patients WHERE id=?", (pid,))
     db.commit()
+    forget_patient(pid)
     flash("Paciente removido.", "info")
     return redirect(url_for("patients.list_patients"))
 
@@ -401,23 +439,67 @@ def delete_patient(pid: int):
 # Orçamentos
 # =========================
 
+def _budget_lines(form) -> tuple[list[tuple], str | None]:
+    """Itens do formulário (listas item_*) -> tuplas para budget_items, ou mensagem de erro."""
+    teeth = form.getlist("item_tooth")
+    qtys = form.getlist("item_qty")
+    prices = form.getlist("item_price")
+    discounts = form.getlist("item_discount")
+
+    def pick(values: list[str], i: int) -> str:
+        return (values[i] if i < len(values) else "") or ""
+
+    lines = []
+    for i, proc in enumerate(form.getlist("item_procedure")):
+        proc = (proc or "").strip()
+        if not proc:
+            continue
+        qty_raw = pick(qtys, i).strip()
+        qty = int(qty_raw) if qty_raw.isdigit() and int(qty_raw) > 0 else 1
+        unit = parse_brl_to_cents(pick(prices, i))
+        if unit <= 0:
+            return [], f"Valor inválido no item \"{proc}\". Ex: 150 ou 150,50."
+        discount = max(0, parse_brl_to_cents(pick(discounts, i)))
+        if discount > qty * unit:
+            return [], f"Desconto maior que o valor no item \"{proc}\"."
+        tooth = pick(teeth, i).strip()[:20] or None
+        lines.append((len(lines), tooth, proc, qty, unit, discount, qty * unit - discount))
+    return lines, None
+
+
 @bp.post("/<int:pid>/budgets/add")
 @login_required
 def budget_add(pid: int):
+    lines, error = _budget_lines(request.form)
+    if error:
+        flash(error, "danger")
+        return redirect(url_for("patients.view_patient", pid=pid, tab="orcamentos"))
     description = (request.form.get("description") or "").strip()
-    amount_raw = (request.form.get("amount") or "").strip()
+    if not lines:
+        # formulário antigo: uma descrição e um valor = orçamento de um item só
+        amount_raw = (request.form.get("amount") or "").strip()
+        if not description:
+            flash("Informe ao menos um procedimento.", "danger")
+            return redirect(url_for("patients.view_patient", pid=pid, tab="orcamentos"))
+        cents = parse_brl_to_cents(amount_raw)
+        if cents <= 0:
+            flash("Valor inválido. Ex: 150 ou 150,50.", "danger")
+            return redirect(url_for("patients.view_patient", pid=pid, tab="orcamentos"))
+        lines = [(0, None, description, 1, cents, 0, cents)]
     if not description:
-        flash("Informe a descrição do orçamento.", "danger")
-        return redirect(url_for("patients.view_patient", pid=pid, tab="orcamentos"))
-    cents = parse_brl_to_cents(amount_raw)
-    if cents <= 0:
-        flash("Valor inválido. Ex: 150 ou 150,50.", "danger")
-        return redirect(url_for("patients.view_patient", pid=pid, tab="orcamentos"))
+        description = lines[0][2] if len(lines) == 1 else f"{lines[0][2]} + {len(lines) - 1} item(ns)"
 
     db = get_db()
-    db.execute(
-        "INSERT INTO budgets(patient_id, description, amount_cents, status) VALUES(?,?,?,?)",
-        (pid, description, cents, "aberto"),
+    # totais começam em zero e as triggers de budget_items somam cada item
+    cur = db.execute(
+        "INSERT INTO budgets(patient_id, description, amount_cents, status) VALUES(?,?,0,?)",
+        (pid, description, "aberto"),
+    )
+    bid = int(cur.lastrowid)
+    db.executemany(
+        "INSERT INTO budget_items(budget_id, position, tooth, procedure, qty, unit_cents, discount_cents, total_cents) "
+        "VALUES(?,?,?,?,?,?,?,?)",
+        [(bid, *line) for line in lines],
     )
     db.commit()
     flash("Orçamento adicionado ✅", "success")
@@ -443,14 +525,27 @@ def budget_status(pid: int, bid: int, s: str):
     db.execute("UPDATE budgets SET status=? WHERE id=? AND patient_id=?", (s, bid, pid))
 
     if s == "aprovado":
-        # Evita duplicar item do plano para o mesmo orçamento
-        ex = db.execute("SELECT id FROM plan_items WHERE budget_id=?", (bid,)).fetchone()
-        if not ex:
+        if b["items_count"]:
+            # cada item vira um item do plano, num INSERT só (e nada se já foi aprovado antes)
             db.execute(
                 "INSERT INTO plan_items(patient_id, budget_id, tooth, procedure, amount_cents, done) "
-                "VALUES (?,?,?,?,?,0)",
-                (pid, bid, None, b["description"], int(b["amount_cents"])),
+                "SELECT ?, i.budget_id, i.tooth, "
+                "       CASE WHEN i.qty > 1 THEN i.procedure || ' (' || i.qty || 'x)' ELSE i.procedure END, "
+                "       i.total_cents, 0 "
+                "  FROM budget_items i "
+                " WHERE i.budget_id=? AND NOT EXISTS (SELECT 1 FROM plan_items WHERE budget_id=?) "
+                " ORDER BY i.position, i.id",
+                (pid, bid, bid),
             )
+        else:
+            # orçamento antigo, sem itens: vira um item do plano (evita duplicar)
+            ex = db.execute("SELECT id FROM plan_items WHERE budget_id=?", (bid,)).fetchone()
+            if not ex:
+                db.execute(
+                    "INSERT INTO plan_items(patient_id, budget_id, tooth, procedure, amount_cents, done) "
+                    "VALUES (?,?,?,?,?,0)",
+                    (pid, bid, None, b["description"], int(b["amount_cents"])),
+                )
 
     db.commit()
     flash("Status atualizado ✅", "success")
@@ -461,18 +556,18 @@ def budget_status(pid: int, bid: int, s: str):
 @login_required
 def budget_print(pid: int, bid: int):
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
-    budget = db.execute(
-        "SELECT * FROM budgets WHERE id=? AND patient_id=?",
-        (bid, pid),
-    ).fetchone()
+    patient, budget = patient_with(db, pid, "budgets", bid)
     if not patient or not budget:
         flash("Orçamento não encontrado.", "danger")
         return redirect(url_for("patients.view_patient", pid=pid, tab="orcamentos"))
+    items = db.execute(
+        "SELECT * FROM budget_items WHERE budget_id=? ORDER BY position, id", (bid,)
+    ).fetchall() if budget["items_count"] else []
     return render_template(
         "budget_print.html",
         patient=patient,
         budget=budget,
+        items=items,
         cents_to_brl=cents_to_brl,
         sql_to_br=_sql_to_br,
     )
@@ -603,6 +698,86 @@ def plan_step_set_done(pid: int, sid: int):
     db.commit()
     return redirect(url_for("patients.view_patient", pid=pid, tab="plano_ficha"))
 
+PLAN_BATCH_MAX = 200
+
+
+def _plan_changes(raw) -> tuple[list[tuple], str | None]:
+    """[{"id", "done", "date"}] -> [(done, done_date|None, id)] ou mensagem de erro."""
+    if raw is None:
+        return [], None
+    if not isinstance(raw, list):
+        return [], "lista inválida"
+    out = []
+    for ch in raw:
+        if not isinstance(ch, dict) or not str(ch.get("id") or "").isdigit():
+            return [], "id inválido"
+        done = 1 if ch.get("done") else 0
+        done_date = None
+        if done and ch.get("date"):
+            done_date = _parse_date_input(ch.get("date"))
+            if not done_date:
+                return [], f"data inválida: {ch.get('date')}"
+        out.append((done, done_date, int(ch["id"])))
+    return out, None
+
+
+@bp.post("/<int:pid>/plan/batch")
+@login_required
+def plan_batch(pid: int):
+    """Marca/desfaz vários procedimentos e etapas numa transação só (JSON).
+
+    Corpo: {"items": [{"id": 1, "done": true, "date": "2024-05-10"}], "steps": [{"id": 7, "done": false}]}.
+    Sem "date", marca com a data/hora de agora. Devolve o estado gravado de cada um.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"ok": False, "error": "corpo JSON deve ser um objeto"}), 400
+    items, err_items = _plan_changes(payload.get("items"))
+    steps, err_steps = _plan_changes(payload.get("steps"))
+    error = err_items or err_steps
+    if error:
+        return jsonify({"ok": False, "error": error}), 400
+    if not items and not steps:
+        return jsonify({"ok": False, "error": "nada para atualizar"}), 400
+    if len(items) + len(steps) > PLAN_BATCH_MAX:
+        return jsonify({"ok": False, "error": f"máximo de {PLAN_BATCH_MAX} alterações por envio"}), 400
+
+    db = get_db()
+    # done=0 limpa a data; done=1 usa a data informada ou agora. O filtro por paciente
+    # fica no WHERE: ids de outro paciente simplesmente não mudam (e voltam em "missing").
+    set_done = "done=?1, done_at=CASE WHEN ?1=1 THEN COALESCE(?2, datetime('now')) END"
+    db.executemany(
+        f"UPDATE plan_items SET {set_done} WHERE id=?3 AND patient_id=?4",
+        [(*ch, pid) for ch in items],
+    )
+    db.executemany(
+        f"UPDATE plan_steps SET {set_done} "
+        "WHERE id=?3 AND plan_item_id IN (SELECT id FROM plan_items WHERE patient_id=?4)",
+        [(*ch, pid) for ch in steps],
+    )
+    db.commit()
+
+    def state(table: str, ids: list[int], where: str) -> list[dict]:
+        if not ids:
+            return []
+        rows = db.execute(
+            f"SELECT t.id, t.done, t.done_at FROM {table} t WHERE t.id IN ({','.join('?' * len(ids))}) AND {where}",
+            (*ids, pid),
+        ).fetchall()
+        return [dict(r) | {"done_at_br": _sql_to_br(r["done_at"])} for r in rows]
+
+    item_ids = [ch[2] for ch in items]
+    step_ids = [ch[2] for ch in steps]
+    items_out = state("plan_items", item_ids, "t.patient_id=?")
+    steps_out = state(
+        "plan_steps", step_ids, "t.plan_item_id IN (SELECT id FROM plan_items WHERE patient_id=?)"
+    )
+    found = {("item", r["id"]) for r in items_out} | {("step", r["id"]) for r in steps_out}
+    missing = [{"kind": "item", "id": i} for i in item_ids if ("item", i) not in found]
+    missing += [{"kind": "step", "id": i} for i in step_ids if ("step", i) not in found]
+    return jsonify({"ok": True, "items": items_out, "steps": steps_out, "missing": missing}), 200
+
+
 @bp.post("/<int:pid>/records/save")
 @login_required
 def record_save(pid: int):
@@ -633,11 +808,7 @@ def record_save(pid: int):
 @login_required
 def record_view(pid: int, rid: int):
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
-    rec = db.execute(
-        "SELECT * FROM clinical_records WHERE id=? AND patient_id=?",
-        (rid, pid),
-    ).fetchone()
+    patient, rec = patient_with(db, pid, "clinical_records", rid)
     if not patient or not rec:
         flash("Ficha não encontrada.", "danger")
         return redirect(url_for("patients.view_patient", pid=pid, tab="plano_ficha"))
@@ -648,11 +819,7 @@ def record_view(pid: int, rid: int):
 @login_required
 def record_print(pid: int, rid: int):
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
-    rec = db.execute(
-        "SELECT * FROM clinical_records WHERE id=? AND patient_id=?",
-        (rid, pid),
-    ).fetchone()
+    patient, rec = patient_with(db, pid, "clinical_records", rid)
     if not patient or not rec:
         flash("Ficha não encontrada.", "danger")
         return redirect(url_for("patients.view_patient", pid=pid, tab="plano_ficha"))
@@ -706,11 +873,7 @@ def anamnesis_save(pid: int):
 @login_required
 def anamnesis_view(pid: int, aid: int):
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
-    rec = db.execute(
-        "SELECT * FROM anamnesis WHERE id=? AND patient_id=?",
-        (aid, pid),
-    ).fetchone()
+    patient, rec = patient_with(db, pid, "anamnesis", aid)
     if not patient or not rec:
         flash("Anamnese não encontrada.", "danger")
         return redirect(url_for("patients.view_patient", pid=pid, tab="anamnese"))
@@ -721,11 +884,7 @@ def anamnesis_view(pid: int, aid: int):
 @login_required
 def anamnesis_print(pid: int, aid: int):
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
-    rec = db.execute(
-        "SELECT * FROM anamnesis WHERE id=? AND patient_id=?",
-        (aid, pid),
-    ).fetchone()
+    patient, rec = patient_with(db, pid, "anamnesis", aid)
     if not patient or not rec:
         flash("Anamnese não encontrada.", "danger")
         return redirect(url_for("patients.view_patient", pid=pid, tab="anamnese"))
@@ -748,7 +907,7 @@ def document_add(pid: int):
     content = (f.get("content") or "").strip()
 
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
+    patient = patient_header(db, pid)
     if not patient:
         flash("Paciente não encontrado.", "danger")
         return redirect(url_for("patients.list_patients"))
@@ -769,11 +928,7 @@ def document_add(pid: int):
 @login_required
 def document_view(pid: int, did: int):
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
-    doc = db.execute(
-        "SELECT * FROM patient_documents WHERE id=? AND patient_id=?",
-        (did, pid),
-    ).fetchone()
+    patient, doc = patient_with(db, pid, "patient_documents", did)
     if not patient or not doc:
         flash("Documento não encontrado.", "danger")
         return redirect(url_for("patients.view_patient", pid=pid, tab="documentos"))
@@ -853,11 +1008,7 @@ def document_sign(pid: int, did: int):
 @login_required
 def document_print(pid: int, did: int):
     db = get_db()
-    patient = db.execute("SELECT * FROM patients WHERE id=?", (pid,)).fetchone()
-    doc = db.execute(
-        "SELECT * FROM patient_documents WHERE id=? AND patient_id=?",
-        (did, pid),
-    ).fetchone()
+    patient, doc = patient_with(db, pid, "patient_documents", did)
     if not patient or not doc:
         flash("Documento não encontrado.", "danger")
         return redirect(url_for("patients.view_patient", pid=pid, tab="documentos"))
@@ -908,7 +1059,7 @@ def appointment_add(pid: int):
 
     db = get_db()
     db.execute(
-        "INSERT INTO appointments(patient_id, provider_id, title, start_at, end_at, note) VALUES(?,?,?,?,?,?)",
+        "INSERT INTO appointments(patient_id, provider_id, title, start_at, end_at, note, updated_at) VALUES(?,?,?,?,?,?, datetime('now'))",
         (pid, provider_id_int, title, start_at, end_at, note),
     )
     db.commit()
@@ -920,16 +1071,50 @@ def appointment_add(pid: int):
 @login_required
 def appointment_delete(pid: int, aid: int):
     db = get_db()
+    appt = db.execute(
+        "SELECT patient_id, provider_id, start_at, end_at FROM appointments WHERE id=? AND patient_id=?",
+        (aid, pid),
+    ).fetchone()
     db.execute("DELETE FROM appointments WHERE id=? AND patient_id=?", (aid, pid))
     db.commit()
     flash("Agendamento excluído.", "info")
-    return redirect(url_for("patients.view_patient", pid=pid, tab="agenda"))
+    offers_url = offer_freed_slot(db, appt)
+    return redirect(offers_url or url_for("patients.view_patient", pid=pid, tab="agenda"))
 
 
 # =========================
 # Odontograma
 # =========================
 
+# status aceitos (mesmos do menu em partials/odontograma_inline.html)
+ODONTO_STATUSES = {
+    "saudavel", "carie", "restauracao", "canal", "fratura",
+    "ausente", "implante", "protese", "mobilidade", "placa",
+}
+# numeração FDI dos permanentes (11-18, 21-28, 31-38, 41-48)
+ODONTO_TEETH = {f"{q}{n}" for q in range(1, 5) for n in range(1, 9)}
+ODONTO_BATCH_MAX = 200
+
+# Upsert por UNIQUE(patient_id, tooth). Repetir o mesmo status/obs. não grava nada
+# (nem mexe em updated_at), então reenvios da fila offline do navegador são inofensivos.
+_ODONTO_UPSERT = (
+    "INSERT INTO odontograma(patient_id, tooth, status, note, updated_at) "
+    "VALUES(?,?,?,?,datetime('now')) "
+    "ON CONFLICT(patient_id, tooth) DO UPDATE SET "
+    "status=excluded.status, note=excluded.note, updated_at=datetime('now') "
+    "WHERE odontograma.status IS NOT excluded.status OR odontograma.note IS NOT excluded.note"
+)
+
+
+def _odontograma_rows(db, pid: int) -> list[dict]:
+    return [
+        dict(r) for r in db.execute(
+            "SELECT tooth, status, note, updated_at FROM odontograma WHERE patient_id=? ORDER BY tooth ASC",
+            (pid,),
+        )
+    ]
+
+
 @bp.post("/<int:pid>/odontograma/save_json")
 @login_required
 def odontograma_save_json(pid: int):
@@ -942,17 +1127,65 @@ def odontograma_save_json(pid: int):
         return jsonify({"ok": False, "error": "tooth/status obrigatórios"}), 400
 
     db = get_db()
-    # Upsert usando UNIQUE(patient_id,tooth)
-    db.execute(
-        "INSERT INTO odontograma(patient_id, tooth, status, note, updated_at) "
-        "VALUES(?,?,?,?,datetime('now')) "
-        "ON CONFLICT(patient_id, tooth) DO UPDATE SET "
-        "status=excluded.status, note=excluded.note, updated_at=datetime('now')",
-        (pid, tooth, status, note),
-    )
+    db.execute(_ODONTO_UPSERT, (pid, tooth, status, note))
     db.commit()
     row = db.execute(
         "SELECT tooth, status, note, updated_at FROM odontograma WHERE patient_id=? AND tooth=?",
         (pid, tooth),
     ).fetchone()
     return jsonify({"ok": True, "row": dict(row)}), 200
+
+
+@bp.post("/<int:pid>/odontograma/save_batch")
+@login_required
+def odontograma_save_batch(pid: int):
+    """Várias mudanças de dente numa transação só; devolve o odontograma inteiro.
+
+    Corpo: {"changes": [{"tooth": "11", "status": "carie", "note": ""}, ...]}.
+    Se o mesmo dente vier mais de uma vez, vale a última.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"ok": False, "error": "corpo JSON deve ser um objeto"}), 400
+    changes = payload.get("changes")
+    if not isinstance(changes, list) or not changes:
+        return jsonify({"ok": False, "error": "changes obrigatório"}), 400
+    if len(changes) > ODONTO_BATCH_MAX:
+        return jsonify({"ok": False, "error": f"máximo de {ODONTO_BATCH_MAX} mudanças por envio"}), 400
+
+    latest: dict[str, tuple[str, str]] = {}
+    for ch in changes:
+        if not isinstance(ch, dict):
+            return jsonify({"ok": False, "error": "mudança inválida"}), 400
+        tooth = str(ch.get("tooth") or "").strip()
+        status = str(ch.get("status") or "").strip()
+        note = str(ch.get("note") or "").strip()
+        if tooth not in ODONTO_TEETH:
+            return jsonify({"ok": False, "error": f"dente inválido: {tooth or '(vazio)'}"}), 400
+        if status not in ODONTO_STATUSES:
+            return jsonify({"ok": False, "error": f"status inválido: {status or '(vazio)'}"}), 400
+        latest[tooth] = (status, note)
+
+    db = get_db()
+    if not db.execute("SELECT 1 FROM patients WHERE id=?", (pid,)).fetchone():
+        return jsonify({"ok": False, "error": "Paciente não encontrado."}), 404
+
+    cur = db.executemany(_ODONTO_UPSERT, [(pid, t, st, n) for t, (st, n) in latest.items()])
+    saved = cur.rowcount  # só os dentes que realmente mudaram
+    db.commit()
+    return jsonify({"ok": True, "saved": saved, "rows": _odontograma_rows(db, pid)}), 200
+
+
+@bp.get("/<int:pid>/odontograma/history")
+@login_required
+def odontograma_history(pid: int):
+    """Linha do tempo de um dente (?tooth=11), mais recente primeiro."""
+    tooth = (request.args.get("tooth") or "").strip()
+    if tooth not in ODONTO_TEETH:
+        return jsonify({"ok": False, "error": "dente inválido"}), 400
+    rows = get_db().execute(
+        "SELECT status, prev_status, note, changed_at FROM odontograma_history "
+        "WHERE patient_id=? AND tooth=? ORDER BY id DESC LIMIT 50",
+        (pid, tooth),
+    ).fetchall()
+    return jsonify({"ok": True, "tooth": tooth, "history": [dict(r) for r in rows]}), 200
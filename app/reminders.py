@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import re
+from datetime import date, timedelta
+from typing import Callable
+from urllib.parse import quote
+
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify
+from .auth import login_required
+from .db import get_db
+from .lookups import get_setting
+
+bp = Blueprint("reminders", __name__, url_prefix="/reminders")
+
+DEFAULT_REMINDER_TEMPLATE = (
+    "Olá {nome}! Passando pra lembrar da sua consulta ({procedimento}) em {data} às {hora}"
+    " com {profissional} na {clinica}. Podemos confirmar? 🙂"
+)
+
+PLACEHOLDERS = ("nome", "clinica", "data", "hora", "profissional", "procedimento")
+_PLACEHOLDER_RE = re.compile(r"\{(" + "|".join(PLACEHOLDERS) + r")\}")
+
+
+def _get_setting(db, key: str, default: str = "") -> str:
+    return get_setting(db, key, default)
+
+
+def _compile_template(template: str) -> Callable[[dict[str, str]], str]:
+    """Quebra o modelo uma única vez; depois cada mensagem é só um join."""
+    parts = _PLACEHOLDER_RE.split(template or "")
+    # re.split com grupo: posições ímpares são os nomes dos campos
+    literals = parts[0::2]
+    fields = parts[1::2]
+
+    def render(values: dict[str, str]) -> str:
+        out = [literals[0]]
+        for field, literal in zip(fields, literals[1:]):
+            out.append(values.get(field, ""))
+            out.append(literal)
+        return "".join(out)
+
+    return render
+
+
+def _wa_phones(phones: list[str | None]) -> list[str]:
+    """Normaliza todos os telefones do lote (só dígitos + DDI 55 quando faltar)."""
+    out = []
+    for phone in phones:
+        digits = "".join(ch for ch in (phone or "") if ch.isdigit())
+        if digits and not digits.startswith("55"):
+            digits = "55" + digits
+        out.append(digits)
+    return out
+
+
+@bp.route("/", methods=["GET", "POST"])
+@login_required
+def list_reminders():
+    db = get_db()
+
+    if request.method == "POST":
+        tpl = (request.form.get("reminder_template") or "").strip()
+        if not tpl:
+            flash("A mensagem padrão não pode ficar vazia.", "danger")
+        else:
+            db.execute("INSERT OR REPLACE INTO app_settings(key, value) VALUES(?,?)", ("reminder_template", tpl))
+            db.commit()
+            flash("Mensagem padrão salva.", "success")
+        return redirect(url_for("reminders.list_reminders", date=request.args.get("date") or None))
+
+    # Padrão: consultas de amanhã
+    target_raw = (request.args.get("date") or "").strip()
+    try:
+        target = date.fromisoformat(target_raw)
+    except ValueError:
+        target = date.today() + timedelta(days=1)
+
+    tpl = _get_setting(db, "reminder_template", DEFAULT_REMINDER_TEMPLATE)
+    render = _compile_template(tpl)
+    clinica = current_app.config.get("CLINIC_NAME", "NewClínica")
+
+    # Faixa do dia na idx_appt_start_status (start_at, status, ...)
+    rows = db.execute(
+        """
+        SELECT a.id, a.patient_id, a.title, a.start_at, a.status,
+               p.name AS patient_name, p.phone AS patient_phone,
+               pr.name AS provider_name,
+               l.sent_at
+          FROM appointments a
+          JOIN patients p ON p.id = a.patient_id
+          LEFT JOIN providers pr ON pr.id = a.provider_id
+          LEFT JOIN reminder_log l ON l.appointment_id = a.id AND l.channel = 'whatsapp'
+         WHERE a.start_at >= ? AND a.start_at < ? AND a.status <> 'cancelled'
+         ORDER BY a.start_at ASC, a.id ASC
+        """,
+        (f"{target.isoformat()} 00:00:00", f"{(target + timedelta(days=1)).isoformat()} 00:00:00"),
+    ).fetchall()
+
+    phones = _wa_phones([r["patient_phone"] for r in rows])
+    data_br = target.strftime("%d/%m/%Y")
+
+    items = []
+    for r, phone in zip(rows, phones):
+        hora = (r["start_at"] or "")[11:16]
+        msg = render({
+            "nome": r["patient_name"] or "",
+            "clinica": clinica,
+            "data": data_br,
+            "hora": hora,
+            "profissional": r["provider_name"] or "nossa equipe",
+            "procedimento": r["title"] or "Consulta",
+        })
+        items.append({
+            "appointment_id": int(r["id"]),
+            "patient_id": int(r["patient_id"]),
+            "name": r["patient_name"],
+            "phone": r["patient_phone"] or "",
+            "time": hora,
+            "title": r["title"] or "Consulta",
+            "provider_name": r["provider_name"] or "",
+            "status": r["status"] or "scheduled",
+            "message": msg,
+            "wa_link": f"https://wa.me/{phone}?text={quote(msg)}" if phone else "",
+            "sent": bool(r["sent_at"]),
+        })
+
+    return render_template(
+        "reminders.html",
+        items=items,
+        target=target.isoformat(),
+        target_br=data_br,
+        pending=sum(1 for i in items if i["wa_link"] and not i["sent"]),
+        reminder_template=tpl,
+        preview=render({
+            "nome": "Maria",
+            "clinica": clinica,
+            "data": data_br,
+            "hora": "09:00",
+            "profissional": "Dra. Hellen",
+            "procedimento": "Consulta",
+        }),
+        placeholders=PLACEHOLDERS,
+    )
+
+
+@bp.post("/mark_sent")
+@login_required
+def mark_sent():
+    db = get_db()
+    appointment_id = request.form.get("appointment_id", type=int)
+    if not appointment_id:
+        return jsonify({"ok": False, "error": "appointment_id faltando"}), 400
+    message = (request.form.get("message") or "").strip() or None
+    # O registro nasce aqui, no envio: abrir a tela não grava nada
+    cur = db.execute(
+        "INSERT INTO reminder_log(appointment_id, patient_id, remind_on, channel, message, sent_at) "
+        "SELECT id, patient_id, substr(start_at, 1, 10), 'whatsapp', ?, datetime('now') FROM appointments WHERE id=? "
+        "ON CONFLICT(appointment_id, channel) DO UPDATE SET message=COALESCE(excluded.message, reminder_log.message), "
+        "sent_at=excluded.sent_at WHERE reminder_log.sent_at IS NULL",
+        (message, appointment_id),
+    )
+    db.commit()
+    return jsonify({"ok": True, "updated": cur.rowcount})
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Extrato do paciente: cobranças e pagamentos com saldo corrente.
+
+O saldo é calculado no próprio SQL (SUM() OVER por data), sobre todo o
+histórico do paciente; a tela pagina por keyset (data + chave) e a exportação
+em CSV vai sendo enviada enquanto lê, sem montar tudo em memória.
+
+Mesmas regras de patient_balances: entradas do financeiro (sem as pendentes de
+boleto cancelado) + manutenções de orto com valor e sem lançamento.
+"""
+from __future__ import annotations
+
+import csv
+import io
+from typing import Iterator
+
+from flask import Blueprint, Response, flash, redirect, render_template, request, stream_with_context, url_for
+
+from .auth import login_required
+from .db import get_db
+from .patient_cache import patient_header
+from .utils import cents_to_brl
+
+bp = Blueprint("statements", __name__, url_prefix="/patients")
+
+STATEMENT_PAGE_SIZE = 50
+EXPORT_FETCH = 500
+
+# Cada lançamento vira uma cobrança (+) e, se pago, um pagamento (-).
+# k = chave única e ordenável dentro do dia (id*4 + tipo), usada no cursor.
+_STATEMENT_SQL = """
+    WITH tx AS (
+        SELECT t.id, t.status, t.date, COALESCE(t.due_date, t.date) AS due, t.amount_cents,
+               t.payment_method, t.description, c.name AS category_name,
+               b.id AS boleto_id, b.status AS boleto_status, b.invoice_url
+          FROM transactions t
+          LEFT JOIN categories c ON c.id = t.category_id
+          LEFT JOIN boletos b ON b.finance_tx_id = t.id AND b.patient_id = t.patient_id
+         WHERE t.patient_id = :pid AND t.kind = 'income'
+           AND NOT (t.status = 'pending' AND b.status IS 'cancelled')
+    ),
+    ortho AS (
+        SELECT o.id, o.payment_status AS status, o.amount_cents, o.payment_method, o.maintenance_done,
+               COALESCE(o.due_date, o.maintenance_date) AS due, COALESCE(o.paid_at, o.maintenance_date) AS paid_on
+          FROM ortho_maintenances o
+         WHERE o.patient_id = :pid AND o.finance_tx_id IS NULL AND o.amount_cents > 0
+    ),
+    items AS (
+        SELECT due AS d, id * 4 AS k, 'charge' AS entry, amount_cents AS delta, status,
+               description, category_name, payment_method, boleto_id, boleto_status, invoice_url
+          FROM tx
+        UNION ALL
+        SELECT date, id * 4 + 1, 'payment', -amount_cents, status,
+               description, category_name, payment_method, boleto_id, boleto_status, invoice_url
+          FROM tx WHERE status = 'paid'
+        UNION ALL
+        SELECT due, id * 4 + 2, 'charge', amount_cents, status,
+               COALESCE('Ortodontia • ' || NULLIF(maintenance_done, ''), 'Ortodontia • Manutenção'),
+               'Ortodontia', payment_method, NULL, NULL, NULL
+          FROM ortho
+        UNION ALL
+        SELECT paid_on, id * 4 + 3, 'payment', -amount_cents, status,
+               COALESCE('Ortodontia • ' || NULLIF(maintenance_done, ''), 'Ortodontia • Manutenção'),
+               'Ortodontia', payment_method, NULL, NULL, NULL
+          FROM ortho WHERE status = 'paid'
+    )
+    SELECT * FROM (
+        SELECT items.*, SUM(delta) OVER (ORDER BY d, k ROWS UNBOUNDED PRECEDING) AS balance
+          FROM items
+    )
+"""
+
+
+def _parse_cursor(raw: str | None) -> tuple[str, int] | None:
+    """Cursor da paginação: "<data>|<k>" do último item da página anterior."""
+    val, _, k = (raw or "").rpartition("|")
+    return (val, int(k)) if k.isdigit() else None
+
+
+def statement_page(db, pid: int, before: tuple[str, int] | None = None, limit: int = STATEMENT_PAGE_SIZE) -> list:
+    """Uma página do extrato, mais recentes primeiro (o saldo é o acumulado até cada linha)."""
+    sql = _STATEMENT_SQL
+    params: dict = {"pid": pid, "limit": limit}
+    if before:
+        sql += " WHERE (d, k) < (:d, :k)"
+        params.update(d=before[0], k=before[1])
+    return db.execute(sql + " ORDER BY d DESC, k DESC LIMIT :limit", params).fetchall()
+
+
+@bp.get("/<int:pid>/extrato")
+@login_required
+def statement(pid: int):
+    db = get_db()
+    patient = patient_header(db, pid)
+    if not patient:
+        flash("Paciente não encontrado.", "danger")
+        return redirect(url_for("patients.list_patients"))
+
+    before = _parse_cursor(request.args.get("before"))
+    rows = statement_page(db, pid, before, STATEMENT_PAGE_SIZE + 1)
+    next_before = None
+    if len(rows) > STATEMENT_PAGE_SIZE:
+        rows = rows[:STATEMENT_PAGE_SIZE]
+        next_before = f"{rows[-1]['d']}|{rows[-1]['k']}"
+    balance = db.execute("SELECT * FROM patient_balances WHERE patient_id=?", (pid,)).fetchone()
+
+    return render_template(
+        "patient_statement.html",
+        patient=patient,
+        rows=rows,
+        balance=balance,
+        next_before=next_before,
+        is_first_page=before is None,
+        page_size=STATEMENT_PAGE_SIZE,
+        cents_to_brl=cents_to_brl,
+    )
+
+
+def _csv_lines(db, pid: int) -> Iterator[str]:
+    buf = io.StringIO()
+    out = csv.writer(buf, delimiter=";")
+
+    def flush() -> str:
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+        return data
+
+    buf.write("\ufeff")  # BOM: Excel abre com acentos certos
+    out.writerow(["Data", "Tipo", "Descrição", "Categoria", "Forma", "Status", "Valor", "Saldo"])
+    yield flush()
+    cur = db.execute(_STATEMENT_SQL + " ORDER BY d, k", {"pid": pid})
+    while True:
+        chunk = cur.fetchmany(EXPORT_FETCH)
+        if not chunk:
+            break
+        for r in chunk:
+            out.writerow([
+                r["d"],
+                "Cobrança" if r["entry"] == "charge" else "Pagamento",
+                r["description"] or "",
+                r["category_name"] or "",
+                r["payment_method"] or "",
+                r["boleto_status"] or r["status"] or "",
+                cents_to_brl(r["delta"]),
+                cents_to_brl(r["balance"]),
+            ])
+        yield flush()
+
+
+@bp.get("/<int:pid>/extrato.csv")
+@login_required
+def statement_csv(pid: int):
+    db = get_db()
+    if not patient_header(db, pid):
+        flash("Paciente não encontrado.", "danger")
+        return redirect(url_for("patients.list_patients"))
+    return Response(
+        stream_with_context(_csv_lines(db, pid)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=extrato_paciente_{pid}.csv"},
+    )
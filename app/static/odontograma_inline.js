@@ -10,8 +10,22 @@
   const btnSave = document.getElementById('odonto-save');
   const btnCancel = document.getElementById('odonto-cancel');
 
-  const saveURL = wrap.dataset.saveUrl;
+  const batchURL = wrap.dataset.batchUrl;
+  const historyURL = wrap.dataset.historyUrl;
   const state = (window.ODONTO_STATE || {});
+  const syncEl = document.getElementById('odonto-sync');
+  const histEl = document.getElementById('odonto-hist');
+
+  // Mudanças ainda não confirmadas pelo servidor (dente -> {tooth,status,note}).
+  // Ficam no localStorage: se a rede cair ou a aba fechar, vão no próximo envio.
+  const QUEUE_KEY = 'odonto-queue-' + (wrap.dataset.pid || '');
+  const DEBOUNCE_MS = 800;
+  const RETRY_MAX_MS = 60000;
+  let pending = {};
+  try{ pending = JSON.parse(localStorage.getItem(QUEUE_KEY) || '{}') || {}; }catch(e){ pending = {}; }
+  let timer = null;
+  let inflight = false;
+  let retryMs = 2000;
 
   const color = {
     saudavel:  '#16a34a',
@@ -26,7 +40,7 @@
     placa:     '#f97316'
   };
 
-function updateRegistroTable(tooth, status, note){
+function updateRegistroTable(tooth, status, note, updatedAt){
   const tbody = document.getElementById('odontograma-tbody');
   if(!tbody) return;
 
@@ -51,7 +65,7 @@ function updateRegistroTable(tooth, status, note){
   if(tds[0]) tds[0].textContent = tooth;
   if(tds[1]) tds[1].textContent = status;
   if(tds[2]) tds[2].textContent = note || '';
-  if(tds[3]) tds[3].textContent = stamp;
+  if(tds[3]) tds[3].textContent = updatedAt || stamp;
 
   row.setAttribute('data-tooth', String(tooth));
 }
@@ -66,11 +80,137 @@ function updateRegistroTable(tooth, status, note){
     r.setAttribute('stroke', c === '#1f2937' ? '#374151' : c);
   }
 
+  function toothEl(tooth){
+    return svg.querySelector(`g.tooth[data-tooth="${tooth}"]`);
+  }
+
+  function pendingCount(){ return Object.keys(pending).length; }
+
+  function persist(){
+    try{
+      if(pendingCount()) localStorage.setItem(QUEUE_KEY, JSON.stringify(pending));
+      else localStorage.removeItem(QUEUE_KEY);
+    }catch(e){}
+  }
+
+  function setSync(msg, offline){
+    if(!syncEl) return;
+    syncEl.textContent = msg || '';
+    syncEl.classList.toggle('offline', !!offline);
+  }
+
+  function schedule(ms){
+    clearTimeout(timer);
+    timer = setTimeout(flush, ms);
+  }
+
+  // estado confirmado pelo servidor (não passa por cima do que ainda está na fila)
+  function applyRows(rows){
+    (rows || []).forEach(r=>{
+      if(pending[r.tooth]) return;
+      state[r.tooth] = r.status;
+      const g = toothEl(r.tooth);
+      if(g) paintTooth(g, r.status);
+      try{ updateRegistroTable(r.tooth, r.status, r.note, r.updated_at); }catch(e){}
+    });
+  }
+
+  async function flush(){
+    clearTimeout(timer);
+    if(inflight || !pendingCount()) return;
+    inflight = true;
+    const batch = Object.assign({}, pending);
+    const n = Object.keys(batch).length;
+    setSync(`Salvando ${n} dente(s)…`);
+    let retry = false;
+    try{
+      const res = await fetch(batchURL, {
+        method: 'POST',
+        headers: {'Content-Type':'application/json'},
+        body: JSON.stringify({ changes: Object.values(batch) })
+      });
+      if(res.redirected){
+        // sessão expirou (foi para o login): a fila fica guardada para depois
+        setSync(`Sessão expirada: ${pendingCount()} alteração(ões) aguardando. Entre de novo para enviar.`, true);
+        return;
+      }
+      const j = await res.json().catch(()=>null);
+      if(res.ok && j && j.ok){
+        // só tira da fila o que não foi editado de novo enquanto o envio rodava
+        Object.keys(batch).forEach(t=>{ if(pending[t] === batch[t]) delete pending[t]; });
+        persist();
+        applyRows(j.rows);
+        retryMs = 2000;
+        setSync(pendingCount() ? '' : 'Salvo ✓');
+      }else if(res.status >= 400 && res.status < 500 && res.status !== 408 && res.status !== 429){
+        // erro de dados: reenviar não resolve
+        Object.keys(batch).forEach(t=>{ if(pending[t] === batch[t]) delete pending[t]; });
+        persist();
+        setSync('');
+        alert('Falha ao salvar: ' + (j && j.error ? j.error : res.status));
+      }else{
+        retry = true;
+      }
+    }catch(err){
+      retry = true;
+    }finally{
+      inflight = false;
+    }
+    if(retry){
+      setSync(`Sem conexão: ${pendingCount()} alteração(ões) na fila, tentando de novo…`, true);
+      schedule(retryMs);
+      retryMs = Math.min(RETRY_MAX_MS, retryMs * 2);
+    }else if(pendingCount()){
+      schedule(DEBOUNCE_MS);
+    }
+  }
+
+  function queueChange(change){
+    pending[change.tooth] = change;
+    persist();
+    state[change.tooth] = change.status;
+    const g = toothEl(change.tooth);
+    if(g) paintTooth(g, change.status);
+    try{ updateRegistroTable(change.tooth, change.status, change.note); }catch(e){}
+    setSync(`${pendingCount()} alteração(ões) para salvar…`);
+    if(!inflight) schedule(DEBOUNCE_MS);
+  }
+
+  // o que ficou na fila de uma visita anterior entra por cima do estado do servidor
+  Object.values(pending).forEach(ch=>{ state[ch.tooth] = ch.status; });
+
   Array.from(svg.querySelectorAll('g.tooth')).forEach(g=>{
     const t = g.dataset.tooth;
     if(state[t]) paintTooth(g, state[t]);
   });
 
+  if(pendingCount()){
+    setSync(`${pendingCount()} alteração(ões) da última visita na fila…`, true);
+    schedule(0);
+  }
+  window.addEventListener('online', ()=>{ retryMs = 2000; flush(); });
+  window.addEventListener('pagehide', ()=>{
+    if(!pendingCount() || !navigator.sendBeacon) return;
+    // melhor esforço; a fila continua no localStorage (reenvio é inofensivo)
+    navigator.sendBeacon(batchURL, new Blob([JSON.stringify({ changes: Object.values(pending) })], {type: 'application/json'}));
+  });
+
+  async function loadHistory(tooth){
+    if(!histEl || !historyURL) return;
+    histEl.textContent = '';
+    try{
+      const res = await fetch(`${historyURL}?tooth=${encodeURIComponent(tooth)}`);
+      const j = await res.json();
+      if(currentTooth !== tooth || !j || !j.ok) return;
+      j.history.slice(0, 10).forEach(h=>{
+        const d = document.createElement('div');
+        const prev = h.prev_status ? ` (antes: ${h.prev_status})` : '';
+        d.textContent = `${h.changed_at} · ${h.status}${prev}${h.note ? ' · ' + h.note : ''}`;
+        histEl.appendChild(d);
+      });
+    }catch(e){}
+  }
+
   function showTip(txt, evt){
     if(!txt){ tip.style.display='none'; return; }
     tip.textContent = txt;
@@ -101,6 +241,7 @@ function updateRegistroTable(tooth, status, note){
     menu.style.display = 'block';
     svg.querySelectorAll('g.tooth').forEach(t=>t.classList.remove('selected'));
     g.classList.add('selected');
+    loadHistory(currentTooth);
   }
   function closeMenu(){
     menu.style.display = 'none';
@@ -115,28 +256,10 @@ function updateRegistroTable(tooth, status, note){
   });
   document.getElementById('odonto-cancel').addEventListener('click', (e)=>{ e.preventDefault(); closeMenu(); });
 
-  document.getElementById('odonto-save').addEventListener('click', async (e)=>{
+  document.getElementById('odonto-save').addEventListener('click', (e)=>{
     e.preventDefault();
     if(!currentTooth) return;
-    const payload = { tooth: String(currentTooth), status: sel.value, note: note.value || '' };
-    try{
-      const res = await fetch(saveURL, {
-        method: 'POST',
-        headers: {'Content-Type':'application/json'},
-        body: JSON.stringify(payload)
-      });
-      const j = await res.json();
-      if(j && j.ok){
-        state[currentTooth] = payload.status;
-        const g = svg.querySelector(`g.tooth[data-tooth="${currentTooth}"]`);
-        if(g) paintTooth(g, payload.status);
-        try{ updateRegistroTable(payload.tooth, payload.status, payload.note); }catch(e){}
-        closeMenu();
-      }else{
-        alert('Falha ao salvar: ' + (j && j.error ? j.error : 'desconhecido'));
-      }
-    }catch(err){
-      alert('Erro de rede ao salvar: ' + err.message);
-    }
+    queueChange({ tooth: String(currentTooth), status: sel.value, note: note.value || '' });
+    closeMenu();
   });
 })();
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import Any
+from urllib.parse import quote
+
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
+from .auth import login_required
+from .db import get_db
+
+bp = Blueprint("waitlist", __name__, url_prefix="/waitlist")
+
+# Quantos candidatos mostrar para cada horário liberado
+OFFER_LIMIT = 5
+
+
+def _safe_int(v: Any) -> int | None:
+    s = str(v).strip() if v is not None else ""
+    return int(s) if s.isdigit() else None
+
+
+def _hhmm(v: str | None) -> str | None:
+    s = (v or "").strip()
+    try:
+        return datetime.strptime(s, "%H:%M").strftime("%H:%M")
+    except ValueError:
+        return None
+
+
+def _yyyy_mm_dd(v: str | None) -> str | None:
+    s = (v or "").strip()
+    try:
+        return datetime.strptime(s, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+def _slot_bounds(start_at: str, end_at: str | None) -> tuple[str, str, str]:
+    """Retorna (dia, hora_inicio, hora_fim) do horário; sem fim, assume 30 minutos."""
+    day = start_at[:10]
+    t_start = start_at[11:16]
+    if end_at and end_at[:10] == day:
+        t_end = end_at[11:16]
+    else:
+        dt = datetime.strptime(start_at[:16], "%Y-%m-%d %H:%M") + timedelta(minutes=30)
+        t_end = dt.strftime("%H:%M") if dt.strftime("%Y-%m-%d") == day else "23:59"
+    return day, t_start, t_end
+
+
+def find_candidates(
+    db,
+    start_at: str,
+    end_at: str | None,
+    provider_id: int | None,
+    *,
+    exclude_patient_id: int | None = None,
+    limit: int = OFFER_LIMIT,
+) -> list[Any]:
+    """Melhores pacientes da lista de espera para o horário (maior prioridade, mais antigo primeiro).
+
+    Cada ramo do UNION percorre idx_waitlist_window (parcial em active=1) já na ordem
+    (priority DESC, id) e para no LIMIT. Os filtros de data/horário não têm como virar
+    faixa no índice (aceitam NULL), então são conferidos entrada a entrada; como as
+    colunas da janela estão no próprio índice, só as linhas que encaixam são lidas da
+    tabela. O custo cresce com quantas entradas de maior prioridade não encaixam.
+    """
+    day, t_start, t_end = _slot_bounds(start_at, end_at)
+    fits = (
+        "(w.earliest_date IS NULL OR w.earliest_date <= :day) "
+        "AND (w.latest_date IS NULL OR w.latest_date >= :day) "
+        "AND (w.time_from IS NULL OR w.time_from <= :t_start) "
+        "AND (w.time_to IS NULL OR w.time_to >= :t_end) "
+        "AND w.patient_id <> :exclude"
+    )
+    branch = (
+        "SELECT * FROM (SELECT w.* FROM waitlist w INDEXED BY idx_waitlist_window "
+        "WHERE w.active=1 AND w.provider_id {cond} AND " + fits +
+        " ORDER BY w.priority DESC, w.id ASC LIMIT :limit)"
+    )
+    sql = f"""
+        SELECT m.*, p.name AS patient_name, p.phone AS patient_phone, pr.name AS provider_name
+          FROM ({branch.format(cond="= :provider_id")} UNION ALL {branch.format(cond="IS NULL")}) m
+          JOIN patients p ON p.id = m.patient_id
+          LEFT JOIN providers pr ON pr.id = m.provider_id
+         ORDER BY m.priority DESC, m.id ASC
+         LIMIT :limit
+    """
+    return db.execute(
+        sql,
+        {
+            "day": day,
+            "t_start": t_start,
+            "t_end": t_end,
+            "exclude": exclude_patient_id or 0,
+            "provider_id": provider_id or 0,
+            "limit": limit,
+        },
+    ).fetchall()
+
+
+def offer_freed_slot(db, appt) -> str | None:
+    """Chamado ao excluir um agendamento: se houver candidatos na lista de espera,
+    avisa a recepção e devolve a URL das ofertas para o horário liberado."""
+    if not appt or not appt["start_at"]:
+        return None
+    if appt["start_at"] < datetime.now().strftime("%Y-%m-%d %H:%M:%S"):
+        return None
+    candidates = find_candidates(
+        db,
+        appt["start_at"],
+        appt["end_at"],
+        appt["provider_id"],
+        exclude_patient_id=appt["patient_id"],
+    )
+    if not candidates:
+        return None
+    names = ", ".join(c["patient_name"] for c in candidates[:3])
+    more = f" e mais {len(candidates) - 3}" if len(candidates) > 3 else ""
+    flash(f"Horário liberado! Lista de espera: {names}{more}.", "info")
+    return url_for(
+        "waitlist.list_waitlist",
+        start_at=appt["start_at"],
+        end_at=appt["end_at"] or "",
+        provider_id=appt["provider_id"] or "",
+        patient_id=appt["patient_id"] or "",
+    )
+
+
+@bp.get("/")
+@login_required
+def list_waitlist():
+    db = get_db()
+    rows = db.execute(
+        """
+        SELECT w.*, p.name AS patient_name, p.phone AS patient_phone, pr.name AS provider_name
+          FROM waitlist w
+          JOIN patients p ON p.id = w.patient_id
+          LEFT JOIN providers pr ON pr.id = w.provider_id
+         WHERE w.active = 1
+         ORDER BY w.priority DESC, w.id ASC
+        """
+    ).fetchall()
+    patients = db.execute("SELECT id, name FROM patients ORDER BY name COLLATE NOCASE").fetchall()
+    providers = db.execute("SELECT id, name FROM providers WHERE active=1 ORDER BY name COLLATE NOCASE").fetchall()
+
+    # Horário liberado (vindo da exclusão de um agendamento)
+    slot = None
+    offers = []
+    start_at = (request.args.get("start_at") or "").strip()
+    if len(start_at) >= 16:
+        end_at = (request.args.get("end_at") or "").strip() or None
+        provider_id = _safe_int(request.args.get("provider_id"))
+        # quem desmarcou não recebe a oferta do próprio horário
+        freed_by = _safe_int(request.args.get("patient_id"))
+        day, t_start, t_end = _slot_bounds(start_at, end_at)
+        slot = {
+            "start_at": start_at,
+            "end_at": end_at or "",
+            "provider_id": provider_id or "",
+            "label": f"{day[8:10]}/{day[5:7]}/{day[0:4]} {t_start}–{t_end}",
+        }
+        clinica = current_app.config.get("CLINIC_NAME", "NewClínica")
+        for c in find_candidates(db, start_at, end_at, provider_id, exclude_patient_id=freed_by):
+            phone = "".join(ch for ch in (c["patient_phone"] or "") if ch.isdigit())
+            if phone and not phone.startswith("55"):
+                phone = "55" + phone
+            msg = (
+                f"Olá {c['patient_name']}! Abriu um horário na {clinica} em {slot['label'][:10]} às {t_start}. "
+                "Quer que eu reserve pra você?"
+            )
+            offers.append(dict(c) | {"wa_link": f"https://wa.me/{phone}?text={quote(msg)}" if phone else ""})
+
+    return render_template(
+        "waitlist.html",
+        rows=rows,
+        patients=patients,
+        providers=providers,
+        slot=slot,
+        offers=offers,
+    )
+
+
+@bp.post("/add")
+@login_required
+def add_entry():
+    f = request.form
+    patient_id = _safe_int(f.get("patient_id"))
+    if not patient_id:
+        flash("Selecione o paciente.", "danger")
+        return redirect(url_for("waitlist.list_waitlist"))
+    try:
+        priority = max(0, min(10, int(f.get("priority") or 0)))
+    except ValueError:
+        priority = 0
+
+    db = get_db()
+    db.execute(
+        "INSERT INTO waitlist(patient_id, provider_id, earliest_date, latest_date, time_from, time_to, priority, note) "
+        "VALUES(?,?,?,?,?,?,?,?)",
+        (
+            patient_id,
+            _safe_int(f.get("provider_id")),
+            _yyyy_mm_dd(f.get("earliest_date")),
+            _yyyy_mm_dd(f.get("latest_date")),
+            _hhmm(f.get("time_from")),
+            _hhmm(f.get("time_to")),
+            priority,
+            (f.get("note") or "").strip() or None,
+        ),
+    )
+    db.commit()
+    flash("Paciente incluído na lista de espera ✅", "success")
+    return redirect(url_for("waitlist.list_waitlist"))
+
+
+@bp.post("/<int:wid>/remove")
+@login_required
+def remove_entry(wid: int):
+    db = get_db()
+    db.execute("UPDATE waitlist SET active=0 WHERE id=?", (wid,))
+    db.commit()
+    flash("Removido da lista de espera.", "info")
+    return redirect(url_for("waitlist.list_waitlist"))
+
+
+@bp.post("/<int:wid>/book")
+@login_required
+def book_entry(wid: int):
+    """Agenda o paciente da lista de espera no horário liberado e tira ele da lista."""
+    db = get_db()
+    entry = db.execute("SELECT * FROM waitlist WHERE id=? AND active=1", (wid,)).fetchone()
+    start_at = (request.form.get("start_at") or "").strip()
+    end_at = (request.form.get("end_at") or "").strip() or None
+    provider_id = _safe_int(request.form.get("provider_id")) or (entry["provider_id"] if entry else None)
+    if not entry or len(start_at) < 16:
+        flash("Não foi possível agendar: registro ou horário inválido.", "danger")
+        return redirect(url_for("waitlist.list_waitlist"))
+
+    # checagem e INSERT na mesma transação (IMMEDIATE): outra recepção pode ter
+    # ocupado o horário entre a oferta e o clique
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    taken = db.execute(
+        """
+        SELECT 1 FROM appointments
+         WHERE provider_id IS :provider_id
+           AND COALESCE(status, 'scheduled') <> 'cancelled'
+           AND datetime(start_at) < COALESCE(datetime(:end_at), datetime(:start_at, '+30 minutes'))
+           AND COALESCE(datetime(end_at), datetime(start_at, '+30 minutes')) > datetime(:start_at)
+         LIMIT 1
+        """,
+        {"provider_id": provider_id, "start_at": start_at, "end_at": end_at},
+    ).fetchone()
+    if taken:
+        db.rollback()
+        flash("Esse horário já foi ocupado por outro agendamento. Escolha outro encaixe.", "danger")
+        return redirect(url_for("waitlist.list_waitlist"))
+    db.execute(
+        "INSERT INTO appointments(patient_id, provider_id, title, start_at, end_at, note, updated_at) VALUES(?,?,?,?,?,?, datetime('now'))",
+        (int(entry["patient_id"]), provider_id, "Consulta", start_at, end_at, "Encaixe (lista de espera)"),
+    )
+    db.execute("UPDATE waitlist SET active=0 WHERE id=?", (wid,))
+    db.commit()
+    flash("Encaixe agendado ✅", "success")
+    return redirect(url_for("agenda.calendar_view"))
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
-from app import create_app
+from app import create_app, start_server
 
-app = create_app()
+app = start_server(create_app())
 
 if __name__ == "__main__":
     host = os.environ.get("HOST", "0.0.0.0")
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Cliente do Asaas contra o servidor fake (tools/asaas_fake.py): novas tentativas e timeout.
+
+Rodar: python -m unittest discover -s tests   (ou pytest tests)
+"""
+from __future__ import annotations
+
+import os
+import sys
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "tools"))
+os.environ.setdefault("JOBS_WORKER", "0")
+
+from asaas_fake import serve  # noqa: E402
+from app import asaas  # noqa: E402
+
+
+class AsaasClientTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.srv, cls.fake = serve(port=0)
+        # o cliente que desistiu por timeout fecha o socket: BrokenPipe esperado no fake
+        cls.srv.handle_error = lambda request, client_address: None
+        cls.base_url = f"http://127.0.0.1:{cls.srv.server_port}/v3"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.srv.shutdown()
+        cls.srv.server_close()
+
+    def setUp(self):
+        with self.fake.lock:
+            self.fake.customers.clear()
+            self.fake.payments.clear()
+            self.fake.stats.clear()
+        self.client = asaas.AsaasClient(self.base_url, "fake", max_retries=2)
+        # breaker novo por teste e sem espera entre tentativas
+        for p in (
+            mock.patch.object(asaas, "breaker", asaas.CircuitBreaker()),
+            mock.patch.object(asaas, "_backoff", return_value=0),
+        ):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _fail_next(self, *outcomes):
+        """Próximas respostas do fake: status de erro (int), atraso em s (float) ou None = normal."""
+        queue = list(outcomes)
+        self.hits = 0
+
+        def chaos():
+            self.hits += 1
+            step = queue.pop(0) if queue else None
+            if isinstance(step, float):
+                time.sleep(step)
+                return None
+            return step
+
+        p = mock.patch.object(self.fake, "chaos", chaos)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_get_retries_5xx_then_succeeds(self):
+        self._fail_next(503, 502)
+        data = self.client.request("GET", "/customers", params={"cpfCnpj": "123"})
+        self.assertEqual(data["object"], "list")
+        self.assertEqual(self.hits, 3)
+
+    def test_get_gives_up_after_max_retries(self):
+        self._fail_next(503, 503, 503, 503)
+        with self.assertRaises(asaas.AsaasError) as ctx:
+            self.client.request("GET", "/customers")
+        self.assertEqual(ctx.exception.status, 503)
+        self.assertEqual(self.hits, 3)
+
+    def test_post_5xx_is_not_retried(self):
+        self._fail_next(503)
+        with self.assertRaises(asaas.AsaasError) as ctx:
+            self.client.request("POST", "/customers", json_body={"name": "Ana", "cpfCnpj": "123"})
+        self.assertEqual(ctx.exception.status, 503)
+        self.assertEqual(self.hits, 1)
+        self.assertEqual(len(self.fake.customers), 0)
+
+    def test_read_timeout_is_retried(self):
+        self._fail_next(0.5)
+        with mock.patch.dict(asaas.TIMEOUTS, {"read": (1.0, 0.2)}):
+            data = self.client.request("GET", "/customers")
+        self.assertEqual(data["object"], "list")
+        self.assertEqual(self.hits, 2)
+
+    def test_read_timeout_without_retries_raises_network_error(self):
+        self._fail_next(0.5)
+        client = asaas.AsaasClient(self.base_url, "fake", max_retries=0)
+        with mock.patch.dict(asaas.TIMEOUTS, {"read": (1.0, 0.2)}):
+            with self.assertRaises(asaas.AsaasError) as ctx:
+                client.request("GET", "/customers")
+        self.assertIsNone(ctx.exception.status)
+
+    def test_half_open_probe_released_on_unexpected_error(self):
+        asaas.breaker.state = "half_open"
+        with mock.patch.object(asaas._get_session(), "request", side_effect=ValueError("resposta quebrada")):
+            with self.assertRaises(ValueError):
+                self.client.request("GET", "/customers")
+        self.assertFalse(asaas.breaker.probe_in_flight)
+        self.assertEqual(asaas.breaker.state, "open")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Sincronização de clientes (sync_customers / map_concurrent) contra o servidor fake.
+
+Rodar: python -m unittest discover -s tests   (ou pytest tests)
+"""
+from __future__ import annotations
+
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "tools"))
+os.environ.setdefault("JOBS_WORKER", "0")
+
+from asaas_fake import serve  # noqa: E402
+from app import asaas, create_app  # noqa: E402
+from app.asaas_customers import sync_customers  # noqa: E402
+from app.db import get_db, init_db  # noqa: E402
+from app.jobs import RetryLater  # noqa: E402
+
+# CPFs válidos (dígitos verificadores ok)
+CPF_ANA = "52998224725"
+CPF_BIA = "11144477735"
+CPF_CAIO = "39053344705"
+
+
+class MapConcurrentTest(unittest.TestCase):
+    def test_keeps_going_after_errors_and_preserves_order(self):
+        def fn(n):
+            if n % 2:
+                raise ValueError(n)
+            return n * 10
+
+        out = asaas.map_concurrent(fn, range(6), max_workers=3)
+        self.assertEqual([item for item, _, _ in out], list(range(6)))
+        self.assertEqual([res for _, res, _ in out], [0, None, 20, None, 40, None])
+        self.assertEqual([type(err).__name__ if err else None for _, _, err in out], [None, "ValueError"] * 3)
+
+
+class SyncCustomersTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.srv, cls.fake = serve(port=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.srv.shutdown()
+        cls.srv.server_close()
+
+    def setUp(self):
+        with self.fake.lock:
+            self.fake.customers.clear()
+            self.fake.payments.clear()
+            self.fake.stats.clear()
+        self.db_path = os.path.join(tempfile.mkdtemp(), "t.db")
+        env = {
+            "DB_PATH": self.db_path,
+            "ASAAS_BASE_URL": f"http://127.0.0.1:{self.srv.server_port}/v3",
+            "ASAAS_API_KEY": "fake",
+            # uma chamada por vez: a ordem das respostas roteirizadas fica previsível
+            "ASAAS_MAX_CONCURRENCY": "1",
+            "ASAAS_RATE_PER_SEC": "1000",
+        }
+        for p in (
+            mock.patch.dict(os.environ, env),
+            mock.patch.object(asaas, "breaker", asaas.CircuitBreaker()),
+            mock.patch.object(asaas, "_backoff", return_value=0),
+        ):
+            p.start()
+            self.addCleanup(p.stop)
+        self.app = create_app()
+        ctx = self.app.app_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+        init_db()
+        db = get_db()
+        db.executemany(
+            "INSERT INTO patients(id, name, cpf, asaas_customer_id) VALUES(?,?,?,?)",
+            [
+                (1, "Ana", CPF_ANA, None),
+                (2, "Bia", CPF_BIA, None),
+                (3, "Caio", CPF_CAIO, None),
+                (4, "Duda", "12345678900", None),   # CPF inválido: nem chama o Asaas
+                (5, "Eva", CPF_ANA, "cus_antigo"),  # já vinculada
+            ],
+        )
+        db.commit()
+
+    def _script(self, *outcomes, on_call=None):
+        """Próximas respostas do fake (status de erro ou None); on_call(n) roda antes da n-ésima."""
+        queue = list(outcomes)
+        self.hits = 0
+
+        def chaos():
+            self.hits += 1
+            if on_call:
+                on_call(self.hits)
+            return queue.pop(0) if queue else None
+
+        p = mock.patch.object(self.fake, "chaos", chaos)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def _linked(self) -> dict[int, str | None]:
+        return {r["id"]: r["asaas_customer_id"] for r in get_db().execute("SELECT id, asaas_customer_id FROM patients")}
+
+    def test_partial_failure_raises_retry_later_and_keeps_the_rest(self):
+        # por paciente: GET /customers (busca pelo CPF) e POST /customers; o POST da Bia falha
+        self._script(None, None, None, 503)
+        with self.assertRaises(RetryLater):
+            sync_customers(get_db())
+        linked = self._linked()
+        self.assertTrue(linked[1] and linked[3])
+        self.assertIsNone(linked[2])
+        self.assertIsNone(linked[4])
+        self.assertEqual(linked[5], "cus_antigo")
+
+        # próxima tentativa: só a Bia ainda falta
+        result = sync_customers(get_db())
+        self.assertEqual(result, {"linked": 1, "invalid": 1, "errors": 0})
+        self.assertTrue(self._linked()[2])
+        self.assertEqual(len(self.fake.customers), 3)
+
+    def test_does_not_overwrite_patient_linked_meanwhile(self):
+        def link_caio_elsewhere(n):
+            # antes da 5ª chamada (GET do Caio), outro caminho vincula o Caio
+            if n == 5:
+                with sqlite3.connect(self.db_path) as con:
+                    con.execute("UPDATE patients SET asaas_customer_id='cus_manual' WHERE id=3")
+
+        self._script(on_call=link_caio_elsewhere)
+        result = sync_customers(get_db())
+        self.assertEqual(result["linked"], 2)
+        linked = self._linked()
+        self.assertEqual(linked[3], "cus_manual")
+        self.assertEqual(linked[5], "cus_antigo")
+
+
+if __name__ == "__main__":
+    unittest.main()
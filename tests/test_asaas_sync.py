@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Reconciliação com o Asaas (sync_stream / apply_payments) contra o servidor fake.
+
+Rodar: python -m unittest discover -s tests   (ou pytest tests)
+"""
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+import unittest
+from datetime import date, timedelta
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "tools"))
+os.environ.setdefault("JOBS_WORKER", "0")
+
+from asaas_fake import serve  # noqa: E402
+from app import asaas, asaas_sync, create_app  # noqa: E402
+from app.db import data_version, get_db, init_db  # noqa: E402
+
+N_BOLETOS = 5
+
+
+class SyncStreamTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.srv, cls.fake = serve(port=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.srv.shutdown()
+        cls.srv.server_close()
+
+    def setUp(self):
+        with self.fake.lock:
+            self.fake.customers.clear()
+            self.fake.payments.clear()
+            self.fake.stats.clear()
+        env = {
+            "DB_PATH": os.path.join(tempfile.mkdtemp(), "t.db"),
+            "ASAAS_BASE_URL": f"http://127.0.0.1:{self.srv.server_port}/v3",
+            "ASAAS_API_KEY": "fake",
+        }
+        # páginas de 2: 5 cobranças viram 3 páginas (hasMore nas duas primeiras)
+        for p in (
+            mock.patch.dict(os.environ, env),
+            mock.patch.object(asaas_sync, "PAGE_SIZE", 2),
+            mock.patch.object(asaas, "breaker", asaas.CircuitBreaker()),
+            mock.patch.object(asaas, "_backoff", return_value=0),
+        ):
+            p.start()
+            self.addCleanup(p.stop)
+        self.app = create_app()
+        ctx = self.app.app_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+        init_db()
+        self.db = get_db()
+        self._seed()
+        self.offsets = self._record_offsets()
+
+    def _seed(self):
+        """Boletos locais pendentes cujas cobranças já estão pagas no Asaas (webhook perdido)."""
+        _, customer = self.fake.create_customer({"name": "Ana", "cpfCnpj": "52998224725"})
+        self.db.execute("INSERT INTO patients(id, name, cpf, asaas_customer_id) VALUES(1, 'Ana', '52998224725', ?)", (customer["id"],))
+        due = (date.today() + timedelta(days=10)).isoformat()
+        for n in range(N_BOLETOS):
+            _, pay = self.fake.create_payment({"customer": customer["id"], "value": 100, "dueDate": due})
+            self.fake.confirm(pay["id"])
+            tx_id = self.db.execute(
+                "INSERT INTO transactions(kind, status, date, due_date, amount_cents, payment_method, description, patient_id) "
+                "VALUES('income', 'pending', ?, ?, 10000, 'boleto', ?, 1) RETURNING id",
+                (due, due, f"Boleto • Parcela {n + 1}"),
+            ).fetchone()[0]
+            self.db.execute(
+                "INSERT INTO boletos(patient_id, finance_tx_id, asaas_customer_id, asaas_payment_id, status, value_cents, due_date, updated_at) "
+                "VALUES(1, ?, ?, ?, 'pending', 10000, ?, '2000-01-01 00:00:00')",
+                (tx_id, customer["id"], pay["id"], due),
+            )
+        self.db.commit()
+
+    def _record_offsets(self) -> list[int]:
+        """offset de cada GET /payments que chegou ao fake."""
+        offsets: list[int] = []
+        original = self.fake.list_payments
+
+        def list_payments(q):
+            offsets.append(int(q.get("offset") or 0))
+            return original(q)
+
+        p = mock.patch.object(self.fake, "list_payments", list_payments)
+        p.start()
+        self.addCleanup(p.stop)
+        return offsets
+
+    def _state(self):
+        return self.db.execute("SELECT * FROM asaas_sync_state WHERE stream='paid'").fetchone()
+
+    def _paid(self) -> tuple[int, int]:
+        return (
+            self.db.execute("SELECT COUNT(*) FROM boletos WHERE status='paid'").fetchone()[0],
+            self.db.execute("SELECT COUNT(*) FROM transactions WHERE status='paid'").fetchone()[0],
+        )
+
+    def test_pages_until_has_more_is_false(self):
+        changed = asaas_sync.sync_stream(self.db, "paid")
+        self.assertEqual(changed, N_BOLETOS)
+        self.assertEqual(self.offsets, [0, 2, 4])
+        self.assertEqual(self._paid(), (N_BOLETOS, N_BOLETOS))
+        st = self._state()
+        self.assertEqual(st["page_offset"], 0)
+        self.assertIsNone(st["run_started"])
+        self.assertEqual(st["cursor_date"], (date.today() - timedelta(days=asaas_sync.CURSOR_OVERLAP_DAYS)).isoformat())
+        self.assertEqual(st["last_changed"], N_BOLETOS)
+
+    def test_resumes_from_saved_cursor_after_interruption(self):
+        self.assertEqual(asaas_sync.sync_stream(self.db, "paid", max_pages=1), 2)
+        self.assertEqual(self._state()["page_offset"], 2)
+
+        # a rodada seguinte cai no meio (Asaas fora): nada da página é aplicado e o cursor fica
+        with mock.patch.object(self.fake, "chaos", return_value=503):
+            with self.assertRaises(asaas.AsaasError):
+                asaas_sync.sync_stream(self.db, "paid")
+        self.db.rollback()
+        st = self._state()
+        self.assertEqual(st["page_offset"], 2)
+        self.assertIsNotNone(st["run_started"])
+        self.assertEqual(self._paid(), (2, 2))
+
+        # Asaas de volta (circuito fechado de novo): continua do offset salvo
+        asaas.breaker = asaas.CircuitBreaker()
+        del self.offsets[:]
+        self.assertEqual(asaas_sync.sync_stream(self.db, "paid"), N_BOLETOS - 2)
+        self.assertEqual(self.offsets, [2, 4])
+        self.assertEqual(self._paid(), (N_BOLETOS, N_BOLETOS))
+        self.assertIsNone(self._state()["run_started"])
+
+    def test_rerunning_the_same_page_changes_nothing(self):
+        asaas_sync.sync_stream(self.db, "paid")
+        before = self.db.execute("SELECT id, status, updated_at FROM boletos ORDER BY id").fetchall()
+        tx_version = data_version(self.db, "transactions")
+
+        # o próximo ciclo recomeça com sobreposição e relê as mesmas cobranças
+        self.db.execute("UPDATE asaas_sync_state SET cursor_date=?, page_offset=0", ((date.today() - timedelta(days=30)).isoformat(),))
+        self.db.commit()
+        del self.offsets[:]
+        self.assertEqual(asaas_sync.sync_stream(self.db, "paid"), 0)
+        self.assertEqual(self.offsets, [0, 2, 4])
+        self.assertEqual([tuple(r) for r in self.db.execute("SELECT id, status, updated_at FROM boletos ORDER BY id")],
+                         [tuple(r) for r in before])
+        self.assertEqual(data_version(self.db, "transactions"), tx_version)
+
+        # a mesma página aplicada duas vezes seguidas também não regrava nada
+        page = self.fake.list_payments({"limit": "2"})["data"]
+        self.assertEqual(asaas_sync.apply_payments(self.db, page), 0)
+        self.db.rollback()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""Servidor local que imita os endpoints do Asaas usados pelo NewClínica V2.
+
+Serve para testar boletos sem o sandbox real e para medir emissão/webhooks offline.
+
+Uso:
+    python tools/asaas_fake.py --port 8099 --latency-ms 120 --error-rate 0.05 \
+        --webhook-url http://127.0.0.1:5000/webhooks/asaas
+
+    # no app:
+    ASAAS_BASE_URL=http://127.0.0.1:8099/v3 ASAAS_API_KEY=fake python run.py
+
+Endpoints (prefixo /v3):
+- POST /customers, GET /customers?cpfCnpj=
+- POST /payments, GET /payments (externalReference, customer, status,
+  paymentDate[ge|le], dueDate[ge|le], offset, limit), GET /payments/{id}
+- GET  /payments/{id}/identificationField
+- POST /sandbox/payment/{id}/confirm  (marca RECEIVED e dispara o webhook)
+
+Controle (sem prefixo):
+- GET  /_fake/stats   contadores por endpoint e estado atual
+- POST /_fake/config  muda latency_ms, jitter_ms, error_rate, throttle_rate,
+                      webhook_url, webhook_token, webhook_dup_rate em tempo real
+- POST /_fake/reset   apaga clientes/cobranças
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+PAID = ("RECEIVED", "CONFIRMED", "RECEIVED_IN_CASH")
+
+
+class FakeAsaas:
+    """Estado em memória + parâmetros de latência/erro (thread-safe)."""
+
+    def __init__(self, **config):
+        self.config = {
+            "latency_ms": 0.0,
+            "jitter_ms": 0.0,
+            "error_rate": 0.0,      # fração de respostas 503
+            "throttle_rate": 0.0,   # fração de respostas 429
+            "webhook_url": "",
+            "webhook_token": "",
+            "webhook_delay_ms": 0.0,
+            "webhook_dup_rate": 0.0,  # fração de eventos reenviados (entrega "pelo menos uma vez")
+        }
+        self.config.update({k: v for k, v in config.items() if v is not None})
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.customers: dict[str, dict] = {}
+        self.payments: dict[str, dict] = {}
+        self.stats: dict[str, dict[str, int]] = {}
+        self.webhooks_sent = 0
+        self.webhook_errors = 0
+
+    # ----- util -----
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}_{next(self.ids):012d}"
+
+    def count(self, key: str, status: int) -> None:
+        with self.lock:
+            s = self.stats.setdefault(key, {"calls": 0, "errors": 0})
+            s["calls"] += 1
+            s["errors"] += 1 if status >= 400 else 0
+
+    def chaos(self) -> int | None:
+        """Simula latência e falhas; devolve o status de erro a responder (ou None)."""
+        cfg = self.config
+        delay = float(cfg["latency_ms"]) + random.uniform(0, float(cfg["jitter_ms"]))
+        if delay > 0:
+            time.sleep(delay / 1000)
+        roll = random.random()
+        if roll < float(cfg["throttle_rate"]):
+            return 429
+        if roll < float(cfg["throttle_rate"]) + float(cfg["error_rate"]):
+            return 503
+        return None
+
+    # ----- webhooks -----
+    def send_webhook(self, event: str, payment: dict) -> None:
+        url = self.config.get("webhook_url")
+        if not url:
+            return
+        body = {"id": self.new_id("evt"), "event": event, "dateCreated": time.strftime("%Y-%m-%d %H:%M:%S"), "payment": dict(payment)}
+
+        def deliver():
+            if float(self.config["webhook_delay_ms"]) > 0:
+                time.sleep(float(self.config["webhook_delay_ms"]) / 1000)
+            times = 2 if random.random() < float(self.config["webhook_dup_rate"]) else 1
+            for _ in range(times):
+                req = Request(url, data=json.dumps(body).encode(), method="POST", headers={
+                    "Content-Type": "application/json",
+                    "asaas-access-token": self.config.get("webhook_token") or "",
+                })
+                try:
+                    with urlopen(req, timeout=10) as r:
+                        r.read()
+                    with self.lock:
+                        self.webhooks_sent += 1
+                except Exception:
+                    with self.lock:
+                        self.webhook_errors += 1
+
+        threading.Thread(target=deliver, daemon=True).start()
+
+    # ----- regras -----
+    def create_customer(self, body: dict) -> tuple[int, dict]:
+        if not body.get("name") or not body.get("cpfCnpj"):
+            return 400, {"errors": [{"code": "invalid_customer", "description": "Nome e CPF/CNPJ são obrigatórios."}]}
+        c = {"object": "customer", "id": self.new_id("cus"), "dateCreated": date.today().isoformat(), **body}
+        with self.lock:
+            self.customers[c["id"]] = c
+        return 200, c
+
+    def create_payment(self, body: dict) -> tuple[int, dict]:
+        if body.get("customer") not in self.customers:
+            return 400, {"errors": [{"code": "invalid_customer", "description": "Cliente inexistente."}]}
+        try:
+            value = float(body.get("value") or 0)
+        except (TypeError, ValueError):
+            value = 0
+        if value <= 0 or not body.get("dueDate"):
+            return 400, {"errors": [{"code": "invalid_value", "description": "Valor/vencimento inválidos."}]}
+        pid = self.new_id("pay")
+        p = {
+            "object": "payment",
+            "id": pid,
+            "dateCreated": date.today().isoformat(),
+            "customer": body["customer"],
+            "billingType": body.get("billingType") or "BOLETO",
+            "value": value,
+            "netValue": round(value * 0.98, 2),
+            "dueDate": body["dueDate"],
+            "description": body.get("description"),
+            "externalReference": body.get("externalReference"),
+            "status": "OVERDUE" if body["dueDate"] < date.today().isoformat() else "PENDING",
+            "paymentDate": None,
+            "confirmedDate": None,
+            "invoiceUrl": f"https://fake.asaas/i/{pid}",
+            "bankSlipUrl": f"https://fake.asaas/b/{pid}.pdf",
+            "deleted": False,
+        }
+        with self.lock:
+            self.payments[pid] = p
+        self.send_webhook("PAYMENT_CREATED", p)
+        return 200, p
+
+    def list_payments(self, q: dict[str, str]) -> dict:
+        with self.lock:
+            data = list(self.payments.values())
+        for field in ("externalReference", "customer", "status"):
+            if q.get(field):
+                data = [p for p in data if str(p.get(field)) == q[field]]
+        for field in ("paymentDate", "dueDate"):
+            if q.get(f"{field}[ge]"):
+                data = [p for p in data if p.get(field) and p[field] >= q[f"{field}[ge]"]]
+            if q.get(f"{field}[le]"):
+                data = [p for p in data if p.get(field) and p[field] <= q[f"{field}[le]"]]
+        offset = int(q.get("offset") or 0)
+        limit = min(100, int(q.get("limit") or 10))
+        return {
+            "object": "list",
+            "hasMore": offset + limit < len(data),
+            "totalCount": len(data),
+            "limit": limit,
+            "offset": offset,
+            "data": data[offset:offset + limit],
+        }
+
+    def confirm(self, pid: str) -> tuple[int, dict]:
+        with self.lock:
+            p = self.payments.get(pid)
+            if not p:
+                return 404, {"errors": [{"code": "not_found", "description": "Cobrança não encontrada."}]}
+            today = date.today().isoformat()
+            p.update(status="RECEIVED", paymentDate=today, confirmedDate=today, clientPaymentDate=today)
+            snapshot = dict(p)
+        self.send_webhook("PAYMENT_RECEIVED", snapshot)
+        return 200, snapshot
+
+
+_PAYMENT = re.compile(r"^/v3/payments/([\w-]+)$")
+_IDENT = re.compile(r"^/v3/payments/([\w-]+)/identificationField$")
+_CONFIRM = re.compile(r"^/v3/sandbox/payment/([\w-]+)/confirm$")
+_CUSTOMER = re.compile(r"^/v3/customers/([\w-]+)$")
+
+
+def make_handler(fake: FakeAsaas):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        server_version = "AsaasFake/1.0"
+
+        def log_message(self, fmt, *args):  # silencioso (benchmarks)
+            pass
+
+        def _send(self, status: int, body: dict, key: str) -> None:
+            raw = json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            if status == 429:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(raw)
+            fake.count(key, status)
+
+        def _body(self) -> dict:
+            n = int(self.headers.get("Content-Length") or 0)
+            if not n:
+                return {}
+            try:
+                return json.loads(self.rfile.read(n) or b"{}")
+            except ValueError:
+                return {}
+
+        def _route(self, method: str) -> None:
+            u = urlparse(self.path)
+            q = {k: v[0] for k, v in parse_qs(u.query).items()}
+            path = u.path.rstrip("/")
+            body = self._body() if method == "POST" else {}
+
+            # controle do fake
+            if path == "/_fake/stats":
+                with fake.lock:
+                    return self._send(200, {
+                        "config": fake.config,
+                        "customers": len(fake.customers),
+                        "payments": len(fake.payments),
+                        "webhooks_sent": fake.webhooks_sent,
+                        "webhook_errors": fake.webhook_errors,
+                        "endpoints": fake.stats,
+                    }, "fake")
+            if path == "/_fake/config" and method == "POST":
+                fake.config.update({k: v for k, v in body.items() if k in fake.config})
+                return self._send(200, fake.config, "fake")
+            if path == "/_fake/reset" and method == "POST":
+                with fake.lock:
+                    fake.customers.clear()
+                    fake.payments.clear()
+                    fake.stats.clear()
+                return self._send(200, {"ok": True}, "fake")
+
+            key = method + " " + re.sub(r"/(?:cus|pay)_\w+", "/:id", path)
+            if not self.headers.get("access_token"):
+                return self._send(401, {"errors": [{"code": "invalid_access_token", "description": "Chave ausente."}]}, key)
+            err = fake.chaos()
+            if err:
+                return self._send(err, {"errors": [{"code": "fake_error", "description": f"Falha simulada ({err})."}]}, key)
+
+            if method == "POST" and path == "/v3/customers":
+                return self._send(*fake.create_customer(body), key)
+            if method == "GET" and path == "/v3/customers":
+                with fake.lock:
+                    data = [c for c in fake.customers.values() if not q.get("cpfCnpj") or c.get("cpfCnpj") == q["cpfCnpj"]]
+                return self._send(200, {"object": "list", "hasMore": False, "totalCount": len(data), "data": data}, key)
+            if method == "GET" and (m := _CUSTOMER.match(path)):
+                c = fake.customers.get(m.group(1))
+                return self._send(200, c, key) if c else self._send(404, {"errors": []}, key)
+            if method == "POST" and path == "/v3/payments":
+                return self._send(*fake.create_payment(body), key)
+            if method == "GET" and path == "/v3/payments":
+                return self._send(200, fake.list_payments(q), key)
+            if method == "GET" and (m := _IDENT.match(path)):
+                p = fake.payments.get(m.group(1))
+                if not p:
+                    return self._send(404, {"errors": []}, key)
+                digits = "".join(ch for ch in p["id"] if ch.isdigit()).rjust(12, "0")
+                return self._send(200, {"identificationField": f"00190.00009 0{digits[:4]}.{digits[4:9]} {digits[9:]}0000.000000 1 {int(p['value'] * 100):010d}",
+                                        "nossoNumero": digits, "barCode": "0019" + digits}, key)
+            if method == "GET" and (m := _PAYMENT.match(path)):
+                p = fake.payments.get(m.group(1))
+                return self._send(200, p, key) if p else self._send(404, {"errors": []}, key)
+            if method == "POST" and (m := _CONFIRM.match(path)):
+                return self._send(*fake.confirm(m.group(1)), key)
+            return self._send(404, {"errors": [{"code": "not_found", "description": path}]}, key)
+
+        def do_GET(self):
+            self._route("GET")
+
+        def do_POST(self):
+            self._route("POST")
+
+    return Handler
+
+
+def serve(host: str = "127.0.0.1", port: int = 8099, **config) -> tuple[ThreadingHTTPServer, FakeAsaas]:
+    """Sobe o fake em uma thread (para scripts/benchmarks). port=0 escolhe uma porta livre."""
+    fake = FakeAsaas(**config)
+    srv = ThreadingHTTPServer((host, port), make_handler(fake))
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="asaas-fake", daemon=True).start()
+    return srv, fake
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Servidor local que imita o Asaas (testes e benchmarks).")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8099)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="latência fixa por chamada")
+    ap.add_argument("--jitter-ms", type=float, default=0.0, help="latência extra aleatória (0..jitter)")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fração de respostas 503")
+    ap.add_argument("--throttle-rate", type=float, default=0.0, help="fração de respostas 429")
+    ap.add_argument("--webhook-url", default="", help="ex.: http://127.0.0.1:5000/webhooks/asaas")
+    ap.add_argument("--webhook-token", default="", help="enviado no header asaas-access-token")
+    ap.add_argument("--webhook-delay-ms", type=float, default=0.0)
+    ap.add_argument("--webhook-dup-rate", type=float, default=0.0, help="fração de webhooks entregues duas vezes")
+    args = ap.parse_args()
+
+    srv = ThreadingHTTPServer((args.host, args.port), make_handler(FakeAsaas(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        webhook_url=args.webhook_url,
+        webhook_token=args.webhook_token,
+        webhook_delay_ms=args.webhook_delay_ms,
+        webhook_dup_rate=args.webhook_dup_rate,
+    )))
+    srv.daemon_threads = True
+    print(f"Asaas fake em http://{args.host}:{srv.server_port}/v3  (Ctrl+C para sair)")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
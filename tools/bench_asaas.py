@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Benchmark offline da emissão de boletos e dos webhooks (usa tools/asaas_fake.py).
+
+Cria um banco temporário, sobe o Asaas fake na mesma máquina e mede:
+1) emissão de carnê (N pacientes × K parcelas) pelo worker de tarefas;
+2) ack dos webhooks e tempo para drenar a caixa de entrada.
+
+Uso:
+    python tools/bench_asaas.py --patients 20 --installments 12 --latency-ms 150 --error-rate 0.02
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+ROOT = HERE.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(HERE))
+
+from asaas_fake import serve  # noqa: E402
+
+
+def _fake_cpf() -> str:
+    n = [random.randint(0, 9) for _ in range(9)]
+    for size in (9, 10):
+        s = sum(d * w for d, w in zip(n, range(size + 1, 1, -1)))
+        n.append(0 if s % 11 < 2 else 11 - s % 11)
+    return "".join(map(str, n))
+
+
+def _pct(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--patients", type=int, default=10)
+    ap.add_argument("--installments", type=int, default=12)
+    ap.add_argument("--webhooks", type=int, default=2000)
+    ap.add_argument("--latency-ms", type=float, default=100.0)
+    ap.add_argument("--jitter-ms", type=float, default=50.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--throttle-rate", type=float, default=0.0)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--rate", type=float, default=20.0, help="chamadas/s nos lotes")
+    args = ap.parse_args()
+
+    srv, fake = serve(port=0, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+    os.environ.update({
+        "DB_PATH": os.path.join(tempfile.mkdtemp(), "bench.db"),
+        "JOBS_WORKER": "0",
+        "ASAAS_BASE_URL": f"http://127.0.0.1:{srv.server_port}/v3",
+        "ASAAS_API_KEY": "fake",
+        "ASAAS_MAX_CONCURRENCY": str(args.concurrency),
+        "ASAAS_RATE_PER_SEC": str(args.rate),
+    })
+
+    from app import create_app
+    from app import jobs
+    from app.db import get_db
+
+    app = create_app()
+    c = app.test_client()
+    c.get("/login")
+    c.post("/login", data={"username": "admin", "password": "admin123"})
+
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            "INSERT INTO patients(name, cpf, phone) VALUES(?,?,?)",
+            [(f"Paciente {i:03d}", _fake_cpf(), "11999990000") for i in range(args.patients)],
+        )
+        db.commit()
+        pids = [r["id"] for r in db.execute("SELECT id FROM patients ORDER BY id")]
+
+    # 1) carnê
+    t0 = time.perf_counter()
+    r = c.post("/boletos/carne", data={
+        "patient_ids": [str(p) for p in pids],
+        "installments": str(args.installments),
+        "first_due_date": time.strftime("%Y-%m-%d"),
+        "amount": "150,00",
+        "description": "Benchmark",
+    })
+    t_request = time.perf_counter() - t0
+    assert r.status_code == 302, r.status_code
+
+    t0 = time.perf_counter()
+    with app.app_context():
+        db = get_db()
+        while True:
+            jobs.run_pending(db)
+            left = db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued','running')").fetchone()[0]
+            if not left:
+                break
+            # backoff das tarefas reagendadas: adianta para não esperar de verdade
+            db.execute("UPDATE jobs SET run_after=datetime('now') WHERE status='queued'")
+            db.commit()
+        counts = dict(db.execute("SELECT status, COUNT(*) FROM boletos GROUP BY status").fetchall())
+    t_issue = time.perf_counter() - t0
+    total = args.patients * args.installments
+    print(f"Carnê: {total} boletos | POST {t_request * 1000:.0f} ms | emissão {t_issue:.1f} s "
+          f"({total / t_issue:.1f} boletos/s) | {counts}")
+
+    # 2) webhooks
+    with app.app_context():
+        pay_ids = [r[0] for r in get_db().execute("SELECT asaas_payment_id FROM boletos WHERE asaas_payment_id IS NOT NULL")]
+    if pay_ids:
+        acks = []
+        t0 = time.perf_counter()
+        for i in range(args.webhooks):
+            body = {"id": f"evt_bench_{i}", "event": "PAYMENT_RECEIVED", "payment": {"id": random.choice(pay_ids), "paymentDate": "2026-01-10"}}
+            t1 = time.perf_counter()
+            c.post("/webhooks/asaas", json=body)
+            acks.append((time.perf_counter() - t1) * 1000)
+        t_ack = time.perf_counter() - t0
+        from app.boletos import drain_webhook_inbox
+        t0 = time.perf_counter()
+        with app.app_context():
+            drained = drain_webhook_inbox(get_db())
+        t_drain = time.perf_counter() - t0
+        print(f"Webhooks: {args.webhooks} eventos | ack p50 {statistics.median(acks):.2f} ms, p95 {_pct(acks, 95):.2f} ms "
+              f"({args.webhooks / t_ack:.0f}/s) | drenagem de {drained} em {t_drain * 1000:.0f} ms")
+
+    print("Asaas fake:", {k: v for k, v in fake.stats.items()})
+    srv.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,3 @@
 # -*- coding: utf-8 -*-
-from app import create_app
-app = create_app()
+from app import create_app, start_server
+app = start_server(create_app())